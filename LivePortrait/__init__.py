@@ -1 +1,3 @@
-from .fast_live_portrait_pipeline import LivePortraitONNX
\ No newline at end of file
+from .engine import InferenceEngine
+from .fast_live_portrait_pipeline import LivePortraitONNX
+from .async_pipeline import AsyncLivePortrait
@@ -0,0 +1,174 @@
+import math
+import os.path as osp
+from glob import glob
+from dataclasses import dataclass, field
+from typing import List, Tuple
+import cv2
+
+from LivePortrait.utils import probe_video
+
+# per-frame stage times (seconds) assumed until the engine has measured them
+STAGE_PRIORS = {'driving': 0.002, 'retargeting': 0.02, 'motion': 0.015, 'stitching': 0.001, 'warp': 0.15,
+                'paste_back': 0.015}
+# memory of a job whatever its length: source image, its 3d feature, compositor
+BASE_MEMORY_MB = 64.
+# statuses of the jobs that still hold or wait for a worker
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+class AdmissionRejected(Exception):
+    """ the node can't take the job within its budgets, retry_after: seconds until it probably can """
+
+    def __init__(self, reason, retry_after=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class JobTooLarge(AdmissionRejected):
+    """ the job can't fit the node whatever its load, retrying won't help """
+
+
+@dataclass
+class JobEstimate:
+    seconds: float  # worker time to render the job
+    memory_mb: float  # peak memory of its frames
+
+
+@dataclass
+class AdmissionDecision:
+    action: str  # 'admit', 'downgrade' or 'queue'
+    options: dict  # Config fields the job runs with, downgrades included
+    output_modes: Tuple[str, ...]
+    estimate: JobEstimate
+    wait: float  # expected seconds of backlog ahead of the job
+    downgrades: List[str] = field(default_factory=list)
+    reason: str = ''
+
+    def to_dict(self) -> dict:
+        return {
+            'action': self.action,
+            'downgrades': list(self.downgrades),
+            'reason': self.reason,
+            'estimated_seconds': self.estimate.seconds,
+            'estimated_memory_mb': self.estimate.memory_mb,
+            'expected_wait': self.wait,
+        }
+
+
+def driving_info(path, cfg):
+    """ (number of frames, (width, height)) of a driving video or frame directory, before frame selection
+    """
+    if osp.isdir(path):
+        image_paths = sorted(glob(osp.join(path, '*.png')) + glob(osp.join(path, '*.jpg')))
+        img = cv2.imread(image_paths[0]) if image_paths else None
+        frame_size = (img.shape[1], img.shape[0]) if img is not None else (cfg.dsize, cfg.dsize)
+        return len(image_paths), frame_size
+    info = probe_video(path)
+    return info['n_frames'], (info['width'], info['height'])
+
+
+class AdmissionController:
+    """ admission control of the rendering service: a new job is admitted as asked, downgraded (retargeting off,
+    then crop output only), queued or rejected, so that an overload delays the excess jobs instead of every job.
+    its cost is its number of frames times the per-frame stage latencies measured by the engine, the backlog is
+    the remaining cost of the queued and running jobs. budgets (0 disables them):
+    cfg.admission_max_latency_s  backlog + cost a job may expect before it is done, beyond it is downgraded or queued
+    cfg.admission_max_queue      jobs queued over the latency budget, beyond them jobs are rejected
+    cfg.admission_memory_mb      memory of the frames of the running jobs, each one gets its worker's share,
+                                 a job over it is rendered in chunks, or rejected if even that doesn't fit
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def frame_seconds(self, cfg, output_modes):
+        """ measured (or assumed) worker time per driving frame of a job
+        """
+        stages = ['motion', 'stitching', 'warp']
+        stages.append('retargeting' if cfg.flag_eye_retargeting or cfg.flag_lip_retargeting else 'driving')
+        if 'pasted' in output_modes:
+            stages.append('paste_back')
+        return sum(self.engine.stage_latency.mean(stage, STAGE_PRIORS[stage]) for stage in stages)
+
+    @staticmethod
+    def frame_bytes(cfg, output_modes, frame_size):
+        """ memory per driving frame held during a render
+        """
+        h, w = cfg.input_shape
+        n_bytes = h * w * 3 * (4 + 1)  # float32 network input and the uint8 frame it comes from
+        if cfg.flag_eye_retargeting or cfg.flag_lip_retargeting:
+            n_bytes += frame_size[0] * frame_size[1] * 3  # native frames for the landmarks
+        elif 'concat' in output_modes:
+            n_bytes += cfg.dsize * cfg.dsize * 3  # display frames
+        if 'crop' in output_modes or 'concat' in output_modes:
+            n_bytes += cfg.dsize * cfg.dsize * 3  # animated crops kept for the outputs
+        return n_bytes
+
+    def estimate(self, options, output_modes, n_frames, frame_size) -> JobEstimate:
+        cfg = self.engine.with_options(**options).cfg
+        held = min(n_frames, cfg.render_chunk_size) if cfg.render_chunk_size > 0 else n_frames
+        return JobEstimate(seconds=n_frames * self.frame_seconds(cfg, output_modes),
+                           memory_mb=BASE_MEMORY_MB + held * self.frame_bytes(cfg, output_modes, frame_size) / 2 ** 20)
+
+    def candidates(self, options, output_modes, allow_downgrade):
+        """ [(downgrades, options, output_modes)], the job as asked first, then more and more degraded
+        """
+        cfg = self.engine.with_options(**options).cfg
+        candidates = [([], dict(options), tuple(output_modes))]
+        if not allow_downgrade:
+            return candidates
+        if cfg.flag_eye_retargeting or cfg.flag_lip_retargeting:
+            downgrades, options, output_modes = candidates[-1]
+            candidates.append((downgrades + ['no_retargeting'],
+                               dict(options, flag_eye_retargeting=False, flag_lip_retargeting=False), output_modes))
+        if tuple(output_modes) != ('crop',):
+            downgrades, options, _ = candidates[-1]
+            candidates.append((downgrades + ['crop_only'], options, ('crop',)))
+        return candidates
+
+    def backlog(self, jobs):
+        """ remaining worker time of the queued and running jobs
+        """
+        seconds = 0.
+        for job in jobs:
+            if job.status not in ACTIVE_STATUSES or job.admission is None:
+                continue
+            done = job.frames_done / job.n_frames if job.n_frames else 0.
+            seconds += job.admission.estimate.seconds * max(1. - done, 0.)
+        return seconds
+
+    def decide(self, options, output_modes, n_frames, frame_size, jobs, allow_downgrade=True) -> AdmissionDecision:
+        """ how to run a new job of n_frames driving frames of frame_size (w, h) given the active jobs
+        raise: AdmissionRejected, JobTooLarge
+        """
+        cfg = self.engine.with_options(**options).cfg
+        n_workers = max(cfg.service_workers, 1)
+        wait = self.backlog(jobs) / n_workers
+        memory_share = cfg.admission_memory_mb / n_workers if cfg.admission_memory_mb > 0 else math.inf
+        max_latency = cfg.admission_max_latency_s if cfg.admission_max_latency_s > 0 else math.inf
+
+        fitting = []
+        for downgrades, job_options, job_modes in self.candidates(options, output_modes, allow_downgrade):
+            estimate = self.estimate(job_options, job_modes, n_frames, frame_size)
+            if estimate.memory_mb > memory_share and job_options.get('render_chunk_size', cfg.render_chunk_size) == 0:
+                # chunks bound the frames in memory without changing the outputs
+                job_options = dict(job_options, render_chunk_size=cfg.admission_chunk_size)
+                downgrades = downgrades + ['chunked']
+                estimate = self.estimate(job_options, job_modes, n_frames, frame_size)
+            if estimate.memory_mb <= memory_share:
+                fitting.append((downgrades, job_options, job_modes, estimate))
+
+        if not fitting:
+            raise JobTooLarge(f'job needs more than the {memory_share:.0f} MB memory share of a worker')
+        for downgrades, job_options, job_modes, estimate in fitting:
+            if wait + estimate.seconds <= max_latency:
+                action = 'downgrade' if set(downgrades) - {'chunked'} else 'admit'
+                return AdmissionDecision(action, job_options, job_modes, estimate, wait, downgrades)
+
+        n_queued = sum(job.status == 'queued' for job in jobs)
+        if n_queued >= cfg.admission_max_queue:
+            raise AdmissionRejected(f'overloaded: {n_queued} jobs queued', retry_after=wait)
+        downgrades, job_options, job_modes, estimate = fitting[0]
+        return AdmissionDecision('queue', job_options, job_modes, estimate, wait, downgrades,
+                                 reason=f'expected {wait + estimate.seconds:.0f}s, over the {max_latency:.0f}s budget')
@@ -0,0 +1,197 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator
+import cv2
+import numpy as np
+
+from LivePortrait.commons import Config
+from LivePortrait.commons.states import SourceState, DrivingState
+from LivePortrait.engine import InferenceEngine
+
+# end of a stream on the queues of animate()
+_END = object()
+
+
+def _batched(frames, n):
+    chunk = []
+    for frame in frames:
+        chunk.append(frame)
+        if len(chunk) == n:
+            yield chunk, None
+            chunk = []
+    if chunk:
+        yield chunk, None
+
+
+class AsyncLivePortrait:
+    """ asyncio front of an InferenceEngine, for services that must not block their event loop
+    the blocking onnxruntime/OpenCV work runs on an executor, decoding, inference and the consumer are decoupled
+    by bounded queues: a slow consumer pauses inference, which pauses decoding, nothing is buffered beyond
+    cfg.async_queue_size frames. closing the iterator (or cancelling the task consuming it) stops both stages,
+    the frame being animated is the last one
+    """
+
+    def __init__(self, engine: InferenceEngine = None, executor=None, cfg=Config):
+        """
+        engine: shared engine, a new one loaded with cfg by default
+        executor: executor of the blocking calls, a thread pool of cfg.async_threads owned by this object by default
+        """
+        self.engine = engine if engine is not None else InferenceEngine(cfg)
+        self._own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=self.engine.cfg.async_threads,
+                                          thread_name_prefix='live_portrait')
+        self.executor = executor
+
+    async def run(self, fn, *args, **kwargs):
+        """ fn(*args, **kwargs) on the executor
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def prepare_source(self, image_path) -> SourceState:
+        return await self.run(self.engine.prepare_source, image_path)
+
+    async def animate(self, source, driving, driving_state=None, paste_back=None) -> AsyncIterator[np.ndarray]:
+        """ animated frames of the source, yielded as soon as they are rendered
+        source: SourceState or path of the source image
+        driving: path of a driving video or image directory, or an iterable / async iterable of HxWx3 RGB frames
+        driving_state: DrivingState to continue (e.g. a stream split over several calls), a new one by default
+        paste_back: yield the frames pasted back into the source image instead of the crops, cfg.flag_pasteback
+        by default
+        yield: HxWx3 uint8 RGB frames
+        """
+        cfg = self.engine.cfg
+        if not isinstance(source, SourceState):
+            source = await self.prepare_source(source)
+        driving_state = driving_state if driving_state is not None else DrivingState()
+        compositor = None
+        if cfg.flag_pasteback if paste_back is None else paste_back:
+            compositor = await self.run(self.engine.prepare_compositor, cfg.mask_crop, source.crop_info['M_c2o'],
+                                        source.img_rgb, use_remap=cfg.flag_remap_paste_back,
+                                        num_threads=cfg.paste_back_threads)
+
+        stop = threading.Event()
+        chunks = asyncio.Queue(maxsize=max(cfg.async_queue_size // max(cfg.async_chunk_size, 1), 1))
+        frames = asyncio.Queue(maxsize=max(cfg.async_queue_size, 1))
+        tasks = [
+            asyncio.create_task(self._decode(driving, chunks, stop)),
+            asyncio.create_task(self._infer(source, driving_state, compositor, chunks, frames, stop)),
+        ]
+        try:
+            while True:
+                frame = await frames.get()
+                if frame is _END:
+                    break
+                if isinstance(frame, BaseException):
+                    raise frame
+                yield frame
+        finally:
+            # the consumer is gone (or done): the frame being animated is the last one
+            stop.set()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _decode(self, driving, chunks, stop):
+        """ (driving_rgb_lst, driving_rgb_lst_256 or None) chunks of the driving frames onto chunks, then _END
+        """
+        cfg = self.engine.cfg
+        try:
+            if hasattr(driving, '__aiter__'):
+                chunk = []
+                async for frame in driving:
+                    if stop.is_set():
+                        return
+                    chunk.append(frame)
+                    if len(chunk) == cfg.async_chunk_size:
+                        await chunks.put((chunk, None))
+                        chunk = []
+                if chunk:
+                    await chunks.put((chunk, None))
+            else:
+                if isinstance(driving, str):
+                    selector = await self.run(self.engine.get_frame_selector, driving, cfg)
+                    chunk_iter = self.engine.iter_driving_chunks(driving, cfg, cfg.async_chunk_size,
+                                                                 with_display=False, selector=selector)
+                else:
+                    chunk_iter = _batched(driving, cfg.async_chunk_size)
+                await self._pull(chunk_iter, chunks, stop)
+            await chunks.put(_END)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await chunks.put(e)
+
+    async def _pull(self, chunk_iter, chunks, stop):
+        """ next() of a blocking iterator on the executor until it is exhausted or stop is set
+        the iterator is then closed on the executor once no next() call runs anymore, which ends its decoder, and
+        waited for up to cfg.async_close_timeout_s
+        """
+        future = None
+        try:
+            while not stop.is_set():
+                future = self.executor.submit(next, chunk_iter, _END)
+                chunk = await asyncio.wrap_future(future)
+                if chunk is _END:
+                    break
+                await chunks.put(chunk)
+        finally:
+            closed = Future()
+
+            def close(_=None):
+                try:
+                    chunk_iter.close()
+                    closed.set_result(None)
+                except BaseException as e:
+                    closed.set_exception(e)
+
+            if future is None or future.done():
+                self.executor.submit(close)
+            else:
+                # a generator cannot be closed while it runs, the worker closes it once next() returns
+                future.add_done_callback(close)
+            # bounded: a decoder that doesn't end in time is left to its thread rather than holding the caller
+            await asyncio.wait([asyncio.wrap_future(closed)], timeout=self.engine.cfg.async_close_timeout_s)
+
+    async def _infer(self, source, driving_state, compositor, chunks, frames, stop):
+        """ animated frames of the chunks onto frames, then _END (or the error of a stage)
+        """
+        try:
+            while True:
+                chunk = await chunks.get()
+                if chunk is _END or isinstance(chunk, BaseException):
+                    await frames.put(chunk)
+                    return
+                for frame in await self.run(self.animate_chunk, source, driving_state, compositor, chunk, stop):
+                    await frames.put(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await frames.put(e)
+
+    def animate_chunk(self, source: SourceState, driving_state: DrivingState, compositor, chunk, stop=None):
+        """ blocking: the frames of one chunk of driving frames, pasted back when a compositor is given
+        """
+        cfg = self.engine.cfg
+        driving_rgb_lst, driving_rgb_lst_256 = chunk
+        if driving_rgb_lst_256 is None:
+            driving_rgb_lst_256 = [cv2.resize(frame, tuple(cfg.input_shape)) for frame in driving_rgb_lst]
+        i_d_lst, eye_ratio_lst, lip_ratio_lst = self.engine.process_driving_frames(driving_rgb_lst, driving_rgb_lst_256,
+                                                                                   cfg, self.engine.cropper)
+        i_p_paste_lst = []
+        result = self.engine.animate(source, driving_state, i_d_lst, eye_ratio_lst, lip_ratio_lst,
+                                     compositor=compositor, i_p_paste_lst=i_p_paste_lst,
+                                     keep_crop=compositor is None, progress=False, stop=stop)
+        return i_p_paste_lst if compositor is not None else result
+
+    def close(self):
+        if self._own_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
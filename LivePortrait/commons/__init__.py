@@ -1,2 +1,3 @@
 from .config import Config
-from .portrait import PortraitController
\ No newline at end of file
+from .portrait import PortraitController
+from .states import SourceState, DrivingState
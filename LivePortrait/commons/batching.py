@@ -0,0 +1,143 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+import numpy as np
+from .scheduling import DeadlineMissed, current_work, work_priority
+
+
+class _Request:
+    __slots__ = ('output_names', 'feeds', 'batch_size', 'key', 'work', 'future')
+
+    def __init__(self, output_names, feeds, batch_size, key):
+        self.output_names = output_names
+        self.feeds = feeds
+        self.batch_size = batch_size
+        self.key = key
+        self.work = current_work()  # (priority, deadline) of the caller
+        self.future = Future()
+
+
+class BatchedSession:
+    """ dynamic micro-batching of the calls of many threads (jobs) to one onnxruntime session
+    run() has the InferenceSession signature: the call is queued, a worker thread gathers the queued calls for up
+    to max_wait_ms or max_batch_size frames, runs the compatible ones (same inputs, outputs, shapes but the batch
+    axis) as one batch and scatters the outputs back, every output must have the batch axis first.
+    calls that can't be batched (fixed batch axis, OrtValue inputs, already large batches) run directly.
+    over a ScheduledSession a batch runs with the most urgent priority and deadline of its calls, the calls whose
+    deadline passed while they were gathered are dropped first
+    """
+
+    def __init__(self, session, max_batch_size=8, max_wait_ms=2.):
+        self.session = session
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        # models exported with a fixed batch of 1 can only run their calls one by one
+        self.batchable = max_batch_size > 1 and all(not isinstance(i.shape[0], int) for i in session.get_inputs())
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        self._n_calls = 0
+        self._n_batches = 0
+
+    def __getattr__(self, name):
+        # get_inputs(), get_outputs(), get_providers(), ... of the wrapped session
+        return getattr(self.session, name)
+
+    def run(self, output_names, input_feed, run_options=None):
+        batch_size = self._batch_size(input_feed)
+        if not self.batchable or run_options is not None or batch_size is None or batch_size >= self.max_batch_size:
+            return self.session.run(output_names, input_feed, run_options)
+        key = (tuple(output_names) if output_names is not None else None,
+               tuple(sorted((name, x.shape[1:], x.dtype.str) for name, x in input_feed.items())))
+        request = _Request(output_names, input_feed, batch_size, key)
+        self._start()
+        self._queue.put(request)
+        return request.future.result()
+
+    @staticmethod
+    def _batch_size(input_feed):
+        """ the common batch size of the numpy inputs, None when they can't be concatenated
+        """
+        sizes = {x.shape[0] if isinstance(x, np.ndarray) and x.ndim > 0 else None for x in input_feed.values()}
+        return sizes.pop() if len(sizes) == 1 else None
+
+    def _start(self):
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._loop, name='micro_batching', daemon=True)
+                    self._worker.start()
+
+    def _loop(self):
+        while True:
+            pending = [self._queue.get()]
+            n_frames = pending[0].batch_size
+            deadline = time.perf_counter() + self.max_wait
+            while n_frames < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                pending.append(request)
+                n_frames += request.batch_size
+            groups = {}
+            for request in pending:
+                groups.setdefault(request.key, []).append(request)
+            for group in groups.values():
+                self._run_batch(group)
+
+    def _run_batch(self, group):
+        now = time.perf_counter()
+        for request in group:
+            if request.work[1] is not None and request.work[1] < now:
+                request.future.set_exception(DeadlineMissed('deadline passed while batching'))
+        group = [request for request in group if not request.future.done()]
+        if not group:
+            return
+        # a batch mixing in calls without deadline must not be dropped for the others
+        deadlines = [request.work[1] for request in group if request.work[1] is not None]
+        deadline = min(deadlines) if len(deadlines) == len(group) else None
+        try:
+            with work_priority(min(request.work[0] for request in group), deadline):
+                outputs = self._run_group(group)
+            results = self._scatter(group, outputs)
+        except Exception as e:
+            for request in group:
+                request.future.set_exception(e)
+            return
+        with self._lock:
+            self._n_calls += len(group)
+            self._n_batches += 1
+        for request, result in zip(group, results):
+            request.future.set_result(result)
+
+    @staticmethod
+    def _scatter(group, outputs):
+        """ the outputs of every call of the group, raise: ValueError when an output has no batch axis to split
+        """
+        n_frames = sum(request.batch_size for request in group)
+        if len(group) > 1 and any(np.ndim(output) == 0 or len(output) != n_frames for output in outputs):
+            raise ValueError(f'batched outputs must have the batch axis ({n_frames}) first')
+        results, start = [], 0
+        for request in group:
+            end = start + request.batch_size
+            results.append([output[start:end] for output in outputs])
+            start = end
+        return results
+
+    def _run_group(self, group):
+        if len(group) == 1:
+            return self.session.run(group[0].output_names, group[0].feeds)
+        feeds = {name: np.concatenate([request.feeds[name] for request in group]) for name in group[0].feeds}
+        return self.session.run(group[0].output_names, feeds)
+
+    def stats(self) -> dict:
+        """ calls served and batches run so far, their ratio is the mean batch size
+        """
+        with self._lock:
+            return {'calls': self._n_calls, 'batches': self._n_batches,
+                    'mean_batch': self._n_calls / self._n_batches if self._n_batches else 0.}
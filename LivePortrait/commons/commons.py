@@ -2,6 +2,7 @@ import torch.nn.functional as F
 import torch
 import numpy as np
 from LivePortrait.commons.retarget_portrait import RetargetStitchPortrait
+from LivePortrait.commons.retarget_features import RetargetFeatures
 
 
 class Transform3DFunction(RetargetStitchPortrait):
@@ -101,30 +102,22 @@ class Transform3DFunction(RetargetStitchPortrait):
 
         return kp_transformed
 
-    def calc_retargeting_ratio(self, driving_lmk_lst):
-        input_eye_ratio_lst = []
-        input_lip_ratio_lst = []
-        for lmk in driving_lmk_lst:
-            # for eyes retargeting
-            input_eye_ratio_lst.append(self.calc_eye_close_ratio(lmk[None]))
-            # for lip retargeting
-            input_lip_ratio_lst.append(self.calc_lip_close_ratio(lmk[None]))
-        return input_eye_ratio_lst, input_lip_ratio_lst
-
-    def calc_combined_eye_ratio(self, input_eye_ratio, source_lmk):
-        eye_close_ratio = self.calc_eye_close_ratio(source_lmk[None])
-        eye_close_ratio_tensor = torch.from_numpy(eye_close_ratio).float()
-        input_eye_ratio_tensor = torch.Tensor([input_eye_ratio[0][0]]).reshape(1, 1)
+    @staticmethod
+    def calc_retargeting_ratio(driving_lmk_lst):
+        """ eye/lip close ratios of all driving frames in one pass
+        return: Tx1x2 eye ratios and Tx1x1 lip ratios, indexed per frame like the landmark list
+        """
+        input_eye_ratio_lst, input_lip_ratio_lst = RetargetFeatures.driving_ratios(driving_lmk_lst)
+        return input_eye_ratio_lst[:, None], input_lip_ratio_lst[:, None]
+
+    @staticmethod
+    def calc_combined_eye_ratio(input_eye_ratio, source_lmk):
         # [c_s,eyes, c_d,eyes,i]
-        combined_eye_ratio_tensor = torch.cat([eye_close_ratio_tensor, input_eye_ratio_tensor], dim=1)
-        return combined_eye_ratio_tensor
+        combined_eye_ratio = RetargetFeatures(source_lmk).combined_eye_ratio(input_eye_ratio)
+        return torch.from_numpy(combined_eye_ratio)
 
-    def calc_combined_lip_ratio(self, input_lip_ratio, source_lmk):
-        lip_close_ratio = self.calc_lip_close_ratio(source_lmk[None])
-        lip_close_ratio_tensor = torch.from_numpy(lip_close_ratio).float()
+    @staticmethod
+    def calc_combined_lip_ratio(input_lip_ratio, source_lmk):
         # [c_s,lip, c_d,lip,i]
-        input_lip_ratio_tensor = torch.Tensor([input_lip_ratio[0]])
-        if input_lip_ratio_tensor.shape != [1, 1]:
-            input_lip_ratio_tensor = input_lip_ratio_tensor.reshape(1, 1)
-        combined_lip_ratio_tensor = torch.cat([lip_close_ratio_tensor, input_lip_ratio_tensor], dim=1)
-        return combined_lip_ratio_tensor
+        combined_lip_ratio = RetargetFeatures(source_lmk).combined_lip_ratio(input_lip_ratio)
+        return torch.from_numpy(combined_lip_ratio)
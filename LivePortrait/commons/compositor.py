@@ -0,0 +1,148 @@
+import numpy as np
+import cv2
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+CV2_INTERP = cv2.INTER_LINEAR
+
+
+@lru_cache(maxsize=None)
+def get_band_pool(num_threads: int) -> ThreadPoolExecutor:
+    """ thread pool shared by the compositors, cv2 releases the GIL so the bands run in parallel
+    even though cv2.setNumThreads(0) keeps every single call single-threaded
+    """
+    return ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='paste_back')
+
+
+def div255(x: np.ndarray) -> np.ndarray:
+    """ round(x / 255) for uint16 x in [0, 255 * 255], without a division
+    """
+    x = x + np.uint16(128)
+    return (x + (x >> 8)) >> 8
+
+
+class PasteBackCompositor:
+    """ paste-back of the animated crop restricted to the bounding box of the mask
+    the mask, its ROI and the background term of the blend are computed once per source,
+    every frame only warps the crop into the ROI and blends it in uint16 fixed point
+    """
+
+    def __init__(self, mask_crop: np.ndarray, crop_m_c2o: np.ndarray, rgb_ori: np.ndarray, flags=CV2_INTERP,
+                 use_remap=False, num_threads=1):
+        """
+        mask_crop: dsize x dsize x 3, uint8 mask in the cropping space
+        crop_m_c2o: 3x3 matrix from the cropping space to the original image
+        rgb_ori: HxWx3, uint8 source image
+        use_remap: warp the crop with float remap tables built here instead of warpAffine every frame
+        num_threads: split the paste back over this many horizontal bands on a thread pool
+        """
+        self.flags = flags
+        self.num_threads = max(int(num_threads), 1)
+        self.background = np.ascontiguousarray(rgb_ori)
+        h, w = rgb_ori.shape[:2]
+        crop_m_c2o = np.asarray(crop_m_c2o, dtype=np.float64)
+
+        # the warped crop can only land inside the image of the crop corners
+        ch, cw = mask_crop.shape[:2]
+        corners = np.array([[0, 0], [cw, 0], [cw, ch], [0, ch]], dtype=np.float64)
+        corners = corners @ crop_m_c2o[:2, :2].T + crop_m_c2o[:2, 2]
+        x0, y0 = np.clip(np.floor(corners.min(axis=0)).astype(int) - 1, 0, [w, h])
+        x1, y1 = np.clip(np.ceil(corners.max(axis=0)).astype(int) + 1, 0, [w, h])
+        mask_roi = self._warp(mask_crop, crop_m_c2o, x0, y0, x1 - x0, y1 - y0)
+
+        # tighten the ROI to the non-zero part of the mask
+        if mask_roi.size > 0:
+            rx, ry, rw, rh = cv2.boundingRect(np.ascontiguousarray(mask_roi.max(axis=2)))
+        else:
+            rx, ry, rw, rh = 0, 0, 0, 0
+        mask_roi = mask_roi[ry:ry + rh, rx:rx + rw]
+        self.roi = (int(x0 + rx), int(y0 + ry), int(rw), int(rh))  # x, y, w, h in the original image
+        x, y = self.roi[:2]
+
+        # translate the crop->original transform so that warpAffine writes the ROI only
+        self.m_c2roi = crop_m_c2o.copy()
+        self.m_c2roi[0, 2] -= x
+        self.m_c2roi[1, 2] -= y
+
+        self.remap_maps = self._build_remap_maps(self.m_c2roi, rw, rh) if use_remap else None
+
+        self.alpha = mask_roi.astype(np.uint16)
+        # (255 - alpha) * background does not change from frame to frame
+        self.background_term = (255 - self.alpha) * self.background[y:y + rh, x:x + rw].astype(np.uint16)
+
+        # the ROI rows are split evenly, the first/last band also take the background rows above/below it
+        n_bands = min(self.num_threads, max(rh, 1))
+        edges = [y + rh * i // n_bands for i in range(n_bands + 1)]
+        edges[0], edges[-1] = 0, h
+        self.bands = list(zip(edges[:-1], edges[1:]))
+
+    @staticmethod
+    def _build_remap_maps(m_c2roi, w, h):
+        """ source coordinates of every ROI pixel, kept as float32 maps: the CV_16SC2 maps of cv2.convertMaps
+        quantize them and drift up to ~7 levels from warpAffine, the float maps stay as close to it as warpAffine
+        """
+        if w == 0 or h == 0:
+            return None
+        m_roi2c = cv2.invertAffineTransform(m_c2roi[:2])
+        xs = np.arange(w, dtype=np.float64)
+        ys = np.arange(h, dtype=np.float64)[:, None]
+        map_x = (m_roi2c[0, 0] * xs + m_roi2c[0, 1] * ys + m_roi2c[0, 2]).astype(np.float32)
+        map_y = (m_roi2c[1, 0] * xs + m_roi2c[1, 1] * ys + m_roi2c[1, 2]).astype(np.float32)
+        return map_x, map_y
+
+    def _warp(self, img, m, x, y, w, h):
+        m = np.array(m[:2], dtype=np.float64)
+        m[0, 2] -= x
+        m[1, 2] -= y
+        return cv2.warpAffine(img, m, dsize=(int(w), int(h)), flags=self.flags)
+
+    @property
+    def mask_ori(self) -> np.ndarray:
+        """ the float32 full-frame mask, same as prepare_paste_back
+        """
+        h, w = self.background.shape[:2]
+        mask_ori = np.zeros((h, w, 3), dtype=np.float32)
+        x, y, rw, rh = self.roi
+        mask_ori[y:y + rh, x:x + rw] = self.alpha / 255.
+        return mask_ori
+
+    def blend_roi(self, image_to_processed: np.ndarray, row0=0, row1=None) -> np.ndarray:
+        """ warp the crop into the rows [row0, row1) of the ROI and blend them with the background
+        return: (row1 - row0) x rw x 3, uint8
+        """
+        _, _, rw, rh = self.roi
+        row1 = rh if row1 is None else row1
+        if self.remap_maps is not None:
+            result = cv2.remap(image_to_processed, self.remap_maps[0][row0:row1], self.remap_maps[1][row0:row1],
+                               self.flags)
+        else:
+            m = self.m_c2roi[:2].copy()
+            m[1, 2] -= row0
+            result = cv2.warpAffine(image_to_processed, m, dsize=(rw, row1 - row0), flags=self.flags)
+        return div255(self.alpha[row0:row1] * result + self.background_term[row0:row1]).astype(np.uint8)
+
+    def _paste_band(self, image_to_processed, out, band, copy_background):
+        band0, band1 = band
+        if copy_background:
+            out[band0:band1] = self.background[band0:band1]
+        x, y, rw, rh = self.roi
+        row0, row1 = max(band0, y), min(band1, y + rh)
+        if rw > 0 and row0 < row1:
+            out[row0:row1, x:x + rw] = self.blend_roi(image_to_processed, row0 - y, row1 - y)
+
+    def paste_back(self, image_to_processed: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """ paste the animated crop back into the source image
+        out: optional HxWx3 buffer already holding the background (e.g. the previous output), reused as is
+        """
+        copy_background = out is None
+        if out is None:
+            out = np.empty_like(self.background)
+        if len(self.bands) > 1:
+            pool = get_band_pool(self.num_threads)
+            futures = [pool.submit(self._paste_band, image_to_processed, out, band, copy_background)
+                       for band in self.bands]
+            for future in futures:
+                future.result()
+        else:
+            self._paste_band(image_to_processed, out, (0, out.shape[0]), copy_background)
+        return out
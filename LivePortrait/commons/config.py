@@ -1,7 +1,7 @@
 import os
 import requests
-from dataclasses import dataclass
-from typing import Literal, Tuple
+from dataclasses import dataclass, fields
+from typing import Literal, Optional, Tuple
 from tqdm import tqdm
 import torch.cuda
 from .base_config import PrintableConfig
@@ -24,6 +24,11 @@ MODEL_URLS = {
 }
 
 
+# 'crop': the 512x512 animated face crop, 'pasted': the crop pasted back into the source image,
+# 'concat': driving | source | crop preview
+OUTPUT_MODES = ('crop', 'pasted', 'concat')
+
+
 # Function to download a file from a URL and save it locally
 def downloading(url, outf):
     if not os.path.exists(outf):
@@ -79,22 +84,64 @@ class Config(PrintableConfig):
     flag_eye_retargeting: bool = False
     flag_lip_retargeting: bool = False
     flag_stitching: bool = True  # we recommend setting it to True!
+    flag_numpy_mlp: bool = True  # evaluate the stitching/retargeting MLPs with numpy instead of onnxruntime sessions
     flag_relative: bool = True  # whether to use relative motion
     flag_pasteback: bool = True  # whether to paste-back/stitch the animated face cropping from the face-cropping space to the original image space
+    flag_remap_paste_back: bool = True  # paste back with float remap tables built per source, as exact as warpAffine
     flag_do_crop: bool = True  # whether to crop the source portrait to the face-cropping space
     flag_do_rot: bool = True  # whether to conduct the rotation when flag_do_crop is True
     flag_write_result: bool = True  # whether to write output video
     flag_write_gif: bool = False
 
     anchor_frame: int = 0  # set this value if find_best_frame is True
+    stitching_batch_size: int = 256  # number of frames per stitching/retargeting MLP call in offline rendering
 
     input_shape: Tuple[int, int] = (256, 256)  # input shape
     output_format: Literal['mp4', 'gif'] = 'mp4'  # output video format
     output_fps: int = 30  # fps for output video
+    output_modes: Tuple[str, ...] = ('pasted', 'concat')  # videos to write, any of OUTPUT_MODES
     crf: int = 15  # crf for output video
+    encoder_preset: str = 'medium'  # x264 preset of the output encoder, faster presets trade size for speed
+    encoder_tune: Optional[str] = None  # x264 tune of the output encoder, e.g. 'zerolatency' or 'fastdecode'
+    flag_audio_passthrough: bool = True  # mux the audio of the driving video into the outputs
+    flag_ffmpeg_decoder: bool = True  # decode driving videos with an ffmpeg pipe that also scales the frames
+    decoder_threads: int = 0  # ffmpeg decoding threads, 0 lets ffmpeg decide
+    driving_start: float = 0.  # seconds of the driving video skipped before rendering
+    driving_end: Optional[float] = None  # end time of the driving video in seconds, None runs to the end
+    driving_stride: int = 1  # render every n-th driving frame
+    driving_fps: Optional[float] = None  # retime the driving video to this fps before inference, None keeps its fps
+    render_chunk_size: int = 0  # frames per resumable chunk of offline rendering, 0 renders the video in one pass
+    flag_keep_segments: bool = False  # keep the chunk segments and the manifest after they are joined
+    render_workers: int = 1  # processes one offline render is split over, every process loads its own models
+    segments_per_worker: int = 2  # segments per worker process, more segments balance the load better
+    ort_intra_op_threads: int = 0  # onnxruntime intra-op threads per session, 0 lets onnxruntime decide
+    async_chunk_size: int = 4  # driving frames per inference call of the asyncio API, also how soon it stops
+    async_queue_size: int = 16  # frames the asyncio API buffers ahead of its consumer before inference waits
+    async_threads: int = 4  # threads of the executor the asyncio API runs the blocking work on
+    async_close_timeout_s: float = 5.  # seconds the asyncio API waits for the driving decoder to close on a stop
+    ws_jpeg_quality: int = 85  # JPEG quality of the frames the websocket server sends back
+    jitter_min_delay_ms: float = 20.  # least playout delay of the motion streams received by the websocket server
+    jitter_max_delay_ms: float = 200.  # most playout delay, the latency a jittery network may add to a stream
+    shm_slots: int = 8  # frames of a shm://name output ring, how far its consumer may lag behind
+    shm_timeout_s: float = 10.  # seconds a shm://name ring waits for the process on the other side
+    realtime_output: Optional[str] = None  # shm://name: the real-time frames go to this ring instead of a window
+    flag_micro_batching: bool = False  # batch the motion/warp/generator calls of concurrent jobs, for servers
+    micro_batch_size: int = 8  # max frames per batched call
+    micro_batch_wait_ms: float = 2.  # max time a call waits for the calls of other jobs to join its batch
+    flag_scheduling: bool = False  # run the model calls through a priority scheduler, real-time frames first
+    scheduler_workers: int = 1  # model calls the scheduler runs at once
+    realtime_deadline_ms: float = 100.  # a real-time frame not animated this long after its capture is dropped
+    service_workers: int = 1  # jobs the rendering service runs at once, they share the sessions of one engine
+    service_dir: str = 'service_jobs'  # where the rendering service keeps the inputs and outputs of its jobs
+    service_templates_dir: str = 'experiment_examples/examples/driving'  # driving videos jobs can name as template
+    admission_max_latency_s: float = 0.  # jobs expected to be done later are downgraded or queued, 0 admits all
+    admission_max_queue: int = 16  # jobs queued over the latency budget, the service rejects the next ones
+    admission_memory_mb: float = 0.  # memory budget of the frames of the running jobs, 0 disables the check
+    admission_chunk_size: int = 256  # chunk size of the jobs rendered in chunks to fit in the memory budget
     mask_crop = None
     size_gif: int = 256
-    ref_max_shape: int = 1280
+    ref_max_shape: int = 1280  # max side of the source image, 0 keeps the native resolution (use paste_back_threads for 4K)
+    paste_back_threads: int = 4  # number of horizontal bands the paste back is split over on a thread pool
     ref_shape_n: int = 2
 
     device: str = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -105,4 +152,25 @@ class Config(PrintableConfig):
     dsize: int = 512  # crop size
     scale: float = 2.3  # scale factor
     vx_ratio: float = 0  # vx ratio
-    vy_ratio: float = -0.125  # vy ratio +up, -down
\ No newline at end of file
+    vy_ratio: float = -0.125  # vy ratio +up, -down
+
+
+def config_snapshot(cfg, **overrides) -> Config:
+    """ a Config instance of its own with the current values of cfg (the Config class or an instance),
+    later changes of cfg do not reach it. values set on an instance outside the fields (e.g. mask_crop) are kept
+    raise: TypeError on an override that is neither a field nor an attribute of cfg
+    """
+    cls = cfg if isinstance(cfg, type) else type(cfg)
+    names = {f.name for f in fields(cls) if f.init}
+    unknown = [name for name in overrides if name not in names and not hasattr(cfg, name)]
+    if unknown:
+        raise TypeError(f'unknown config option(s): {", ".join(unknown)}')
+    values = {name: getattr(cfg, name) for name in names}
+    values.update({name: value for name, value in overrides.items() if name in names})
+    snapshot = cls(**values)
+    extras = {} if isinstance(cfg, type) else dict(vars(cfg))
+    extras.update(overrides)
+    for name, value in extras.items():
+        if name not in names:
+            setattr(snapshot, name, value)
+    return snapshot
@@ -0,0 +1,54 @@
+import time
+from typing import List
+import cv2
+import onnxruntime as ort
+from LivePortrait.utils import Cropper
+from .config import Config, config_snapshot
+from .portrait import PortraitController
+from .motion_stream import MotionPacket
+
+
+class MotionExtractor(PortraitController):
+    """ the edge side of the motion-only transport: turns driving frames into MotionPackets
+    only the motion extractor is loaded (and the landmark models with eye/lip retargeting), the stitching, warp,
+    generator and paste back run on the render side, see InferenceEngine.animate_motion
+    """
+
+    def __init__(self, cfg=Config):
+        super().__init__(config_snapshot(cfg))
+        self.providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
+        options = ort.SessionOptions()
+        if self.cfg.ort_intra_op_threads > 0:
+            options.intra_op_num_threads = self.cfg.ort_intra_op_threads
+        m_session = ort.InferenceSession(self.cfg.checkpoint_M, sess_options=options, providers=self.providers)
+        self._model_sessions = {'m_session': m_session, 'm_input_name': m_session.get_inputs()[0].name}
+        self.retargeting = self.cfg.flag_eye_retargeting or self.cfg.flag_lip_retargeting
+        self.cropper = Cropper(crop_cfg=self.cfg) if self.retargeting else None
+        self.seq = 0
+        self._anchor = True
+
+    def reset(self):
+        """ the next frame becomes the anchor of the relative motion, e.g. when the performer moved away
+        """
+        self._anchor = True
+
+    def extract(self, driving_rgb_lst, timestamps=None) -> List[MotionPacket]:
+        """ packets of consecutive driving frames
+        driving_rgb_lst: HxWx3 RGB frames, any size
+        timestamps: capture time of every frame (time.perf_counter() seconds), now by default
+        """
+        now = time.perf_counter()
+        driving_rgb_lst_256 = [cv2.resize(frame, tuple(self.cfg.input_shape)) for frame in driving_rgb_lst]
+        i_d_lst, eye_ratio_lst, lip_ratio_lst = self.process_driving_frames(driving_rgb_lst, driving_rgb_lst_256,
+                                                                            self.cfg, self.cropper)
+        packets = []
+        for i in range(i_d_lst.shape[0]):
+            kp_info = self.get_kp_info(self._model_sessions, i_d_lst[i], None, None, None, None, run_local=True)
+            packets.append(MotionPacket.from_kp_info(
+                kp_info, 0, self.seq, timestamps[i] if timestamps is not None else now,
+                eye_ratio=eye_ratio_lst[i] if eye_ratio_lst is not None else None,
+                lip_ratio=lip_ratio_lst[i] if lip_ratio_lst is not None else None,
+                anchor=self._anchor))
+            self.seq += 1
+            self._anchor = False
+        return packets
@@ -0,0 +1,183 @@
+""" motion-only transport: the edge sends the driving motion of every frame instead of the frame
+
+packet (little endian), version 1:
+  MOTION_HEADER  magic b'LPMO', version u8, flags u8, n_kp u16, seq u32, timestamp f64 (edge capture time, seconds)
+  float32        pitch, yaw, roll (degrees), t (3), scale, exp (n_kp x 3)
+                 eye ratio (2) if flags & HAS_EYE, lip ratio (1) if flags & HAS_LIP
+flags ANCHOR marks the frame relative motion is measured from (the first one, or after a reset of the edge).
+21 keypoints with both ratios make 312 bytes. a decoder refuses a newer version, and ignores the bytes
+after the fields it knows, so later versions may append fields and keep the version for older readers
+"""
+import heapq
+import struct
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+import numpy as np
+import torch
+
+MOTION_MAGIC = b'LPMO'
+MOTION_STREAM_VERSION = 1
+MOTION_HEADER = struct.Struct('<4sBBHId')
+ANCHOR, HAS_EYE, HAS_LIP = 1, 2, 4
+
+
+@dataclass
+class MotionPacket:
+    """ the kinematics of one driving frame, what the render side needs of it without the motion extractor
+    """
+    seq: int
+    timestamp: float  # edge time the frame was captured, seconds
+    pose: np.ndarray  # 3, pitch, yaw, roll in degrees
+    t: np.ndarray  # 3
+    scale: float
+    exp: np.ndarray  # n_kp x 3
+    eye_ratio: Optional[np.ndarray] = None  # 2, eye close ratios of the driving frame
+    lip_ratio: Optional[np.ndarray] = None  # 1, lip close ratio of the driving frame
+    anchor: bool = False
+
+    @classmethod
+    def from_kp_info(cls, kp_info: Dict[str, Any], i, seq, timestamp, eye_ratio=None, lip_ratio=None, anchor=False):
+        """ packet of frame i of a batched get_kp_info() result
+        """
+        pose = np.array([float(kp_info[name][i].reshape(-1)[0]) for name in ('pitch', 'yaw', 'roll')], np.float32)
+        return cls(seq=seq, timestamp=timestamp, pose=pose,
+                   t=np.asarray(kp_info['t'][i], dtype=np.float32).reshape(3),
+                   scale=float(kp_info['scale'][i].reshape(-1)[0]),
+                   exp=np.asarray(kp_info['exp'][i], dtype=np.float32).reshape(-1, 3),
+                   eye_ratio=None if eye_ratio is None else np.asarray(eye_ratio, dtype=np.float32).reshape(2),
+                   lip_ratio=None if lip_ratio is None else np.asarray(lip_ratio, dtype=np.float32).reshape(1),
+                   anchor=anchor)
+
+    def kp_info(self) -> Dict[str, torch.Tensor]:
+        """ the packet as a batch of one get_kp_info() result: pitch/yaw/roll/scale 1x1, t 1x3, exp 1xNx3
+        """
+        return {
+            'pitch': torch.tensor(self.pose[0:1].reshape(1, 1)),
+            'yaw': torch.tensor(self.pose[1:2].reshape(1, 1)),
+            'roll': torch.tensor(self.pose[2:3].reshape(1, 1)),
+            't': torch.tensor(self.t.reshape(1, 3)),
+            'scale': torch.tensor([[self.scale]], dtype=torch.float32),
+            'exp': torch.tensor(self.exp.reshape(1, -1, 3)),
+        }
+
+    def encode(self) -> bytes:
+        flags = (ANCHOR if self.anchor else 0) | (HAS_EYE if self.eye_ratio is not None else 0) | \
+                (HAS_LIP if self.lip_ratio is not None else 0)
+        values = [self.pose, self.t, np.float32([self.scale]), self.exp.reshape(-1)]
+        if self.eye_ratio is not None:
+            values.append(self.eye_ratio)
+        if self.lip_ratio is not None:
+            values.append(self.lip_ratio)
+        header = MOTION_HEADER.pack(MOTION_MAGIC, MOTION_STREAM_VERSION, flags, self.exp.shape[0], self.seq,
+                                    self.timestamp)
+        return header + np.concatenate(values).astype('<f4').tobytes()
+
+    @classmethod
+    def decode(cls, data) -> 'MotionPacket':
+        """ raise: ValueError on a message that is not a motion packet or a version this decoder doesn't know
+        """
+        if len(data) < MOTION_HEADER.size:
+            raise ValueError('motion packet too short')
+        magic, version, flags, n_kp, seq, timestamp = MOTION_HEADER.unpack_from(data)
+        if magic != MOTION_MAGIC:
+            raise ValueError('not a motion packet')
+        if version > MOTION_STREAM_VERSION:
+            raise ValueError(f'motion stream version {version}, this side reads up to {MOTION_STREAM_VERSION}')
+        n_values = 7 + 3 * n_kp + (2 if flags & HAS_EYE else 0) + (1 if flags & HAS_LIP else 0)
+        if len(data) < MOTION_HEADER.size + 4 * n_values:
+            raise ValueError(f'motion packet truncated: {len(data)} bytes')
+        values = np.frombuffer(data, dtype='<f4', count=n_values, offset=MOTION_HEADER.size).astype(np.float32)
+        end = 7 + 3 * n_kp
+        eye_ratio = lip_ratio = None
+        if flags & HAS_EYE:
+            eye_ratio, end = values[end:end + 2], end + 2
+        if flags & HAS_LIP:
+            lip_ratio = values[end:end + 1]
+        return cls(seq=seq, timestamp=timestamp, pose=values[0:3], t=values[3:6], scale=float(values[6]),
+                   exp=values[7:7 + 3 * n_kp].reshape(n_kp, 3), eye_ratio=eye_ratio, lip_ratio=lip_ratio,
+                   anchor=bool(flags & ANCHOR))
+
+
+class JitterBuffer:
+    """ plays a motion stream out at the pace it was captured, absorbing the variation of the network delay
+    a packet is due at its edge timestamp + the clock offset (smallest transit seen over the last `window`
+    packets, which also absorbs the clock difference of the two sides) + a playout delay. the delay follows the
+    interarrival jitter (RFC 3550 estimate) times jitter_factor, within [min_delay_ms, max_delay_ms].
+    packets are reordered by seq, those arriving after a later one was played are dropped as late.
+    the items buffered are opaque (a MotionPacket or what the caller keeps with it).
+    not thread safe, it belongs to one connection
+    """
+
+    def __init__(self, min_delay_ms=20., max_delay_ms=200., jitter_factor=3., window=128):
+        self.min_delay = min_delay_ms / 1000.
+        self.max_delay = max_delay_ms / 1000.
+        self.jitter_factor = jitter_factor
+        self.jitter = 0.
+        self._transits = deque(maxlen=window)
+        self._last = None  # (arrival, timestamp) of the previous packet
+        self._heap = []
+        self._played_seq = -1
+        self.counts = {'received': 0, 'played': 0, 'late': 0, 'missing': 0}
+
+    @property
+    def delay(self) -> float:
+        return min(max(self.jitter_factor * self.jitter, self.min_delay), self.max_delay)
+
+    def reset(self):
+        """ forget the stream, for a new one (sequence numbers start over)
+        """
+        self.jitter = 0.
+        self._transits.clear()
+        self._last = None
+        self._heap.clear()
+        self._played_seq = -1
+
+    def push(self, seq, timestamp, item, arrival=None) -> bool:
+        """ add a received packet, False when it was dropped (late or duplicate)
+        seq, timestamp: sequence number and edge capture time of the packet (MotionPacket.seq/timestamp)
+        arrival: time.perf_counter() time of its reception
+        """
+        arrival = time.perf_counter() if arrival is None else arrival
+        self.counts['received'] += 1
+        if seq <= self._played_seq or any(entry[0] == seq for entry in self._heap):
+            self.counts['late'] += 1
+            return False
+        self._transits.append(arrival - timestamp)
+        if self._last is not None:
+            d = (arrival - self._last[0]) - (timestamp - self._last[1])
+            self.jitter += (abs(d) - self.jitter) / 16.
+        self._last = (arrival, timestamp)
+        heapq.heappush(self._heap, (seq, timestamp, item))
+        return True
+
+    def playout_time(self, timestamp) -> float:
+        """ local time.perf_counter() time a packet captured at edge time timestamp is due
+        """
+        return timestamp + min(self._transits) + self.delay
+
+    def wait_time(self, now=None) -> Optional[float]:
+        """ seconds until the next packet is due (<= 0 when one is), None when the buffer is empty
+        """
+        if not self._heap:
+            return None
+        now = time.perf_counter() if now is None else now
+        return self.playout_time(self._heap[0][1]) - now
+
+    def pop_due(self, now=None):
+        """ items of the packets due, in sequence order, the last one is the most recent motion
+        """
+        now = time.perf_counter() if now is None else now
+        due = []
+        while self._heap and self.playout_time(self._heap[0][1]) <= now:
+            seq, _, item = heapq.heappop(self._heap)
+            if self._played_seq >= 0:
+                self.counts['missing'] += max(seq - self._played_seq - 1, 0)
+            self._played_seq = seq
+            due.append(item)
+        self.counts['played'] += len(due)
+        return due
+
+    def stats(self) -> dict:
+        return dict(self.counts, buffered=len(self._heap), jitter_ms=self.jitter * 1000., delay_ms=self.delay * 1000.)
@@ -0,0 +1,117 @@
+import numpy as np
+import onnx
+from onnx import numpy_helper
+
+
+class UnsupportedGraph(ValueError):
+    """ the onnx graph is not a plain MLP chain NumpyMLP can evaluate, run it with onnxruntime instead
+    """
+
+
+class NumpyMLP:
+    """ numpy evaluation of the stitching/retargeting MLPs
+    the weights are read from the onnx initializers, the graph must be a chain of Gemm/MatMul/Add/Relu.
+    run() has the onnxruntime.InferenceSession signature, so it can stand in for the session,
+    run_with_source() reuses the first layer contribution of the source keypoints, computed once per source
+    """
+
+    def __init__(self, model_path):
+        model = onnx.load(model_path)
+        graph = model.graph
+        weights = {init.name: numpy_helper.to_array(init).astype(np.float32) for init in graph.initializer}
+        inputs = [i.name for i in graph.input if i.name not in weights]
+        if len(inputs) != 1:
+            raise UnsupportedGraph(f'expect a single input: {inputs}')
+        self.input_name = inputs[0]
+        self.output_name = graph.output[0].name
+        self.layers = self._parse_layers(graph, weights, self.input_name, self.output_name)
+        self._source_cache = None
+
+    @staticmethod
+    def _parse_layers(graph, weights, input_name, output_name):
+        """ return [[W (in x out), b (out), relu], ...]
+        """
+        layers = []
+        current = input_name
+        for node in graph.node:
+            if node.op_type == 'Constant':
+                weights[node.output[0]] = numpy_helper.to_array(node.attribute[0].t).astype(np.float32)
+                continue
+            data_inputs = [name for name in node.input if name not in weights]
+            if data_inputs != [current]:
+                raise UnsupportedGraph(f'{node.op_type} node {node.name} is not part of a plain MLP chain')
+            attrs = {attr.name: onnx.helper.get_attribute_value(attr) for attr in node.attribute}
+
+            if node.op_type == 'Gemm':
+                if attrs.get('transA', 0):
+                    raise UnsupportedGraph('Gemm with transA is not supported')
+                w = weights[node.input[1]]
+                w = w.T if attrs.get('transB', 0) else w
+                w = w * attrs.get('alpha', 1.0)
+                if len(node.input) > 2 and node.input[2]:
+                    b = weights[node.input[2]].reshape(-1) * attrs.get('beta', 1.0)
+                else:
+                    b = np.zeros(w.shape[1], dtype=np.float32)
+                layers.append([w, b, False])
+            elif node.op_type == 'MatMul':
+                w = weights[node.input[1]]
+                layers.append([w, np.zeros(w.shape[1], dtype=np.float32), False])
+            elif node.op_type == 'Add' and layers and not layers[-1][2]:
+                bias = weights[node.input[1] if node.input[0] == current else node.input[0]]
+                layers[-1][1] = layers[-1][1] + bias.reshape(-1)
+            elif node.op_type == 'Relu' and layers:
+                layers[-1][2] = True
+            else:
+                raise UnsupportedGraph(f'unsupported op in MLP: {node.op_type}')
+            current = node.output[0]
+
+        if current != output_name or not layers:
+            raise UnsupportedGraph('graph output is not produced by the MLP chain')
+        return [[np.ascontiguousarray(w, dtype=np.float32), b.astype(np.float32), relu] for w, b, relu in layers]
+
+    def _forward_from_first(self, h):
+        """ h: pre-activation of the first layer
+        """
+        if self.layers[0][2]:
+            h = np.maximum(h, 0)
+        for w, b, relu in self.layers[1:]:
+            h = h @ w + b
+            if relu:
+                h = np.maximum(h, 0)
+        return h
+
+    def forward(self, x: np.ndarray) -> np.ndarray:
+        w, b, _ = self.layers[0]
+        return self._forward_from_first(np.asarray(x, dtype=np.float32) @ w + b)
+
+    def source_bias(self, kp_source) -> np.ndarray:
+        """ first layer contribution of the source keypoints (plus the bias), cached for the last source
+        kp_source: 1xNx3
+        return: 1xH
+        """
+        kp_source = np.asarray(kp_source, dtype=np.float32).reshape(1, -1)
+        cache = self._source_cache
+        if cache is not None and np.array_equal(cache[0], kp_source):
+            return cache[1]
+        w, b, _ = self.layers[0]
+        bias = kp_source @ w[:kp_source.shape[1]] + b
+        self._source_cache = (kp_source.copy(), bias)
+        return bias
+
+    def run_with_source(self, kp_source, driving: np.ndarray) -> np.ndarray:
+        """ same as forward(concat([kp_source, driving])), without redoing the source part
+        kp_source: 1xNx3
+        driving: BxC, driving keypoints or combined ratios
+        return: BxO
+        """
+        kp_source = np.asarray(kp_source, dtype=np.float32).reshape(1, -1)
+        n_src = kp_source.shape[1]
+        bias = self.source_bias(kp_source)
+        w = self.layers[0][0]
+        driving = np.asarray(driving, dtype=np.float32).reshape(-1, w.shape[0] - n_src)
+        return self._forward_from_first(driving @ w[n_src:] + bias)
+
+    def run(self, output_names, input_feed, run_options=None):
+        """ onnxruntime.InferenceSession.run compatible
+        """
+        return [self.forward(input_feed[self.input_name])]
@@ -1,8 +1,13 @@
 from LivePortrait.utils.io import load_driving_info
+from LivePortrait.utils.video import load_video_frames, probe_video, FrameSelector, FFmpegVideoReader
+from LivePortrait.utils.shm_frames import SharedFrameReader, is_shared_frames
 from .portrait_output import ParsingPaste
+from .batching import BatchedSession
+import os.path as osp
 import cv2
 import torch
 import numpy as np
+import onnxruntime as ort
 
 
 class PortraitController(ParsingPaste):
@@ -50,21 +55,126 @@ class PortraitController(ParsingPaste):
         y = np.array(y).astype('float32')
         return y
 
-    def process_source_motion(self, img_rgb, source_motion, crop_info, cfg, cropper):
-        template_lst = None
+    @staticmethod
+    def get_frame_selector(source_motion, cfg, src_fps=None):
+        """ FrameSelector of the driving_start/end/stride/fps options
+        src_fps: frame rate of the driving, probed for video files, cfg.output_fps for image directories
+        """
+        if src_fps is None:
+            src_fps = probe_video(source_motion)['fps'] if osp.isfile(source_motion) else cfg.output_fps
+        return FrameSelector(src_fps, start=cfg.driving_start, end=cfg.driving_end, stride=cfg.driving_stride,
+                             fps=cfg.driving_fps)
+
+    @staticmethod
+    def load_driving_frames(source_motion, cfg, with_display=True, selector=None):
+        """ network-input frames and the frames kept for retargeting/display of a driving video
+        video files are decoded and scaled by ffmpeg, only retargeting needs the native resolution,
+        the concat preview is resized to the crop size anyway
+        selector: FrameSelector, only the selected frames are decoded
+        shm://name reads the frames of a shared-memory ring until its producer closes it
+        """
+        if is_shared_frames(source_motion):
+            sizes = PortraitController.driving_sizes(cfg, with_display)
+            frame_lsts = [[] for _ in sizes]
+            for frames in SharedFrameReader(source_motion, sizes=sizes, selector=selector, timeout=cfg.shm_timeout_s):
+                for frame_lst, frame in zip(frame_lsts, frames if isinstance(frames, tuple) else (frames,)):
+                    frame_lst.append(frame)
+            driving_rgb_lst_256 = frame_lsts[0]
+            driving_rgb_lst = frame_lsts[1] if len(frame_lsts) > 1 else None
+        elif cfg.flag_ffmpeg_decoder and osp.isfile(source_motion):
+            sizes = PortraitController.driving_sizes(cfg, with_display)
+            frame_lsts = load_video_frames(source_motion, sizes=sizes, threads=cfg.decoder_threads, selector=selector)
+            driving_rgb_lst_256 = frame_lsts[0]
+            driving_rgb_lst = frame_lsts[1] if len(frame_lsts) > 1 else None
+        else:
+            driving_rgb_lst = load_driving_info(source_motion)
+            if selector is not None and not selector.is_identity:
+                indices = selector.selected_indices(len(driving_rgb_lst))
+                driving_rgb_lst = [driving_rgb_lst[i] for i in indices]
+            driving_rgb_lst_256 = [cv2.resize(_, tuple(cfg.input_shape)) for _ in driving_rgb_lst]
+        return driving_rgb_lst, driving_rgb_lst_256
+
+    @staticmethod
+    def driving_sizes(cfg, with_display):
+        """ decoder outputs: the network input, plus the native frames for retargeting or the crop-size display
+        """
+        sizes = [tuple(cfg.input_shape)]
+        if cfg.flag_eye_retargeting or cfg.flag_lip_retargeting:
+            sizes.append(None)
+        elif with_display:
+            sizes.append((cfg.dsize, cfg.dsize))
+        return sizes
+
+    @staticmethod
+    def iter_driving_chunks(source_motion, cfg, chunk_size, with_display=True, selector=None, start_frame=0):
+        """ same frames as load_driving_frames, yielded chunk_size at a time without decoding the whole video first
+        start_frame: chunks start at this (selected) frame. ffmpeg seeks to it, the frames before it are only
+        decoded and dropped without the ffmpeg decoder. a shm:// ring is a live stream, it always starts at 0
+        yield: (driving_rgb_lst or None, driving_rgb_lst_256) per chunk
+        """
+        if is_shared_frames(source_motion) or cfg.flag_ffmpeg_decoder and osp.isfile(source_motion):
+            sizes = PortraitController.driving_sizes(cfg, with_display)
+            if is_shared_frames(source_motion):
+                if start_frame > 0:
+                    raise ValueError(f'{source_motion} is a live stream, it can not start at frame {start_frame}')
+                reader = SharedFrameReader(source_motion, sizes=sizes, selector=selector, timeout=cfg.shm_timeout_s)
+            else:
+                offset = 0
+                if start_frame > 0:
+                    # resume: decode from the source frame of start_frame on instead of the start of the video
+                    selector = selector if selector is not None else FrameSelector(probe_video(source_motion)['fps'])
+                    offset = selector.offset_of(start_frame)
+                    if selector.end_frame is not None and selector.first_frame + offset >= selector.end_frame:
+                        return
+                reader = FFmpegVideoReader(source_motion, sizes=sizes, threads=cfg.decoder_threads,
+                                           selector=selector, offset=offset)
+            chunk = []
+            for frames in reader:
+                chunk.append(frames if isinstance(frames, tuple) else (frames,))
+                if len(chunk) == chunk_size:
+                    yield PortraitController.split_chunk(chunk)
+                    chunk = []
+            if chunk:
+                yield PortraitController.split_chunk(chunk)
+        else:
+            driving_rgb_lst, driving_rgb_lst_256 = PortraitController.load_driving_frames(
+                source_motion, cfg, with_display=with_display, selector=selector)
+            for start in range(start_frame, len(driving_rgb_lst_256), chunk_size):
+                yield driving_rgb_lst[start:start + chunk_size], driving_rgb_lst_256[start:start + chunk_size]
+
+    @staticmethod
+    def split_chunk(chunk):
+        driving_rgb_lst_256 = [frames[0] for frames in chunk]
+        driving_rgb_lst = [frames[1] for frames in chunk] if len(chunk[0]) > 1 else None
+        return driving_rgb_lst, driving_rgb_lst_256
+
+    def process_driving_frames(self, driving_rgb_lst, driving_rgb_lst_256, cfg, cropper):
+        """ network input and retargeting ratios of driving frames
+        return: i_d_lst, eye ratios and lip ratios (None without retargeting)
+        """
         input_eye_ratio_lst = None
         input_lip_ratio_lst = None
-        driving_rgb_lst = load_driving_info(source_motion)
-        driving_rgb_lst_256 = [cv2.resize(_, (256, 256)) for _ in driving_rgb_lst]
         i_d_lst = self.prepare_driving_videos(driving_rgb_lst_256, single_image=False)
-        n_frames = i_d_lst.shape[0]
         if cfg.flag_eye_retargeting or cfg.flag_lip_retargeting:
             driving_lmk_lst = cropper.get_retargeting_lmk_info(driving_rgb_lst)
             input_eye_ratio_lst, input_lip_ratio_lst = self.calc_retargeting_ratio(driving_lmk_lst)
-        mask_ori = self.prepare_paste_back(cfg.mask_crop, crop_info['M_c2o'],
-                                           dsize=(img_rgb.shape[1], img_rgb.shape[0]))
+        return i_d_lst, input_eye_ratio_lst, input_lip_ratio_lst
+
+    def process_source_motion(self, img_rgb, source_motion, crop_info, cfg, cropper, with_paste_back=True,
+                              with_display=True, selector=None):
+        template_lst = None
+        driving_rgb_lst, driving_rgb_lst_256 = self.load_driving_frames(source_motion, cfg, with_display=with_display,
+                                                                         selector=selector)
+        i_d_lst, input_eye_ratio_lst, input_lip_ratio_lst = self.process_driving_frames(
+            driving_rgb_lst, driving_rgb_lst_256, cfg, cropper)
+        n_frames = i_d_lst.shape[0]
+        compositor = None
+        if with_paste_back:
+            compositor = self.prepare_compositor(cfg.mask_crop, crop_info['M_c2o'], img_rgb,
+                                                 use_remap=cfg.flag_remap_paste_back,
+                                                 num_threads=cfg.paste_back_threads)
         i_p_paste_lst = []
-        return mask_ori, driving_rgb_lst, i_d_lst, i_p_paste_lst, template_lst, n_frames, input_eye_ratio_lst, input_lip_ratio_lst
+        return compositor, driving_rgb_lst, i_d_lst, i_p_paste_lst, template_lst, n_frames, input_eye_ratio_lst, input_lip_ratio_lst
 
     def algorithm(self, x_s, x_d_i_info, r_s, x_s_info, lip_delta_before_animation, cfg):
         r_d_i = self.get_rotation_matrix(x_d_i_info['pitch'], x_d_i_info['yaw'], x_d_i_info['roll'])
@@ -127,11 +237,33 @@ class PortraitController(ParsingPaste):
         feature_3d = torch.tensor(outputs[0]).float()
         return feature_3d
 
+    @staticmethod
+    def prepare_feature_3d(session, feature_3d):
+        """ convert the source feature (1x32x16x64x64, ~8MB) once for all the warp calls of a source
+        on CUDA it is uploaded once as an OrtValue, otherwise it is kept as a contiguous float32 array. a micro-batched
+        warp session gets the array too: batches are concatenated on the host, an OrtValue would bypass them
+        """
+        feature_3d = np.ascontiguousarray(feature_3d, dtype=np.float32)
+        w_session = session['w_session']
+        if isinstance(w_session, BatchedSession) and w_session.batchable:
+            return feature_3d
+        if 'CUDAExecutionProvider' in w_session.get_providers():
+            return ort.OrtValue.ortvalue_from_numpy(feature_3d, 'cuda', 0)
+        return feature_3d
+
+    @staticmethod
+    def as_ort_input(x):
+        """ OrtValues, float32 arrays and cpu tensors are passed to the session without a copy
+        """
+        if isinstance(x, ort.OrtValue):
+            return x
+        return np.ascontiguousarray(x, dtype=np.float32)
+
     def warp_decode(self, session, feature_3d, kp_source, kp_driving):
         ort_inputs = {
-            session['w_input_names'][0]: np.array(feature_3d),
-            session['w_input_names'][1]: np.array(kp_driving),
-            session['w_input_names'][2]: np.array(kp_source)
+            session['w_input_names'][0]: self.as_ort_input(feature_3d),
+            session['w_input_names'][1]: self.as_ort_input(kp_driving),
+            session['w_input_names'][2]: self.as_ort_input(kp_source)
         }
 
         outputs = session['w_session'].run(session['w_output_names'], ort_inputs)
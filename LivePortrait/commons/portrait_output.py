@@ -4,6 +4,7 @@ import os.path as osp
 import os
 from rich.progress import track
 from .commons import Transform3DFunction
+from .compositor import PasteBackCompositor
 cv2.setNumThreads(0)
 cv2.ocl.setUseOpenCL(False)  # NOTE: enforce single thread
 
@@ -12,6 +13,8 @@ CV2_INTERP = cv2.INTER_LINEAR
 
 
 class ParsingPaste(Transform3DFunction):
+    _mask_template = None
+
     def __init__(self):
         super().__init__()
 
@@ -26,15 +29,31 @@ class ParsingPaste(Transform3DFunction):
 
         return out
 
+    @classmethod
+    def load_mask_template(cls):
+        """the default paste-back mask, read from disk once per process
+        """
+        if cls._mask_template is None:
+            cls._mask_template = cv2.imread(cls.make_abs_path('./resources/mask_template.png'), cv2.IMREAD_COLOR)
+        return cls._mask_template
+
     def prepare_paste_back(self, mask_crop, crop_m_c2o, dsize):
         """prepare mask for later image paste back
         """
         if mask_crop is None:
-            mask_crop = cv2.imread(self.make_abs_path('./resources/mask_template.png'), cv2.IMREAD_COLOR)
+            mask_crop = self.load_mask_template()
         mask_ori = self._transform_img(mask_crop, crop_m_c2o, dsize)
         mask_ori = mask_ori.astype(np.float32) / 255.
         return mask_ori
 
+    def prepare_compositor(self, mask_crop, crop_m_c2o, rgb_ori, use_remap=False, num_threads=1):
+        """prepare the ROI-restricted fixed-point paste back, once per source
+        """
+        if mask_crop is None:
+            mask_crop = self.load_mask_template()
+        return PasteBackCompositor(mask_crop, crop_m_c2o, rgb_ori, use_remap=use_remap,
+                                   num_threads=num_threads)
+
     def paste_back(self, image_to_processed, crop_m_c2o, rgb_ori, mask_ori):
         """paste back the image
         """
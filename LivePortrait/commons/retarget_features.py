@@ -0,0 +1,66 @@
+import numpy as np
+from LivePortrait.utils.retargeting_utils import calc_eye_close_ratio, calc_lip_close_ratio
+
+
+class RetargetFeatures:
+    """ eye/lip close ratios for the retargeting MLPs
+    the source ratios are computed once per source, the driving ratios of all frames in one pass
+    """
+
+    def __init__(self, source_lmk: np.ndarray):
+        """
+        source_lmk: Nx2 (203 points) landmarks of the source crop
+        """
+        lmk = np.asarray(source_lmk, dtype=np.float32)[None]  # 1xNx2
+        self.source_eye_ratio = calc_eye_close_ratio(lmk).astype(np.float32)  # 1x2, c_s,eyes
+        self.source_lip_ratio = calc_lip_close_ratio(lmk).astype(np.float32)  # 1x1, c_s,lip
+
+    @staticmethod
+    def driving_ratios(driving_lmk):
+        """
+        driving_lmk: TxNx2 array or list of Nx2 landmarks
+        return: eye ratio Tx2, lip ratio Tx1
+        """
+        lmk = np.asarray(driving_lmk, dtype=np.float32)
+        if lmk.ndim == 2:
+            lmk = lmk[None]
+        return calc_eye_close_ratio(lmk), calc_lip_close_ratio(lmk)
+
+    def combined_eye_ratio(self, driving_eye_ratio: np.ndarray) -> np.ndarray:
+        """ [c_s,eyes, c_d,eyes,i] for every frame
+        driving_eye_ratio: Tx2 (only the first eye is fed to the MLP)
+        return: Tx3, float32
+        """
+        driving_eye_ratio = np.asarray(driving_eye_ratio, dtype=np.float32).reshape(-1, 2)
+        n = driving_eye_ratio.shape[0]
+        return np.concatenate([np.repeat(self.source_eye_ratio, n, axis=0), driving_eye_ratio[:, :1]], axis=1)
+
+    def combined_lip_ratio(self, driving_lip_ratio: np.ndarray) -> np.ndarray:
+        """ [c_s,lip, c_d,lip,i] for every frame
+        driving_lip_ratio: Tx1, or a scalar per frame
+        return: Tx2, float32
+        """
+        driving_lip_ratio = np.asarray(driving_lip_ratio, dtype=np.float32).reshape(-1, 1)
+        n = driving_lip_ratio.shape[0]
+        return np.concatenate([np.repeat(self.source_lip_ratio, n, axis=0), driving_lip_ratio], axis=1)
+
+    @staticmethod
+    def mlp_input(kp_source, combined_ratio: np.ndarray) -> np.ndarray:
+        """ batched input of the eye/lip retargeting MLP
+        kp_source: 1xNx3
+        combined_ratio: TxC
+        return: Tx(3N+C), float32
+        """
+        kp_source = np.asarray(kp_source, dtype=np.float32).reshape(1, -1)
+        n = combined_ratio.shape[0]
+        return np.concatenate([np.repeat(kp_source, n, axis=0), combined_ratio.astype(np.float32)], axis=1)
+
+    def __call__(self, driving_lmk):
+        """ all the driving-side retargeting inputs of a video
+        return: dict with the Tx3 combined eye ratio and the Tx2 combined lip ratio
+        """
+        eye_ratio, lip_ratio = self.driving_ratios(driving_lmk)
+        return {
+            'eye_ratio': self.combined_eye_ratio(eye_ratio),
+            'lip_ratio': self.combined_lip_ratio(lip_ratio),
+        }
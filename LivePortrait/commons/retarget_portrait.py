@@ -1,5 +1,6 @@
 import torch
 import numpy as np
+from LivePortrait.commons.numpy_mlp import NumpyMLP
 
 
 class RetargetStitchPortrait:
@@ -10,17 +11,24 @@ class RetargetStitchPortrait:
     def concat_feat(stitch_session, kp_source, kp_driving, lip_ratio, eye_ratio,
                     lip=False, eye=False) -> torch.Tensor:
         """
-        kp_source: (bs, k, 3)
+        kp_source: (bs, k, 3), or (1, k, 3) shared by a batch of driving frames/ratios
         kp_driving: (bs, k, 3)
         Return: (bs, 2k*3)
         """
         alert = 'batch size must be equal'
+        driving = kp_driving if kp_driving is not None else (lip_ratio if lip else eye_ratio)
+        if isinstance(stitch_session, NumpyMLP) and kp_source.shape[0] == 1:
+            # the source part of the first layer is cached, only the driving part is evaluated
+            return stitch_session.run_with_source(np.asarray(kp_source), np.asarray(driving).reshape(driving.shape[0], -1))
+        if kp_source.shape[0] == 1 and driving.shape[0] > 1:
+            # one source for a chunk of frames, the MLPs run once on the whole batch
+            kp_source = kp_source.expand(driving.shape[0], *kp_source.shape[1:])
         if lip == False and eye == False:
             bs_src = kp_source.shape[0]
             bs_dri = kp_driving.shape[0]
             assert bs_src == bs_dri, alert
 
-            feat = torch.cat([kp_source.view(bs_src, -1), kp_driving.view(bs_dri, -1)], dim=1)
+            feat = torch.cat([kp_source.reshape(bs_src, -1), kp_driving.view(bs_dri, -1)], dim=1)
             delta = stitch_session.run(None, {'input': np.array(feat)})
             return delta[0]
         elif lip == True and eye == False:
@@ -28,7 +36,7 @@ class RetargetStitchPortrait:
             bs_dri = lip_ratio.shape[0]
             assert bs_src == bs_dri, alert
 
-            feat = torch.cat([kp_source.view(bs_src, -1), lip_ratio.view(bs_dri, -1)], dim=1)
+            feat = torch.cat([kp_source.reshape(bs_src, -1), lip_ratio.view(bs_dri, -1)], dim=1)
             delta_lip = stitch_session.run(None, {'input': np.array(feat)})
             return delta_lip[0]
         elif lip == False and eye == True:
@@ -36,7 +44,7 @@ class RetargetStitchPortrait:
             bs_dri = eye_ratio.shape[0]
             assert bs_src == bs_dri, alert
 
-            feat = torch.cat([kp_source.view(bs_src, -1), eye_ratio.view(bs_dri, -1)], dim=1)
+            feat = torch.cat([kp_source.reshape(bs_src, -1), eye_ratio.view(bs_dri, -1)], dim=1)
             delta_eye = stitch_session.run(None, {'input': np.array(feat)})
             return delta_eye[0]
 
@@ -76,7 +84,7 @@ class RetargetStitchPortrait:
         kp_driving: Bxnum_kpx3
         """
 
-        bs, num_kp = kp_source.shape[:2]
+        bs, num_kp = kp_driving.shape[:2]
 
         kp_driving_new = kp_driving.clone()
         delta = self.stitch(session, kp_source, kp_driving_new)
@@ -0,0 +1,119 @@
+import math
+import time
+import heapq
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+# priority classes, lower runs first
+REALTIME = 0
+BATCH = 1
+PRIORITY_NAMES = {REALTIME: 'realtime', BATCH: 'batch'}
+
+# (priority, deadline) of the model calls of the current thread / task
+_work = contextvars.ContextVar('live_portrait_work', default=(BATCH, None))
+
+
+class DeadlineMissed(Exception):
+    """ a work item was dropped, its deadline had passed when a worker reached it """
+
+
+@contextmanager
+def work_priority(priority, deadline=None):
+    """ model calls made in this block are scheduled with this priority class and deadline
+    deadline: time.perf_counter() time the result is useless after, None for no deadline
+    """
+    token = _work.set((priority, deadline))
+    try:
+        yield
+    finally:
+        _work.reset(token)
+
+
+def current_work():
+    """ (priority, deadline) of the calling context, (BATCH, None) outside work_priority()
+    """
+    return _work.get()
+
+
+class DeadlineScheduler:
+    """ runs work items on n_workers threads, by priority class, then earliest deadline first, then in order
+    real-time items carry a deadline and are dropped (their future raises DeadlineMissed) when a worker reaches
+    them after it, batch items have none and only run when no real-time item waits, so batch work fills the
+    idle capacity. a running item is not preempted, items are single model calls, so a real-time frame waits
+    for at most one call of a batch job per worker
+    """
+
+    def __init__(self, n_workers=1):
+        self._heap = []
+        self._cv = threading.Condition()
+        self._seq = itertools.count()
+        self._counts = {}  # {(priority, 'run' or 'dropped'): n}
+        self._workers = [threading.Thread(target=self._loop, name=f'scheduler_{i}', daemon=True)
+                         for i in range(max(n_workers, 1))]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, fn, *args, priority=BATCH, deadline=None, **kwargs) -> Future:
+        future = Future()
+        with self._cv:
+            heapq.heappush(self._heap, (priority, math.inf if deadline is None else deadline, next(self._seq),
+                                        future, fn, args, kwargs))
+            self._cv.notify()
+        return future
+
+    def _loop(self):
+        while True:
+            with self._cv:
+                while not self._heap:
+                    self._cv.wait()
+                priority, deadline, _, future, fn, args, kwargs = heapq.heappop(self._heap)
+            if not future.set_running_or_notify_cancel():
+                continue
+            if deadline < time.perf_counter():
+                self._count(priority, 'dropped')
+                future.set_exception(DeadlineMissed(f'{(time.perf_counter() - deadline) * 1000.:.1f} ms late'))
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            self._count(priority, 'run')
+
+    def _count(self, priority, what):
+        with self._cv:
+            self._counts[priority, what] = self._counts.get((priority, what), 0) + 1
+
+    def stats(self) -> dict:
+        """ {priority class: {'run', 'dropped', 'waiting'}}
+        """
+        with self._cv:
+            waiting = {}
+            for item in self._heap:
+                waiting[item[0]] = waiting.get(item[0], 0) + 1
+            priorities = {priority for priority, _ in self._counts} | set(waiting)
+            return {PRIORITY_NAMES.get(priority, str(priority)): {
+                'run': self._counts.get((priority, 'run'), 0),
+                'dropped': self._counts.get((priority, 'dropped'), 0),
+                'waiting': waiting.get(priority, 0),
+            } for priority in sorted(priorities)}
+
+
+class ScheduledSession:
+    """ an onnxruntime session whose run() calls go through a DeadlineScheduler, with the priority and deadline
+    of the calling context (see work_priority), the caller waits for the result
+    """
+
+    def __init__(self, session, scheduler: DeadlineScheduler):
+        self.session = session
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def run(self, output_names, input_feed, run_options=None):
+        priority, deadline = current_work()
+        return self.scheduler.submit(self.session.run, output_names, input_feed, run_options, priority=priority,
+                                     deadline=deadline).result()
@@ -0,0 +1,64 @@
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+import numpy as np
+import onnxruntime as ort
+
+
+@dataclass
+class SourceState:
+    """ everything prepared from one source image, owned by a job and never shared through the engine
+    lip_delta_before_animation is None when the lip-zero correction does not apply to this source
+    """
+    source_lmk: np.ndarray  # Nx2, 203 landmarks of the source crop
+    x_c_s: Any  # 1xNx3 canonical keypoints
+    x_s: Any  # 1xNx3 transformed keypoints
+    f_s: Any  # prepared 3d appearance feature, see PortraitController.prepare_feature_3d
+    r_s: Any  # 1x3x3 rotation
+    x_s_info: Dict[str, Any]
+    lip_delta_before_animation: Any
+    crop_info: Dict[str, Any]
+    img_rgb: np.ndarray  # HxWx3 source image (after resize_to_limit)
+    img_crop_256x256: np.ndarray
+
+    # keys of to_dict()/from_dict(), what is persisted for chunked and segment-parallel rendering
+    PERSISTED = ('source_lmk', 'x_c_s', 'x_s', 'r_s', 'x_s_info', 'lip_delta_before_animation', 'img_rgb',
+                 'img_crop_256x256')
+
+    def to_dict(self, with_feature=True) -> dict:
+        """ the state as arrays, f_s as a host array
+        with_feature: include f_s (~8MB), which can also be recomputed from the source image
+        """
+        state = {name: getattr(self, name) for name in self.PERSISTED}
+        state['M_c2o'] = self.crop_info['M_c2o']
+        if with_feature:
+            state['f_s'] = self.f_s.numpy() if isinstance(self.f_s, ort.OrtValue) else self.f_s
+        return state
+
+    @classmethod
+    def from_dict(cls, state: dict, f_s=None, crop_info=None) -> 'SourceState':
+        """
+        f_s: prepared feature, defaults to the host array of the state (prepare it for the device before use)
+        crop_info: recomputed crop info, its M_c2o is replaced by the stored one
+        """
+        crop_info = dict(crop_info or {'lmk_crop': state['source_lmk']}, M_c2o=state['M_c2o'])
+        kwargs = {name: state.get(name) for name in cls.PERSISTED}
+        return cls(f_s=state.get('f_s') if f_s is None else f_s, crop_info=crop_info, **kwargs)
+
+
+@dataclass
+class DrivingState:
+    """ per-job progress through a driving video
+    anchor: (r_d_0, x_d_0_info) of the first driving frame, relative motion is measured against it
+    """
+    anchor: Optional[Tuple[Any, Dict[str, Any]]] = None
+    n_frames: int = 0  # frames animated so far
+
+    def to_dict(self) -> dict:
+        if self.anchor is None:
+            return {}
+        return {'r_d_0': self.anchor[0], 'x_d_0_info': self.anchor[1]}
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'DrivingState':
+        anchor = (state['r_d_0'], state['x_d_0_info']) if 'r_d_0' in state else None
+        return cls(anchor=anchor)
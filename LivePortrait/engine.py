@@ -0,0 +1,352 @@
+import copy
+import time
+import onnxruntime as ort
+import numpy as np
+import torch
+from tqdm import tqdm
+from LivePortrait.utils import load_image_rgb, resize_to_limit, Cropper
+from LivePortrait.utils.timer import LatencyStats
+from LivePortrait.commons import PortraitController, Config
+from LivePortrait.commons.config import config_snapshot
+from LivePortrait.commons.states import SourceState, DrivingState
+from LivePortrait.commons.retarget_features import RetargetFeatures
+from LivePortrait.commons.numpy_mlp import NumpyMLP, UnsupportedGraph
+from LivePortrait.commons.batching import BatchedSession
+from LivePortrait.commons.scheduling import DeadlineScheduler, ScheduledSession
+
+
+class InferenceEngine(PortraitController):
+    """ the models of the pipeline and the computations on them, shared by every job of the process
+    after construction the engine is only read: the sessions, the cropper and a private copy of the options.
+    everything that belongs to a job (SourceState, DrivingState, compositor, writers) is created and owned by
+    the job, so jobs can run concurrently on a thread pool against one set of sessions.
+    with_options() gives a view of the engine with other options over the same sessions.
+    stage_latency holds the per-frame time of every stage (driving, retargeting, motion, stitching, warp,
+    paste_back) and the time of source, shared by the views, admission control estimates job costs from it
+    """
+
+    def __init__(self, cfg=Config):
+        super().__init__(config_snapshot(cfg))
+        self.providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
+        self.cropper = Cropper(crop_cfg=self.cfg)
+        self.scheduler = None
+        self.stage_latency = LatencyStats()
+        self._model_sessions = None
+        self.model_sessions()
+
+    def with_options(self, **options) -> 'InferenceEngine':
+        """ the engine with some options replaced (e.g. per-job output or driving options), sharing the sessions
+        and the cropper, so it adds no model memory. options changing the models need a new engine
+        raise: TypeError on an unknown option
+        """
+        engine = copy.copy(self)
+        engine.cfg = config_snapshot(self.cfg, **options)
+        return engine
+
+    def model_sessions(self):
+        if self._model_sessions is None:
+            self._model_sessions = self._initialize_sessions()
+        return self._model_sessions
+
+    def _initialize_sessions(self):
+        options = self.session_options()
+        m_session = ort.InferenceSession(self.cfg.checkpoint_M, sess_options=options, providers=self.providers)
+        f_session = ort.InferenceSession(self.cfg.checkpoint_F, sess_options=options, providers=self.providers)
+        w_session = ort.InferenceSession(self.cfg.checkpoint_W, sess_options=options, providers=self.providers)
+        g_session = ort.InferenceSession(self.cfg.checkpoint_G, sess_options=options, providers=self.providers)
+
+        if self.cfg.flag_scheduling:
+            # real-time and batch jobs share these sessions, real-time frames go first and stale ones are dropped
+            self.scheduler = DeadlineScheduler(self.cfg.scheduler_workers)
+            m_session, w_session, g_session = [ScheduledSession(session, self.scheduler)
+                                               for session in (m_session, w_session, g_session)]
+        if self.cfg.flag_micro_batching:
+            # concurrent jobs share these sessions, their per-frame calls are gathered into batches
+            m_session, w_session, g_session = [
+                BatchedSession(session, max_batch_size=self.cfg.micro_batch_size,
+                               max_wait_ms=self.cfg.micro_batch_wait_ms)
+                for session in (m_session, w_session, g_session)]
+
+        s_session = self._initialize_mlp_session(self.cfg.checkpoint_S)
+        s_l_session = self._initialize_mlp_session(self.cfg.checkpoint_SL)
+        s_e_session = self._initialize_mlp_session(self.cfg.checkpoint_SE)
+
+        m_input_name = m_session.get_inputs()[0].name
+        m_output_name = m_session.get_outputs()[0].name
+
+        g_input_name = g_session.get_inputs()[0].name
+        g_output_name = g_session.get_outputs()[0].name
+
+        f_input_name = f_session.get_inputs()[0].name
+        f_output_name = f_session.get_outputs()[0].name
+
+        w_input_names = [input.name for input in w_session.get_inputs()]
+        w_output_names = [output.name for output in w_session.get_outputs()]
+
+        return {
+            'm_session': m_session, 'm_input_name': m_input_name, 'm_output_name': m_output_name,
+            'g_session': g_session, 'g_input_name': g_input_name, 'g_output_name': g_output_name,
+            'f_session': f_session, 'f_input_name': f_input_name, 'f_output_name': f_output_name,
+            'w_session': w_session, 'w_input_names': w_input_names, 'w_output_names': w_output_names,
+            's_session': s_session, 's_l_session': s_l_session, 's_e_session': s_e_session
+        }
+
+    def _initialize_mlp_session(self, checkpoint):
+        """stitching/retargeting MLPs run in numpy when possible, session overhead dominates their compute"""
+        if self.cfg.flag_numpy_mlp:
+            try:
+                return NumpyMLP(checkpoint)
+            except UnsupportedGraph:
+                pass
+        return ort.InferenceSession(checkpoint, sess_options=self.session_options(), providers=self.providers)
+
+    def batching_stats(self) -> dict:
+        """ {session: BatchedSession.stats()} of the micro-batched sessions, empty without micro-batching
+        """
+        return {name: session.stats() for name, session in self._model_sessions.items()
+                if isinstance(session, BatchedSession)}
+
+    def scheduler_stats(self) -> dict:
+        """ DeadlineScheduler.stats(), empty without scheduling
+        """
+        return self.scheduler.stats() if self.scheduler is not None else {}
+
+    def session_options(self):
+        options = ort.SessionOptions()
+        if self.cfg.ort_intra_op_threads > 0:
+            # several render processes share the cores, each one has to stay within its share
+            options.intra_op_num_threads = self.cfg.ort_intra_op_threads
+        return options
+
+    def prepare_source(self, source_image_path) -> SourceState:
+        """ everything the animation needs from the source image
+        the lip-zero decision is stored in the state (lip_delta_before_animation is None when it does not apply),
+        the shared options are not touched
+        """
+        # Load and preprocess source image
+        return self.prepare_source_rgb(load_image_rgb(source_image_path))
+
+    def prepare_source_rgb(self, img_rgb) -> SourceState:
+        """ prepare_source of a decoded HxWx3 RGB image (e.g. received by a server)
+        """
+        t0 = time.perf_counter()
+        img_rgb = resize_to_limit(img_rgb, self.cfg.ref_max_shape, self.cfg.ref_shape_n)
+        # log(f"Load source image from {source_image_path}")
+        crop_info = self.cropper.crop_single_image(img_rgb)
+        source_lmk = crop_info['lmk_crop']
+        _, img_crop_256x256 = crop_info['img_crop'], crop_info['img_crop_256x256']
+
+        if self.cfg.flag_do_crop:
+            i_s = self.prepare_source_image(img_crop_256x256)
+        else:
+            i_s = self.prepare_source_image(img_rgb)
+
+        x_s_info = self.get_kp_info(self._model_sessions, i_s, x_s=None, r_s=None, x_s_info=None,
+                                    lip_delta_before_animation=None, single_image=True)
+        x_c_s = x_s_info['kp']
+        r_s = self.get_rotation_matrix(x_s_info['pitch'], x_s_info['yaw'], x_s_info['roll'])
+        # the source feature is converted once here, the per-frame warp only moves driving-dependent data
+        f_s = self.prepare_feature_3d(self._model_sessions, self.get_3d_feature(self._model_sessions, np.array(i_s)))
+        x_s = self.transform_keypoint(x_s_info)
+
+        lip_delta_before_animation = None
+        if self.cfg.flag_lip_zero:
+            c_d_lip_before_animation = [0.]
+            combined_lip_ratio_tensor_before_animation = self.calc_combined_lip_ratio(
+                c_d_lip_before_animation, crop_info['lmk_crop'])
+            if combined_lip_ratio_tensor_before_animation[0][0] >= self.cfg.lip_zero_threshold:
+                lip_delta_before_animation = self.retarget_lip(self._model_sessions['s_l_session'], x_s,
+                                                               combined_lip_ratio_tensor_before_animation)
+        self.stage_latency.add('source', time.perf_counter() - t0)
+        return SourceState(source_lmk=source_lmk, x_c_s=x_c_s, x_s=x_s, f_s=f_s, r_s=r_s, x_s_info=x_s_info,
+                           lip_delta_before_animation=lip_delta_before_animation, crop_info=crop_info,
+                           img_rgb=img_rgb, img_crop_256x256=img_crop_256x256)
+
+    def prepare_portrait(self, source_image_path):
+        """ prepare_source as the tuple of the former API
+        """
+        source = self.prepare_source(source_image_path)
+        return source.source_lmk, source.x_c_s, source.x_s, source.f_s, source.r_s, source.x_s_info, \
+            source.lip_delta_before_animation, source.crop_info, source.img_rgb, source.img_crop_256x256
+
+    def stitch_retarget(self, x_s, x_d_new, eye_ratio, lip_ratio, lip_delta_before_animation):
+        """ Algorithm 1 on a chunk of frames, each stitching/retargeting MLP runs once for the whole chunk
+        x_s: 1xNx3
+        x_d_new: BxNx3
+        eye_ratio: Bx3 combined eye ratios or None
+        lip_ratio: Bx2 combined lip ratios or None
+        lip_delta_before_animation: lip-zero correction of the source, None when it does not apply
+        """
+        num_kp = x_s.shape[1]
+        if not self.cfg.flag_stitching and not self.cfg.flag_eye_retargeting and not self.cfg.flag_lip_retargeting:
+            # without stitching or retargeting
+            if lip_delta_before_animation is not None:
+                x_d_new += lip_delta_before_animation.reshape(-1, num_kp, 3)
+        elif self.cfg.flag_stitching and not self.cfg.flag_eye_retargeting and not self.cfg.flag_lip_retargeting:
+            # with stitching and without retargeting
+            x_d_new = self.stitching(self._model_sessions['s_session'], x_s, x_d_new)
+            if lip_delta_before_animation is not None:
+                x_d_new += lip_delta_before_animation.reshape(-1, num_kp, 3)
+        else:
+            eyes_delta, lip_delta = 0, 0
+            if self.cfg.flag_eye_retargeting:
+                # ∆_eyes,i = R_eyes(x_s; c_s,eyes, c_d,eyes,i)
+                eyes_delta = self.retarget_eye(self._model_sessions['s_e_session'], x_s, eye_ratio)
+                eyes_delta = eyes_delta.reshape(-1, num_kp, 3)
+            if self.cfg.flag_lip_retargeting:
+                # ∆_lip,i = R_lip(x_s; c_s,lip, c_d,lip,i)
+                lip_delta = self.retarget_lip(self._model_sessions['s_l_session'], x_s, lip_ratio)
+                lip_delta = lip_delta.reshape(-1, num_kp, 3)
+
+            if self.cfg.flag_relative:  # use x_s
+                x_d_new = x_s + torch.from_numpy(np.asarray(eyes_delta + lip_delta, dtype=np.float32))
+            else:  # use x_d,i
+                x_d_new = x_d_new + torch.from_numpy(np.asarray(eyes_delta + lip_delta, dtype=np.float32))
+
+            if self.cfg.flag_stitching:
+                x_d_new = self.stitching(self._model_sessions['s_session'], x_s, x_d_new)
+        return x_d_new
+
+    def generate(self, n_frames, source_lmk, crop_info, img_rgb, compositor, i_d_lst, i_p_paste_lst, x_s,
+                 r_s, f_s, x_s_info, x_c_s, eye_ratio_lst, lip_ratio_lst, lip_delta_before_animation, keep_crop=True,
+                 driving=None, progress=True, stop=None, progress_callback=None, motion_lst=None):
+        """
+        compositor: paste-back compositor, None skips the paste back
+        i_p_paste_lst: list or StreamingVideoWriter the pasted frames are appended to
+        keep_crop: whether to keep and return the animated crops, only needed for the crop/concat outputs
+        driving: DrivingState of the job, relative motion is measured against its anchor, which is set from the
+        first frame of i_d_lst when missing. chunked rendering passes the same state to every chunk
+        progress: show the tqdm progress bars
+        stop: threading.Event, once set no further frame is animated (the frames done so far are returned)
+        progress_callback: called with 1 after every animated frame
+        motion_lst: kp info of the driving frames extracted elsewhere (see MotionPacket.kp_info), replaces i_d_lst
+        """
+
+        i_p_lst = []
+        driving = driving if driving is not None else DrivingState()
+        r_d_0, x_d_0_info = driving.anchor if driving.anchor is not None else (None, None)
+        combined_eye_ratios, combined_lip_ratios = None, None
+        if self.cfg.flag_eye_retargeting or self.cfg.flag_lip_retargeting:
+            # source ratios once, [c_s, c_d,i] for every frame in one pass
+            retarget_features = RetargetFeatures(source_lmk)
+            if self.cfg.flag_eye_retargeting:
+                combined_eye_ratios = torch.from_numpy(retarget_features.combined_eye_ratio(eye_ratio_lst))
+            if self.cfg.flag_lip_retargeting:
+                combined_lip_ratios = torch.from_numpy(retarget_features.combined_lip_ratio(lip_ratio_lst))
+
+        x_d_new_lst = []
+        for i in tqdm(range(n_frames), desc='Extracting motion...', total=n_frames, disable=not progress):
+            t0 = time.perf_counter()
+            if motion_lst is not None:
+                x_d_i_info = motion_lst[i]
+            else:
+                x_d_i_info = self.get_kp_info(self._model_sessions, i_d_lst[i], x_s, r_s, x_s_info,
+                                              lip_delta_before_animation, run_local=True)
+            r_d_i = self.get_rotation_matrix(x_d_i_info['pitch'], x_d_i_info['yaw'], x_d_i_info['roll'])
+
+            if r_d_0 is None:
+                r_d_0 = r_d_i
+                x_d_0_info = x_d_i_info
+                driving.anchor = (r_d_0, x_d_0_info)
+
+            if self.cfg.flag_relative:
+                r_new = (r_d_i @ r_d_0.permute(0, 2, 1)) @ r_s
+                delta_new = x_s_info['exp'] + (x_d_i_info['exp'] - x_d_0_info['exp'])
+                scale_new = x_s_info['scale'] * (x_d_i_info['scale'] / x_d_0_info['scale'])
+                t_new = x_s_info['t'] + (x_d_i_info['t'] - x_d_0_info['t'])
+            else:
+                r_new = r_d_i
+                delta_new = x_d_i_info['exp']
+                scale_new = x_s_info['scale']
+                t_new = x_d_i_info['t']
+
+            t_new[..., 2].fill_(0)  # zero tz
+            x_d_new_lst.append(scale_new * (x_c_s @ r_new + delta_new) + t_new)
+            self.stage_latency.add('motion', time.perf_counter() - t0)
+
+        # Algorithm 1, batched over chunks of frames: the MLPs are tiny, so one call per chunk instead of per frame
+        t0 = time.perf_counter()
+        x_d_new = torch.cat(x_d_new_lst, dim=0)
+        chunk = max(self.cfg.stitching_batch_size, 1)
+        for start in range(0, n_frames, chunk):
+            end = min(start + chunk, n_frames)
+            x_d_new[start:end] = self.stitch_retarget(
+                x_s, x_d_new[start:end].clone(),
+                combined_eye_ratios[start:end] if combined_eye_ratios is not None else None,
+                combined_lip_ratios[start:end] if combined_lip_ratios is not None else None,
+                lip_delta_before_animation)
+        self.stage_latency.add('stitching', (time.perf_counter() - t0) / max(n_frames, 1))
+
+        n_animated = 0
+        for i in tqdm(range(n_frames), desc='Animating...', total=n_frames, disable=not progress):
+            if stop is not None and stop.is_set():
+                break
+            t0 = time.perf_counter()
+            i_p_i = self.warp_decode(self._model_sessions, f_s, x_s, x_d_new[i:i + 1])
+            self.stage_latency.add('warp', time.perf_counter() - t0)
+            if keep_crop:
+                i_p_lst.append(i_p_i)
+            if compositor is not None:
+                t0 = time.perf_counter()
+                i_p_i_to_ori_blend = compositor.paste_back(i_p_i)
+                self.stage_latency.add('paste_back', time.perf_counter() - t0)
+                i_p_paste_lst.append(i_p_i_to_ori_blend)
+            n_animated += 1
+            if progress_callback is not None:
+                progress_callback(1)
+        driving.n_frames += n_animated
+        return i_p_lst
+
+    def animate(self, source: SourceState, driving: DrivingState, i_d_lst, eye_ratio_lst=None, lip_ratio_lst=None,
+                compositor=None, i_p_paste_lst=None, keep_crop=True, progress=True, stop=None, progress_callback=None):
+        """ generate() on the job states
+        """
+        return self.generate(i_d_lst.shape[0], source.source_lmk, source.crop_info, source.img_rgb, compositor, i_d_lst,
+                             i_p_paste_lst if i_p_paste_lst is not None else [], source.x_s, source.r_s, source.f_s,
+                             source.x_s_info, source.x_c_s, eye_ratio_lst, lip_ratio_lst,
+                             source.lip_delta_before_animation, keep_crop=keep_crop, driving=driving,
+                             progress=progress, stop=stop, progress_callback=progress_callback)
+
+    def animate_motion(self, source: SourceState, driving: DrivingState, packets, compositor=None,
+                       i_p_paste_lst=None, keep_crop=True, progress=False, stop=None):
+        """ animate() on MotionPackets received from an edge, the motion extractor doesn't run
+        a packet flagged anchor restarts the relative motion from it
+        """
+        retargeting = self.cfg.flag_eye_retargeting or self.cfg.flag_lip_retargeting
+        i_p_lst = []
+        i_p_paste_lst = i_p_paste_lst if i_p_paste_lst is not None else []
+        start = 0
+        for end in range(1, len(packets) + 1):
+            if end < len(packets) and not packets[end].anchor:
+                continue
+            segment = packets[start:end]
+            start = end
+            if segment[0].anchor:
+                driving.anchor = None
+            eye_ratio_lst = lip_ratio_lst = None
+            if retargeting:
+                if any(p.eye_ratio is None or p.lip_ratio is None for p in segment):
+                    raise ValueError('retargeting needs the eye and lip ratios in the motion packets')
+                eye_ratio_lst = np.stack([p.eye_ratio.reshape(1, 2) for p in segment])
+                lip_ratio_lst = np.stack([p.lip_ratio.reshape(1, 1) for p in segment])
+            i_p_lst += self.generate(len(segment), source.source_lmk, source.crop_info, source.img_rgb, compositor,
+                                     None, i_p_paste_lst, source.x_s, source.r_s, source.f_s, source.x_s_info,
+                                     source.x_c_s, eye_ratio_lst, lip_ratio_lst, source.lip_delta_before_animation,
+                                     keep_crop=keep_crop, driving=driving, progress=progress, stop=stop,
+                                     motion_lst=[p.kp_info() for p in segment])
+        return i_p_lst
+
+    def process_driving_frames(self, driving_rgb_lst, driving_rgb_lst_256, cfg, cropper):
+        t0 = time.perf_counter()
+        result = super().process_driving_frames(driving_rgb_lst, driving_rgb_lst_256, cfg, cropper)
+        stage = 'retargeting' if cfg.flag_eye_retargeting or cfg.flag_lip_retargeting else 'driving'
+        self.stage_latency.add(stage, (time.perf_counter() - t0) / max(len(driving_rgb_lst_256), 1))
+        return result
+
+    def get_motion_anchor(self, i_d_0):
+        """ (r_d_0, x_d_0_info) of the first driving frame, the reference of the relative motion
+        i_d_0: 1x3xHxW
+        """
+        x_d_0_info = self.get_kp_info(self._model_sessions, i_d_0, None, None, None, None, run_local=True)
+        r_d_0 = self.get_rotation_matrix(x_d_0_info['pitch'], x_d_0_info['yaw'], x_d_0_info['roll'])
+        return r_d_0, x_d_0_info
@@ -1,211 +1,343 @@
 import cv2
-import onnxruntime as ort
-import numpy as np
 import os.path as osp
+import time
+import shutil
+from contextlib import ExitStack
 from tqdm import tqdm
-from LivePortrait.utils import load_image_rgb, resize_to_limit, Cropper, images2video, basename
-from LivePortrait.commons import PortraitController, Config
+from concurrent.futures import as_completed
+from LivePortrait.utils import StreamingVideoWriter, basename, concat_segments
+from LivePortrait.utils import load_video_frames, probe_video, probe_keyframes
+from LivePortrait.utils.rprint import rlog as log
+from LivePortrait.utils.manifest import RenderManifest, job_key, file_signature
+from LivePortrait.utils.shm_frames import SharedFrameRing, SharedFrameWriter, is_shared_frames, shared_frames_name
+from LivePortrait.commons import Config
+from LivePortrait.commons.config import OUTPUT_MODES
+from LivePortrait.commons.states import SourceState, DrivingState
+from LivePortrait.commons.scheduling import REALTIME, DeadlineMissed, work_priority
+from LivePortrait.engine import InferenceEngine
+from LivePortrait.parallel_render import plan_segments, get_render_pool, render_segment
 
+# options a chunked render is keyed on, resuming with any of them changed starts the render over. the encoder
+# options (crf, preset, tune) are part of it: segments are joined without re-encoding, they must all match
+RENDER_KEY_FIELDS = (
+    'checkpoint_F', 'checkpoint_M', 'checkpoint_W', 'checkpoint_G', 'checkpoint_S', 'checkpoint_SE', 'checkpoint_SL',
+    'flag_relative', 'flag_stitching', 'flag_eye_retargeting', 'flag_lip_retargeting', 'flag_lip_zero',
+    'lip_zero_threshold', 'flag_do_crop', 'flag_pasteback', 'flag_remap_paste_back', 'input_shape', 'dsize', 'scale',
+    'vx_ratio', 'vy_ratio', 'ref_max_shape', 'ref_shape_n', 'crf', 'encoder_preset', 'encoder_tune',
+    'driving_start', 'driving_end', 'driving_stride', 'driving_fps', 'output_fps',
+)
+
+
+class LivePortraitONNX(InferenceEngine):
+    """ rendering jobs on top of the engine: every render() call prepares its own source and driving states,
+    so several renders can run at once on threads of one instance (use distinct wfp_prefix for their outputs)
+    """
 
-class LivePortraitONNX(PortraitController):
     def __init__(self, cfg=Config):
         super().__init__(cfg)
-        self.providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
-        self.cfg = cfg
-        self.cropper = Cropper(crop_cfg=self.cfg)
-        self._model_sessions = None
-        self.model_sessions()
-
-    def model_sessions(self):
-        if self._model_sessions is None:
-            self._model_sessions = self._initialize_sessions()
-        return self._model_sessions
-
-    def _initialize_sessions(self):
-        m_session = ort.InferenceSession(self.cfg.checkpoint_M, providers=self.providers)
-        f_session = ort.InferenceSession(self.cfg.checkpoint_F, providers=self.providers)
-        w_session = ort.InferenceSession(self.cfg.checkpoint_W, providers=self.providers)
-        g_session = ort.InferenceSession(self.cfg.checkpoint_G, providers=self.providers)
-
-        s_session = ort.InferenceSession(self.cfg.checkpoint_S, providers=self.providers)
-        s_l_session = ort.InferenceSession(self.cfg.checkpoint_SL, providers=self.providers)
-        s_e_session = ort.InferenceSession(self.cfg.checkpoint_SE, providers=self.providers)
-
-        m_input_name = m_session.get_inputs()[0].name
-        m_output_name = m_session.get_outputs()[0].name
-
-        g_input_name = g_session.get_inputs()[0].name
-        g_output_name = g_session.get_outputs()[0].name
-
-        f_input_name = f_session.get_inputs()[0].name
-        f_output_name = f_session.get_outputs()[0].name
-
-        w_input_names = [input.name for input in w_session.get_inputs()]
-        w_output_names = [output.name for output in w_session.get_outputs()]
-
-        return {
-            'm_session': m_session, 'm_input_name': m_input_name, 'm_output_name': m_output_name,
-            'g_session': g_session, 'g_input_name': g_input_name, 'g_output_name': g_output_name,
-            'f_session': f_session, 'f_input_name': f_input_name, 'f_output_name': f_output_name,
-            'w_session': w_session, 'w_input_names': w_input_names, 'w_output_names': w_output_names,
-            's_session': s_session, 's_l_session': s_l_session, 's_e_session': s_e_session
-        }
-
-    def prepare_portrait(self, source_image_path):
-        # Load and preprocess source image
-        img_rgb = load_image_rgb(source_image_path)
-        img_rgb = resize_to_limit(img_rgb, self.cfg.ref_max_shape, self.cfg.ref_shape_n)
-        # log(f"Load source image from {source_image_path}")
-        crop_info = self.cropper.crop_single_image(img_rgb)
-        source_lmk = crop_info['lmk_crop']
-        _, img_crop_256x256 = crop_info['img_crop'], crop_info['img_crop_256x256']
-
-        if self.cfg.flag_do_crop:
-            i_s = self.prepare_source_image(img_crop_256x256)
-        else:
-            i_s = self.prepare_source_image(img_rgb)
-
-        x_s_info = self.get_kp_info(self._model_sessions, i_s, x_s=None, r_s=None, x_s_info=None,
-                                    lip_delta_before_animation=None, single_image=True)
-        x_c_s = x_s_info['kp']
-        r_s = self.get_rotation_matrix(x_s_info['pitch'], x_s_info['yaw'], x_s_info['roll'])
-        f_s = self.get_3d_feature(self._model_sessions, np.array(i_s))
-        x_s = self.transform_keypoint(x_s_info)
-
-        lip_delta_before_animation = None
-        if self.cfg.flag_lip_zero:
-            c_d_lip_before_animation = [0.]
-            combined_lip_ratio_tensor_before_animation = self.calc_combined_lip_ratio(
-                c_d_lip_before_animation, crop_info['lmk_crop'])
-            if combined_lip_ratio_tensor_before_animation[0][0] < self.cfg.lip_zero_threshold:
-                self.cfg.flag_lip_zero = False
-            else:
-                lip_delta_before_animation = self.retarget_lip(self._model_sessions['s_l_session'], x_s,
-                                                               combined_lip_ratio_tensor_before_animation)
-        return source_lmk, x_c_s, x_s, f_s, r_s, x_s_info, lip_delta_before_animation, crop_info, img_rgb, img_crop_256x256
-
-    def generate(self, n_frames, source_lmk, crop_info, img_rgb, mask_ori, i_d_lst, i_p_paste_lst, x_s,
-                 r_s, f_s, x_s_info, x_c_s, eye_ratio_lst, lip_ratio_lst, lip_delta_before_animation):
-
-        i_p_lst = []
-        r_d_0, x_d_0_info = None, None
-        for i in tqdm(range(n_frames), desc='Animating...', total=n_frames):
-            i_d_i = i_d_lst[i]
-            x_d_i_info = self.get_kp_info(self._model_sessions, i_d_i, x_s, r_s, x_s_info, lip_delta_before_animation,
-                                          run_local=True)
-            r_d_i = self.get_rotation_matrix(x_d_i_info['pitch'], x_d_i_info['yaw'], x_d_i_info['roll'])
-
-            if i == 0:
-                r_d_0 = r_d_i
-                x_d_0_info = x_d_i_info
-
-            if self.cfg.flag_relative:
-                r_new = (r_d_i @ r_d_0.permute(0, 2, 1)) @ r_s
-                delta_new = x_s_info['exp'] + (x_d_i_info['exp'] - x_d_0_info['exp'])
-                scale_new = x_s_info['scale'] * (x_d_i_info['scale'] / x_d_0_info['scale'])
-                t_new = x_s_info['t'] + (x_d_i_info['t'] - x_d_0_info['t'])
-            else:
-                r_new = r_d_i
-                delta_new = x_d_i_info['exp']
-                scale_new = x_s_info['scale']
-                t_new = x_d_i_info['t']
-
-            t_new[..., 2].fill_(0)  # zero tz
-            x_d_i_new = scale_new * (x_c_s @ r_new + delta_new) + t_new
-
-            # Algorithm 1:
-            if not self.cfg.flag_stitching and not self.cfg.flag_eye_retargeting and not self.cfg.flag_lip_retargeting:
-                # without stitching or retargeting
-                if self.cfg.flag_lip_zero:
-                    x_d_i_new += lip_delta_before_animation.reshape(-1, x_s.shape[1], 3)
-                else:
-                    pass
-            elif self.cfg.flag_stitching and not self.cfg.flag_eye_retargeting and not self.cfg.flag_lip_retargeting:
-                # with stitching and without retargeting
-                if self.cfg.flag_lip_zero:
-                    x_d_i_new = self.stitching(self._model_sessions['s_session'], x_s,
-                                               x_d_i_new) + lip_delta_before_animation.reshape(-1,
-                                                                                               x_s.shape[
-                                                                                                   1],
-                                                                                               3)
-
-                else:
-                    x_d_i_new = self.stitching(self._model_sessions['s_session'], x_s, x_d_i_new)
 
-            else:
-                eyes_delta, lip_delta = None, None
-
-                if self.cfg.flag_eye_retargeting:
-                    c_d_eyes_i = eye_ratio_lst[i]
-                    combined_eye_ratio_tensor = self.calc_combined_eye_ratio(c_d_eyes_i,
-                                                                             source_lmk)
-                    # ∆_eyes,i = R_eyes(x_s; c_s,eyes, c_d,eyes,i)
-                    eyes_delta = self.retarget_eye(self._model_sessions['s_e_session'], x_s, combined_eye_ratio_tensor)
-                if self.cfg.flag_lip_retargeting:
-                    c_d_lip_i = lip_ratio_lst[i]
-                    combined_lip_ratio_tensor = self.calc_combined_lip_ratio(c_d_lip_i,
-                                                                             source_lmk)
-                    # ∆_lip,i = R_lip(x_s; c_s,lip, c_d,lip,i)
-                    lip_delta = self.retarget_lip(self._model_sessions['s_e_session'], x_s, combined_lip_ratio_tensor)
-
-                if self.cfg.flag_relative:  # use x_s
-                    x_d_i_new = x_s + \
-                                (eyes_delta.reshape(-1, x_s.shape[1], 3) if eyes_delta is not None else 0) + \
-                                (lip_delta.reshape(-1, x_s.shape[1], 3) if lip_delta is not None else 0)
-                else:  # use x_d,i
-                    x_d_i_new = x_d_i_new + \
-                                (eyes_delta.reshape(-1, x_s.shape[1], 3) if eyes_delta is not None else 0) + \
-                                (lip_delta.reshape(-1, x_s.shape[1], 3) if lip_delta is not None else 0)
-
-                if self.cfg.flag_stitching:
-                    x_d_i_new = self.stitching(self._model_sessions['s_session'], x_s, x_d_i_new)
-
-            i_p_i = self.warp_decode(self._model_sessions, f_s, x_s, x_d_i_new)
-            i_p_lst.append(i_p_i)
-            i_p_i_to_ori_blend = self.paste_back(i_p_i, crop_info['M_c2o'], img_rgb, mask_ori)
-            i_p_paste_lst.append(i_p_i_to_ori_blend)
-        return i_p_lst
-
-    def render(self, live_portrait, video_path_or_id=None, image_path=None, real_time=False):
+    def get_output_modes(self, output_modes=None):
+        output_modes = tuple(self.cfg.output_modes if output_modes is None else output_modes)
+        unknown = set(output_modes) - set(OUTPUT_MODES)
+        if unknown:
+            raise ValueError(f'unknown output modes {sorted(unknown)}, expect any of {OUTPUT_MODES}')
+        if not self.cfg.flag_pasteback:
+            output_modes = tuple(mode for mode in output_modes if mode != 'pasted')
+        return output_modes
+
+    def render(self, video_path_or_id=None, image_path=None, real_time=False, output_modes=None, wfp_prefix=None,
+               progress_callback=None):
         """
         Video_path_or_id is use for 2 process, please make sure video_id only use for real-time demo
+        shm://name reads the driving frames from a shared-memory ring instead, in both modes
+        output_modes: any of 'crop', 'pasted', 'concat', defaults to cfg.output_modes. Stages only needed by
+        outputs that are not requested (paste back, concat, their encodes) are skipped
+        wfp_prefix: path of the outputs without extension, defaults to animations/{source}--{source},
+        shm://name streams them to shared-memory rings (name for pasted, name_crop, name_concat)
+        progress_callback: called with the number of driving frames just rendered, offline rendering only
         """
-        source_landmark, x_c_s, x_s, f_s, r_s, \
-            x_s_info, lip_delta_before_animation, crop_info, \
-            img_rgb, imgs_crop_256x256 = live_portrait.prepare_portrait(source_image_path=image_path)
+        output_modes = self.get_output_modes(output_modes)
+        source = self.prepare_source(image_path)
         if real_time:
-            cap = cv2.VideoCapture(int(video_path_or_id) if real_time else video_path_or_id)
+            self.render_real_time(video_path_or_id if is_shared_frames(video_path_or_id) else int(video_path_or_id),
+                                  source, output_modes)
+            return
+
+        cfg = self.cfg
+        selector = self.get_frame_selector(video_path_or_id, cfg)
+        if wfp_prefix is None:
+            self.mkdir('animations')
+            wfp_prefix = osp.join('animations', f'{basename(image_path)}--{basename(image_path)}')
+        audio_fp = video_path_or_id if cfg.flag_audio_passthrough and osp.isfile(video_path_or_id) else None
+        # a ring is a live stream: it can't be split or resumed, and its frames go out as they are rendered
+        streamed = is_shared_frames(video_path_or_id) or is_shared_frames(wfp_prefix)
+        if cfg.render_workers > 1 and osp.isfile(video_path_or_id) and not streamed:
+            self.render_parallel(video_path_or_id, image_path, source, output_modes, wfp_prefix, audio_fp=audio_fp,
+                                 selector=selector, progress_callback=progress_callback)
+            return
+        if cfg.render_chunk_size > 0 and not streamed:
+            self.render_chunked(video_path_or_id, image_path, source, output_modes, wfp_prefix, audio_fp=audio_fp,
+                                selector=selector, progress_callback=progress_callback)
+            return
+
+        compositor, driving_rgb_lst, i_d_lst, _, _, _, eye_ratio_lst, lip_ratio_lst = self.process_source_motion(
+            source.img_rgb, video_path_or_id, source.crop_info, cfg, self.cropper,
+            with_paste_back='pasted' in output_modes, with_display='concat' in output_modes, selector=selector)
+
+        # pasted frames are encoded by a background ffmpeg process while the next frames are animated
+        writers = self.open_video_writers({mode: self.output_path(wfp_prefix, mode) for mode in output_modes},
+                                          audio_fp=audio_fp, selector=selector)
+        self.render_frames(source, compositor, DrivingState(), driving_rgb_lst, i_d_lst, eye_ratio_lst, lip_ratio_lst,
+                           writers, progress_callback=progress_callback)
+
+    def render_real_time(self, video_id, source: SourceState, output_modes):
+        """ animate a webcam or a shm://name ring as it goes, shown in a window or written to the
+        cfg.realtime_output ring
+        """
+        # per-source compositing context: warped mask, ROI and background term are built once, not per frame
+        compositor = None
+        if 'pasted' in output_modes:
+            compositor = self.prepare_compositor(self.cfg.mask_crop, source.crop_info['M_c2o'], source.img_rgb,
+                                                 use_remap=self.cfg.flag_remap_paste_back,
+                                                 num_threads=self.cfg.paste_back_threads)
+        sink = None
+        if self.cfg.realtime_output:
+            sink = SharedFrameWriter(self.cfg.realtime_output, n_slots=self.cfg.shm_slots, lossless=False)
+        i_p_i_to_ori_blend = None
+        try:
+            for captured, frame in self.capture_frames(video_id):
+                try:
+                    # with cfg.flag_scheduling the frame goes before batch work and is dropped once it is stale
+                    with work_priority(REALTIME, deadline=captured + self.cfg.realtime_deadline_ms / 1000.):
+                        x_s, x_d_i_new = self.get_kp_info(self._model_sessions, frame, source.x_s, source.r_s,
+                                                          source.x_s_info, source.lip_delta_before_animation)
+                        i_p_i = self.warp_decode(self._model_sessions, source.f_s, x_s, x_d_i_new)
+                except DeadlineMissed:
+                    continue
+                if compositor is not None:
+                    # only the ROI changes between frames, so the previous output is reused as background
+                    i_p_i_to_ori_blend = compositor.paste_back(i_p_i, out=i_p_i_to_ori_blend)
+                    i_p_i = i_p_i_to_ori_blend
+                if sink is not None:
+                    sink.write(i_p_i)
+                    continue
+                cv2.imshow('a', i_p_i[:, :, ::-1])
+                if cv2.waitKey(1) & 0xff == ord('q'):
+                    break
+        finally:
+            if sink is not None:
+                sink.close()
+            else:
+                cv2.destroyAllWindows()
+
+    def capture_frames(self, video_id):
+        """ yield (time.perf_counter() capture time, frame) of the selected real-time driving frames
+        video_id: webcam id, its frames as read, or shm://name, the latest frame of the ring each time (a view of
+        the shared memory, valid until the producer wraps around)
+        """
+        t0 = None
+        if is_shared_frames(video_id):
+            ring = SharedFrameRing.attach(shared_frames_name(video_id), timeout=self.cfg.shm_timeout_s)
+            selector = self.get_frame_selector(video_id, self.cfg)
+            try:
+                for _, _, frame in ring.iter_frames(lossless=False):
+                    captured = time.perf_counter()
+                    t0 = captured if t0 is None else t0
+                    if selector.finished(captured - t0):
+                        break
+                    if selector.select(captured - t0):
+                        yield captured, frame
+            finally:
+                ring.close()
+            return
+        cap = cv2.VideoCapture(video_id)
+        # webcam frames are selected on the time since the first frame, skipped ones are grabbed, not decoded
+        selector = self.get_frame_selector(video_id, self.cfg, src_fps=cap.get(cv2.CAP_PROP_FPS))
+        try:
             while cap.isOpened():
-                ret, frame = cap.read()
-                if not ret:
+                if not cap.grab():
                     break
-                x_s, x_d_i_new = live_portrait.get_kp_info(self._model_sessions, frame, x_s, r_s, x_s_info,
-                                                           lip_delta_before_animation)
-                i_p_i = live_portrait.warp_decode(self._model_sessions, np.array(f_s), np.array(x_s),
-                                                  np.array(x_d_i_new))
-                if live_portrait.cfg.flag_pasteback:
-                    mask_ori = live_portrait.prepare_paste_back(live_portrait.cfg.mask_crop, crop_info['M_c2o'],
-                                                                dsize=(img_rgb.shape[1], img_rgb.shape[0]))
-                    i_p_i_to_ori_blend = live_portrait.paste_back(i_p_i, crop_info['M_c2o'], img_rgb, mask_ori)
-                    cv2.imshow('a', i_p_i_to_ori_blend[:, :, ::-1])
-                if cv2.waitKey(1) & 0xff == ord('q'):
+                t0 = time.perf_counter() if t0 is None else t0
+                t = time.perf_counter() - t0
+                if selector.finished(t):
+                    break
+                if not selector.select(t):
+                    continue
+                ret, frame = cap.retrieve()
+                if not ret:
                     break
+                yield t0 + t, frame
+        finally:
             cap.release()
-            cv2.destroyAllWindows()
-        else:
-
-            mask_ori, driving_rgb_lst, i_d_lsts, i_p_paste_lst, _, n_frames, input_eye_ratio_lsts, input_lip_ratio_lsts = live_portrait.process_source_motion(
-                img_rgb, video_path_or_id, crop_info, live_portrait.cfg, live_portrait.cropper)
-
-            result = live_portrait.generate(n_frames, source_landmark, crop_info, img_rgb, mask_ori, i_d_lsts,
-                                            i_p_paste_lst, x_s, r_s, f_s, x_s_info, x_c_s, input_eye_ratio_lsts,
-                                            input_lip_ratio_lsts,
-                                            lip_delta_before_animation)
-            live_portrait.mkdir('animations')
-            frames_concatenated = live_portrait.concat_frames(result, driving_rgb_lst, imgs_crop_256x256)
-            wfp_concat = osp.join('animations',
-                                  f'{basename(image_path)}--{basename(image_path)}_concat.mp4')
-            images2video(frames_concatenated, wfp=wfp_concat)
-
-            wfp = osp.join('animations', f'{basename(image_path)}--{basename(image_path)}.mp4')
-            images2video(i_p_paste_lst, wfp=wfp)
+
+    @staticmethod
+    def output_path(wfp_prefix, mode):
+        extension = '' if is_shared_frames(wfp_prefix) else '.mp4'
+        return f'{wfp_prefix}{extension}' if mode == 'pasted' else f'{wfp_prefix}_{mode}{extension}'
+
+    def render_chunked(self, video_path_or_id, image_path, source: SourceState, output_modes, wfp_prefix,
+                       audio_fp=None, selector=None, progress_callback=None):
+        """ offline rendering in chunks of cfg.render_chunk_size frames that survives a crash or pre-emption
+        every chunk is encoded to its own segments in {wfp_prefix}.parts and recorded in a manifest,
+        a rerun of the same job continues after the last completed chunk. the source and driving states are
+        stored with the manifest, so relative motion stays consistent across restarts. the appearance feature is
+        not stored, the one just prepared from the source image is used.
+        the segments are joined with the concat demuxer, without re-encoding
+        """
+        cfg = self.cfg
+        key = job_key(file_signature(image_path), file_signature(video_path_or_id), list(output_modes),
+                      {field: getattr(cfg, field, None) for field in RENDER_KEY_FIELDS})
+        job_dir = f'{wfp_prefix}.parts'
+        manifest = RenderManifest.open(job_dir, key, cfg.render_chunk_size, output_modes)
+
+        driving = DrivingState()
+        if manifest.has_state():
+            # resumed job: keep the states of the first run instead of the ones just recomputed, except the feature
+            # which only depends on the source image
+            state = manifest.load_state()
+            source = SourceState.from_dict(state, f_s=source.f_s, crop_info=source.crop_info)
+            driving = DrivingState.from_dict(state)
+            driving.n_frames = manifest.next_frame
+            log(f'Resume {job_dir} at frame {manifest.next_frame}')
+            if progress_callback is not None:
+                progress_callback(manifest.next_frame)
+
+        if not manifest.complete:
+            compositor = None
+            if 'pasted' in output_modes:
+                compositor = self.prepare_compositor(cfg.mask_crop, source.crop_info['M_c2o'], source.img_rgb,
+                                                     use_remap=cfg.flag_remap_paste_back,
+                                                     num_threads=cfg.paste_back_threads)
+            index, start = len(manifest.chunks), manifest.next_frame
+            for driving_rgb_lst, driving_rgb_lst_256 in self.iter_driving_chunks(
+                    video_path_or_id, cfg, cfg.render_chunk_size, with_display='concat' in output_modes,
+                    selector=selector, start_frame=start):
+                i_d_lst, eye_ratio_lst, lip_ratio_lst = self.process_driving_frames(driving_rgb_lst, driving_rgb_lst_256,
+                                                                                    cfg, self.cropper)
+                if driving.anchor is None:
+                    driving.anchor = self.get_motion_anchor(i_d_lst[0])
+                    manifest.save_state(**source.to_dict(with_feature=False), **driving.to_dict())
+                n_frames = i_d_lst.shape[0]
+                writers = self.open_video_writers(
+                    {mode: manifest.segment_path(mode, index) for mode in output_modes}, selector=selector)
+                self.render_frames(source, compositor, driving, driving_rgb_lst, i_d_lst, eye_ratio_lst,
+                                   lip_ratio_lst, writers, progress_callback=progress_callback)
+                manifest.add_chunk(index, start, start + n_frames)
+                index, start = index + 1, start + n_frames
+            manifest.mark_complete()
+
+        for mode in output_modes:
+            concat_segments(manifest.segments(mode), self.output_path(wfp_prefix, mode), audio_fp=audio_fp,
+                            audio_start=selector.start if selector is not None else 0.,
+                            audio_duration=selector.duration if selector is not None else None)
+        if not cfg.flag_keep_segments:
+            shutil.rmtree(job_dir)
+
+    def render_frames(self, source: SourceState, compositor, driving: DrivingState, driving_rgb_lst, i_d_lst,
+                      eye_ratio_lst, lip_ratio_lst, writers, progress_callback=None):
+        """ animate a run of driving frames and write them to writers ({mode: writer}), which are closed, also when
+        rendering fails
+        driving: state of the whole driving video, its anchor is the first frame of the video, not of the run
+        """
+        with ExitStack() as stack:
+            for writer in writers.values():
+                stack.callback(writer.close)
+            result = self.animate(source, driving, i_d_lst, eye_ratio_lst, lip_ratio_lst, compositor=compositor,
+                                  i_p_paste_lst=writers.get('pasted'),
+                                  keep_crop='crop' in writers or 'concat' in writers,
+                                  progress_callback=progress_callback)
+            if 'concat' in writers:
+                for frame in self.concat_frames(result, driving_rgb_lst, source.img_crop_256x256):
+                    writers['concat'].write(frame)
+            if 'crop' in writers:
+                for frame in result:
+                    writers['crop'].write(frame)
+
+    def render_parallel(self, video_path, image_path, source: SourceState, output_modes, wfp_prefix, audio_fp=None,
+                        selector=None, progress_callback=None):
+        """ offline rendering of one driving video split over cfg.render_workers processes
+        the source and the motion of the first driving frame are prepared here once and stored with the manifest,
+        the selected driving frames are split into segments starting near keyframes, every worker decodes its
+        segments from their first frame on and renders them against that same anchor, so the frames are those
+        of the serial render. finished segments are recorded in the manifest (a rerun only renders the missing
+        ones) and joined with the concat demuxer, without re-encoding
+        """
+        cfg = self.cfg
+        selector = selector if selector is not None else self.get_frame_selector(video_path, cfg)
+        info = probe_video(video_path)
+        selected = selector.selected_indices(info['n_frames'])
+        if not selected:
+            raise ValueError(f'no driving frame selected in {video_path}')
+        n_workers = cfg.render_workers
+        segments = plan_segments(selected, probe_keyframes(video_path, fps=selector.src_fps),
+                                 min(n_workers * cfg.segments_per_worker, len(selected)))
+        key = job_key(file_signature(image_path), file_signature(video_path), list(output_modes),
+                      {field: getattr(cfg, field, None) for field in RENDER_KEY_FIELDS}, segments, 'parallel')
+        job_dir = f'{wfp_prefix}.parts'
+        manifest = RenderManifest.open(job_dir, key, 0, output_modes)
+
+        if not manifest.has_state():
+            # only the first selected frame is decoded, ffmpeg stops after it
+            first_frame = load_video_frames(video_path, sizes=[tuple(cfg.input_shape)], threads=cfg.decoder_threads,
+                                            selector=selector, max_frames=1)[0][0]
+            driving = DrivingState(
+                anchor=self.get_motion_anchor(self.prepare_driving_videos([first_frame], single_image=False)[0]))
+            manifest.save_state(**source.to_dict(), **driving.to_dict())
+
+        if not manifest.complete:
+            job = {
+                'video_path': video_path,
+                'job_dir': job_dir,
+                'output_modes': list(output_modes),
+                'selector': selector.kwargs,
+            }
+            pending = [(index, start, end) for index, (start, end) in enumerate(segments)
+                       if index not in manifest.completed()]
+            log(f'Render {len(pending)}/{len(segments)} segments of {len(selected)} frames on {n_workers} processes')
+            if progress_callback is not None:
+                progress_callback(sum(chunk['end'] - chunk['start'] for chunk in manifest.chunks))
+            with get_render_pool(cfg, n_workers) as pool:
+                futures = {
+                    pool.submit(render_segment, job, index, selected[start] - selector.first_frame,
+                                end - start if end < len(selected) else None): (index, start, end)
+                    for index, start, end in pending
+                }
+                for future in tqdm(as_completed(futures), desc='Rendering segments...', total=len(futures)):
+                    n_rendered = future.result()
+                    index, start, _ = futures[future]
+                    manifest.add_chunk(index, start, start + n_rendered)
+                    if progress_callback is not None:
+                        progress_callback(n_rendered)
+            manifest.mark_complete()
+
+        for mode in output_modes:
+            concat_segments(manifest.segments(mode), self.output_path(wfp_prefix, mode), audio_fp=audio_fp,
+                            audio_start=selector.start, audio_duration=selector.duration)
+        if not cfg.flag_keep_segments:
+            shutil.rmtree(job_dir)
+
+    def open_video_writers(self, wfps, audio_fp=None, selector=None):
+        """ {mode: writer} of {mode: path}, the writers already open are closed when one of them fails to open
+        """
+        with ExitStack() as stack:
+            writers = {}
+            for mode, wfp in wfps.items():
+                writers[mode] = self.open_video_writer(wfp, audio_fp=audio_fp, selector=selector)
+                stack.callback(writers[mode].close)
+            stack.pop_all()
+        return writers
+
+    def open_video_writer(self, wfp, audio_fp=None, selector=None):
+        """
+        selector: FrameSelector of the driving frames, the output is written at their frame rate
+        and the audio is trimmed to their time range
+        shm://name: a lossless shared-memory ring the frames are streamed to
+        """
+        if is_shared_frames(wfp):
+            return SharedFrameWriter(wfp, n_slots=self.cfg.shm_slots, lossless=True, timeout=self.cfg.shm_timeout_s)
+        if selector is None:
+            return StreamingVideoWriter(wfp, fps=self.cfg.output_fps, audio_fp=audio_fp, crf=self.cfg.crf,
+                                        preset=self.cfg.encoder_preset, tune=self.cfg.encoder_tune)
+        return StreamingVideoWriter(wfp, fps=selector.output_fps, audio_fp=audio_fp, audio_start=selector.start,
+                                    audio_duration=selector.duration, crf=self.cfg.crf,
+                                    preset=self.cfg.encoder_preset, tune=self.cfg.encoder_tune)
@@ -0,0 +1,107 @@
+import os
+import multiprocessing
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from dataclasses import fields
+
+from LivePortrait.commons import Config, PortraitController
+from LivePortrait.commons.states import SourceState, DrivingState
+from LivePortrait.utils import FFmpegVideoReader, FrameSelector
+from LivePortrait.utils.manifest import RenderManifest
+
+# per-process state of a render worker: the pipeline, and the states of the job it last rendered
+_worker = {}
+
+
+def config_values(cfg) -> dict:
+    """ the fields of a Config, what a spawned process needs to rebuild it
+    """
+    return {f.name: getattr(cfg, f.name) for f in fields(Config) if f.init}
+
+
+def plan_segments(selected, keyframes, n_segments):
+    """ split the selected frames into n_segments runs whose first frame is the closest to a keyframe,
+    so that a worker seeking to it decodes (almost) nothing it drops
+    selected: sorted source frame indices of the rendered frames
+    keyframes: source frame indices of the keyframes, empty splits evenly
+    return: [(start, end)] ranges of positions in selected
+    """
+    keyframes = np.asarray(keyframes, dtype=np.int64)
+    bounds = [0]
+    for k in range(1, max(n_segments, 1)):
+        frame = selected[len(selected) * k // n_segments]
+        if len(keyframes):
+            frame = keyframes[np.abs(keyframes - frame).argmin()]
+        position = bisect_left(selected, frame)
+        if bounds[-1] < position < len(selected):
+            bounds.append(position)
+    bounds.append(len(selected))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _init_worker(cfg_values):
+    from LivePortrait.fast_live_portrait_pipeline import LivePortraitONNX
+
+    _worker['live_portrait'] = LivePortraitONNX(Config(**cfg_values))
+
+
+def get_render_pool(cfg, n_workers) -> ProcessPoolExecutor:
+    """ spawned processes (forking would share onnxruntime/CUDA state), each one loads its own models,
+    onnxruntime threads are split between them unless cfg.ort_intra_op_threads is set
+    """
+    cfg_values = config_values(cfg)
+    if cfg_values['ort_intra_op_threads'] <= 0:
+        cfg_values['ort_intra_op_threads'] = max((os.cpu_count() or 1) // n_workers, 1)
+    return ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker, initargs=(cfg_values,))
+
+
+def _job_source(job, live_portrait):
+    """ source and driving states of the job stored by the coordinator, loaded once per process
+    """
+    if _worker.get('job_dir') != job['job_dir']:
+        cfg = live_portrait.cfg
+        state = RenderManifest(job['job_dir'], None, 0, job['output_modes']).load_state()
+        source = SourceState.from_dict(state, f_s=live_portrait.prepare_feature_3d(live_portrait.model_sessions(),
+                                                                                   state['f_s']))
+        compositor = None
+        if 'pasted' in job['output_modes']:
+            compositor = live_portrait.prepare_compositor(cfg.mask_crop, state['M_c2o'], state['img_rgb'],
+                                                          use_remap=cfg.flag_remap_paste_back,
+                                                          num_threads=cfg.paste_back_threads)
+        _worker.update(job_dir=job['job_dir'], source=source, compositor=compositor,
+                       anchor=DrivingState.from_dict(state).anchor)
+    return _worker['source'], _worker['compositor'], DrivingState(anchor=_worker['anchor'])
+
+
+def render_segment(job, index, offset, n_frames):
+    """ render one segment in a worker process
+    offset: first source frame of the segment, counted from the first frame of the selection
+    n_frames: number of selected frames of the segment, None runs to the end of the selection
+    return: number of rendered frames
+    """
+    live_portrait = _worker['live_portrait']
+    cfg = live_portrait.cfg
+    source, compositor, driving = _job_source(job, live_portrait)
+    selector = FrameSelector(**job['selector'])
+    output_modes = job['output_modes']
+
+    chunk = []
+    sizes = PortraitController.driving_sizes(cfg, 'concat' in output_modes)
+    # ffmpeg stops by itself at the end of the segment
+    for frames in FFmpegVideoReader(job['video_path'], sizes=sizes, threads=cfg.decoder_threads, selector=selector,
+                                    offset=offset, max_frames=n_frames):
+        chunk.append(frames if isinstance(frames, tuple) else (frames,))
+    if not chunk:
+        raise RuntimeError(f'segment {index} of {job["video_path"]} has no frame at offset {offset}')
+
+    driving_rgb_lst, driving_rgb_lst_256 = PortraitController.split_chunk(chunk)
+    i_d_lst, eye_ratio_lst, lip_ratio_lst = live_portrait.process_driving_frames(driving_rgb_lst, driving_rgb_lst_256,
+                                                                                 cfg, live_portrait.cropper)
+    manifest = RenderManifest(job['job_dir'], None, 0, output_modes)
+    writers = live_portrait.open_video_writers({mode: manifest.segment_path(mode, index) for mode in output_modes},
+                                               selector=selector)
+    live_portrait.render_frames(source, compositor, driving, driving_rgb_lst, i_d_lst, eye_ratio_lst, lip_ratio_lst,
+                                writers)
+    return len(chunk)
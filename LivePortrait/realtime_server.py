@@ -0,0 +1,302 @@
+""" websocket server animating the webcam frames of remote clients
+
+protocol, every binary message is a header followed by an image:
+  client -> server  HEADER (kind, seq, client_time) + image
+                    kind SOURCE: the source image (any format OpenCV decodes), answered by a text message
+                    {"type": "source", "ok": true, "ms": ...} or {"type": "error", "message": ...}
+                    kind FRAME: a JPEG driving frame
+                    kind MOTION: a MotionPacket instead of an image, the motion of a frame extracted by the edge
+                    (motion-only transport, see commons.motion_stream), played out through a jitter buffer
+  server -> client  RESULT_HEADER (kind, seq, client_time, wait_ms, decode_ms, render_ms, encode_ms) + JPEG
+                    kind RESULT: the rendered frame of driving frame seq, client_time is echoed back
+                    (for a motion packet: wait is its time in the jitter buffer, decode the packet decoding)
+                    kind DROPPED: no image, the frame was skipped (replaced by a newer one or past its deadline)
+  text messages     {"type": "config", "paste_back": bool, "quality": int} options of the connection
+                    {"type": "stats"} answered by {"type": "stats", "server": {...}, "connection": {...}}
+a malformed message is answered by {"type": "error", "message": ...}, the connection stays open
+"""
+import json
+import time
+import struct
+import asyncio
+import cv2
+import numpy as np
+import websockets
+
+from LivePortrait.commons import Config
+from LivePortrait.commons.states import DrivingState
+from LivePortrait.commons.scheduling import REALTIME, DeadlineMissed, work_priority
+from LivePortrait.commons.motion_stream import MotionPacket, JitterBuffer
+from LivePortrait.async_pipeline import AsyncLivePortrait
+from LivePortrait.utils.timer import LatencyStats
+
+HEADER = struct.Struct('<BId')
+RESULT_HEADER = struct.Struct('<BId4f')
+SOURCE, FRAME, RESULT, DROPPED, MOTION = 1, 2, 3, 4, 5
+MAX_MESSAGE_SIZE = 16 * 2 ** 20  # source images can be large
+
+
+def decode_image(payload) -> np.ndarray:
+    img = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError('the image could not be decoded')
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def encode_jpeg(img_rgb, quality) -> bytes:
+    ok, buf = cv2.imencode('.jpg', cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buf.tobytes()
+
+
+class StreamConnection:
+    """ state of one client: its source, its motion anchor, its compositor and the frame waiting to be rendered
+    only the latest driving frame is kept, a frame arriving while another one waits replaces it.
+    motion packets wait in a jitter buffer until they are due
+    """
+
+    def __init__(self, cfg):
+        self.source = None
+        self.driving = DrivingState()
+        self.compositor = None
+        self.paste_back = False
+        self.quality = cfg.ws_jpeg_quality
+        self.pending = None  # (seq, client_time, payload, time received)
+        self.ready = asyncio.Event()
+        self.jitter = JitterBuffer(cfg.jitter_min_delay_ms, cfg.jitter_max_delay_ms)
+        self.motion_ready = asyncio.Event()
+        self.counts = {'received': 0, 'rendered': 0, 'dropped': 0, 'bytes': 0}
+
+    def offer(self, frame):
+        """ make frame the next one to render, return the frame it replaces (None if there was none)
+        """
+        replaced, self.pending = self.pending, frame
+        self.counts['received'] += 1
+        self.ready.set()
+        return replaced
+
+    def take(self):
+        frame, self.pending = self.pending, None
+        self.ready.clear()
+        return frame
+
+
+class RealtimeServer:
+    """ renders the driving frames of every connection on one shared engine
+    JPEG decoding, inference and encoding run on the executor of an AsyncLivePortrait, the event loop only moves
+    bytes. with cfg.flag_scheduling frames are real-time work with a deadline cfg.realtime_deadline_ms after they
+    were received, they go before batch work sharing the engine and are dropped when stale
+    """
+
+    def __init__(self, front: AsyncLivePortrait = None, cfg=Config):
+        self.front = front if front is not None else AsyncLivePortrait(cfg=cfg)
+        self.cfg = self.front.engine.cfg
+        self.latency = LatencyStats()
+        self.n_connections = 0
+
+    async def handler(self, websocket, *_):
+        conn = StreamConnection(self.cfg)
+        self.n_connections += 1
+        tasks = [asyncio.create_task(self.render_loop(websocket, conn)),
+                 asyncio.create_task(self.playout_loop(websocket, conn))]
+        try:
+            async for message in websocket:
+                try:
+                    if isinstance(message, str):
+                        await self.on_text(websocket, conn, message)
+                    else:
+                        await self.on_binary(websocket, conn, message)
+                except ValueError as e:
+                    await websocket.send(json.dumps({'type': 'error', 'message': str(e)}))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.n_connections -= 1
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def on_text(self, websocket, conn: StreamConnection, text):
+        """ raise: ValueError on a malformed message
+        """
+        message = json.loads(text)
+        if not isinstance(message, dict):
+            raise ValueError('a text message is a JSON object')
+        if message.get('type') == 'config':
+            try:
+                quality = int(message.get('quality', conn.quality))
+            except (TypeError, ValueError):
+                raise ValueError(f'quality {message["quality"]!r} is not an integer') from None
+            if not 1 <= quality <= 100:
+                raise ValueError(f'quality {quality} is not in [1, 100]')
+            conn.paste_back = bool(message.get('paste_back', conn.paste_back))
+            conn.quality = quality
+            if conn.source is not None:
+                await self.prepare_compositor(conn)
+        elif message.get('type') == 'stats':
+            await websocket.send(json.dumps({'type': 'stats', 'server': self.latency.summary(),
+                                             'connection': dict(conn.counts), 'jitter': conn.jitter.stats(),
+                                             'connections': self.n_connections}))
+        else:
+            raise ValueError(f'unknown message type {message.get("type")!r}')
+
+    async def on_binary(self, websocket, conn: StreamConnection, message):
+        """ raise: ValueError on a malformed message
+        """
+        if len(message) < HEADER.size:
+            raise ValueError(f'binary message of {len(message)} bytes, shorter than its {HEADER.size} bytes header')
+        kind, seq, client_time = HEADER.unpack_from(message)
+        if kind not in (SOURCE, FRAME, MOTION):
+            raise ValueError(f'unknown message kind {kind}')
+        payload = message[HEADER.size:]
+        conn.counts['bytes'] += len(message)
+        if kind == SOURCE:
+            t0 = time.perf_counter()
+            try:
+                img_rgb = await self.front.run(decode_image, payload)
+                conn.source = await self.front.run(self.front.engine.prepare_source_rgb, img_rgb)
+            except Exception as e:
+                await websocket.send(json.dumps({'type': 'error', 'message': f'source: {e}'}))
+                return
+            # a new source starts a new animation, relative to the next driving frame
+            conn.driving = DrivingState()
+            await self.prepare_compositor(conn)
+            await websocket.send(json.dumps({'type': 'source', 'ok': True, 'ms': (time.perf_counter() - t0) * 1000.}))
+        elif kind == FRAME:
+            replaced = conn.offer((seq, client_time, payload, time.perf_counter()))
+            if replaced is not None:
+                await self.send_dropped(websocket, conn, replaced)
+        elif kind == MOTION:
+            t0 = time.perf_counter()
+            try:
+                packet = MotionPacket.decode(payload)
+            except ValueError as e:
+                await websocket.send(json.dumps({'type': 'error', 'message': f'motion {seq}: {e}'}))
+                await self.send_dropped(websocket, conn, (seq, client_time, None, t0))
+                return
+            conn.counts['received'] += 1
+            if packet.anchor and packet.seq == 0:
+                conn.jitter.reset()  # the edge restarted its stream
+            frame = (seq, client_time, packet, t0, time.perf_counter() - t0)
+            if conn.jitter.push(packet.seq, packet.timestamp, frame, t0):
+                conn.motion_ready.set()
+            else:
+                await self.send_dropped(websocket, conn, frame)
+
+    async def prepare_compositor(self, conn: StreamConnection):
+        conn.compositor = None
+        if conn.paste_back:
+            cfg = self.cfg
+            conn.compositor = await self.front.run(self.front.engine.prepare_compositor, cfg.mask_crop,
+                                                   conn.source.crop_info['M_c2o'], conn.source.img_rgb,
+                                                   use_remap=cfg.flag_remap_paste_back,
+                                                   num_threads=cfg.paste_back_threads)
+
+    async def send_dropped(self, websocket, conn: StreamConnection, frame):
+        seq, client_time = frame[:2]
+        conn.counts['dropped'] += 1
+        await websocket.send(RESULT_HEADER.pack(DROPPED, seq, client_time, 0., 0., 0., 0.))
+
+    async def drop_motion(self, websocket, conn: StreamConnection, frame):
+        """ send_dropped for a motion packet, a dropped anchor makes the next packet rendered the anchor instead
+        """
+        if frame[2].anchor:
+            conn.driving.anchor = None
+        await self.send_dropped(websocket, conn, frame)
+
+    async def render_loop(self, websocket, conn: StreamConnection):
+        while True:
+            await conn.ready.wait()
+            frame = conn.take()
+            if frame is None:
+                continue
+            if conn.source is None:
+                await self.send_dropped(websocket, conn, frame)
+                continue
+            seq, client_time, payload, received = frame
+            t0 = time.perf_counter()
+            try:
+                img_rgb = await self.front.run(decode_image, payload)
+                t1 = time.perf_counter()
+                result = await self.front.run(self.render_frame, conn, img_rgb,
+                                              received + self.cfg.realtime_deadline_ms / 1000.)
+            except DeadlineMissed:
+                await self.send_dropped(websocket, conn, frame)
+                continue
+            except Exception as e:
+                await websocket.send(json.dumps({'type': 'error', 'message': f'frame {seq}: {e}'}))
+                await self.send_dropped(websocket, conn, frame)
+                continue
+            t2 = time.perf_counter()
+            jpeg = await self.front.run(encode_jpeg, result, conn.quality)
+            t3 = time.perf_counter()
+            timings = (t0 - received, t1 - t0, t2 - t1, t3 - t2)
+            for stage, seconds in zip(('wait', 'decode', 'render', 'encode'), timings):
+                self.latency.add(stage, seconds)
+            self.latency.add('total', t3 - received)
+            conn.counts['rendered'] += 1
+            await websocket.send(RESULT_HEADER.pack(RESULT, seq, client_time, *(t * 1000. for t in timings)) + jpeg)
+
+    async def playout_loop(self, websocket, conn: StreamConnection):
+        """ renders the motion packets of the connection when the jitter buffer makes them due, the packets due
+        while the previous one was rendered are dropped but the last (the motion restarts from it if one of them was
+        an anchor)
+        """
+        while True:
+            conn.motion_ready.clear()
+            wait = conn.jitter.wait_time()
+            if wait is None or wait > 0:
+                try:
+                    await asyncio.wait_for(conn.motion_ready.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            due = conn.jitter.pop_due()
+            for frame in due[:-1]:
+                await self.drop_motion(websocket, conn, frame)
+            frame = due[-1]
+            if conn.source is None:
+                await self.drop_motion(websocket, conn, frame)
+                continue
+            seq, client_time, packet, received, decode = frame
+            t0 = time.perf_counter()
+            try:
+                result = await self.front.run(self.render_motion, conn, packet,
+                                              t0 + self.cfg.realtime_deadline_ms / 1000.)
+            except DeadlineMissed:
+                await self.drop_motion(websocket, conn, frame)
+                continue
+            except Exception as e:
+                await websocket.send(json.dumps({'type': 'error', 'message': f'motion {seq}: {e}'}))
+                await self.drop_motion(websocket, conn, frame)
+                continue
+            t1 = time.perf_counter()
+            jpeg = await self.front.run(encode_jpeg, result, conn.quality)
+            t2 = time.perf_counter()
+            timings = (t0 - received - decode, decode, t1 - t0, t2 - t1)
+            for stage, seconds in zip(('jitter', 'decode_motion', 'render', 'encode'), timings):
+                self.latency.add(stage, seconds)
+            self.latency.add('total', t2 - received)
+            conn.counts['rendered'] += 1
+            await websocket.send(RESULT_HEADER.pack(RESULT, seq, client_time, *(t * 1000. for t in timings)) + jpeg)
+
+    def render_motion(self, conn: StreamConnection, packet: MotionPacket, deadline):
+        """ blocking: the animated (or pasted back) frame of one motion packet of the connection
+        """
+        engine = self.front.engine
+        with work_priority(REALTIME, deadline):
+            if conn.compositor is None:
+                return engine.animate_motion(conn.source, conn.driving, [packet])[0]
+            i_p_paste_lst = []
+            engine.animate_motion(conn.source, conn.driving, [packet], conn.compositor, i_p_paste_lst,
+                                  keep_crop=False)
+            return i_p_paste_lst[0]
+
+    def render_frame(self, conn: StreamConnection, img_rgb, deadline):
+        """ blocking: the animated (or pasted back) frame of one driving frame of the connection
+        """
+        with work_priority(REALTIME, deadline):
+            return self.front.animate_chunk(conn.source, conn.driving, conn.compositor, ([img_rgb], None))[0]
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        async with websockets.serve(self.handler, host, port, max_size=MAX_MESSAGE_SIZE):
+            await asyncio.Future()
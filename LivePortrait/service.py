@@ -0,0 +1,310 @@
+import os
+import os.path as osp
+import re
+import json
+import time
+import uuid
+import shutil
+import math
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.responses import FileResponse, StreamingResponse
+
+from LivePortrait.commons import Config
+from LivePortrait.fast_live_portrait_pipeline import LivePortraitONNX
+from LivePortrait.utils.timer import LatencyStats
+from LivePortrait.admission import AdmissionController, AdmissionDecision, AdmissionRejected, JobTooLarge, driving_info
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.webm')
+EVENTS_INTERVAL_RANGE = (0.05, 10.)  # seconds between two polls of a job by /jobs/{job_id}/events
+
+
+class RenderJob:
+    """ one render of the service, updated by the worker thread and read by the request handlers
+    """
+
+    def __init__(self, job_id, job_dir, source_path, driving_path, output_modes, options):
+        self.id = job_id
+        self.dir = job_dir
+        self.source_path = source_path
+        self.driving_path = driving_path
+        self.output_modes = output_modes
+        self.options = options  # Config fields of this job, see LivePortraitONNX.with_options
+        self.status = 'queued'  # queued, running, done or failed
+        self.n_frames = None  # driving frames to render, None while unknown
+        self.frames_done = 0
+        self.outputs = {}  # {mode: path}
+        self.error = None
+        self.timings = {}  # seconds spent queued and rendering
+        self.admission: Optional[AdmissionDecision] = None
+        self.submitted = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def advance(self, n_frames):
+        with self.lock:
+            self.frames_done += n_frames
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'id': self.id,
+                'status': self.status,
+                'n_frames': self.n_frames,
+                'frames_done': self.frames_done,
+                'progress': min(self.frames_done / self.n_frames, 1.) if self.n_frames else None,
+                'output_modes': list(self.output_modes),
+                'outputs': {mode: f'/jobs/{self.id}/outputs/{mode}' for mode in self.outputs},
+                'error': self.error,
+                'timings': dict(self.timings),
+                'admission': self.admission.to_dict() if self.admission is not None else None,
+            }
+
+
+class RenderService:
+    """ renders jobs on one warm LivePortraitONNX: the sessions and the cropper are loaded once, when the service
+    starts, every job uses them through with_options() with its own driving options.
+    jobs run on cfg.service_workers threads, the others wait in the queue of the pool, new jobs go through
+    admission control (see AdmissionController)
+    """
+
+    def __init__(self, live_portrait: LivePortraitONNX = None, cfg=Config, work_dir=None, templates_dir=None,
+                 n_workers=None):
+        self.live_portrait = live_portrait if live_portrait is not None else LivePortraitONNX(cfg)
+        if n_workers is not None:
+            self.live_portrait = self.live_portrait.with_options(service_workers=n_workers)
+        cfg = self.live_portrait.cfg
+        self.work_dir = work_dir or cfg.service_dir
+        self.templates_dir = templates_dir or cfg.service_templates_dir
+        self.jobs = {}
+        self.executor = ThreadPoolExecutor(max_workers=cfg.service_workers, thread_name_prefix='render_job')
+        self.admission = AdmissionController(self.live_portrait)
+        self.admission_counts = {}  # {action or 'reject': n}
+        self.lock = threading.Lock()
+        self.endpoint_latency = LatencyStats()
+        self.job_latency = LatencyStats()
+        os.makedirs(self.work_dir, exist_ok=True)
+
+    def templates(self):
+        """ names of the driving videos (or frame directories) in the templates directory
+        """
+        if not osp.isdir(self.templates_dir):
+            return []
+        return sorted(name for name in os.listdir(self.templates_dir)
+                      if osp.isdir(osp.join(self.templates_dir, name)) or name.lower().endswith(VIDEO_EXTENSIONS))
+
+    def template_path(self, name):
+        for template in self.templates():
+            if name in (template, osp.splitext(template)[0]):
+                return osp.join(self.templates_dir, template)
+        raise KeyError(name)
+
+    def new_job_dir(self):
+        job_id = uuid.uuid4().hex[:12]
+        job_dir = osp.join(self.work_dir, job_id)
+        os.makedirs(job_dir)
+        return job_id, job_dir
+
+    def submit(self, job_id, job_dir, source_path, driving_path, output_modes=None, allow_downgrade=True,
+               **options) -> RenderJob:
+        """ queue a render of source_path driven by driving_path
+        options: Config fields of the job (driving_start, driving_fps, ...)
+        allow_downgrade: admission control may turn retargeting off or render the crop output only
+        raise: AdmissionRejected when the service is over its budgets, JobTooLarge when it can never take the job,
+        ValueError on options or a driving video it can't use
+        """
+        live_portrait = self.live_portrait.with_options(**options)
+        output_modes = live_portrait.get_output_modes(output_modes)
+        try:
+            n_frames, frame_size = driving_info(driving_path, live_portrait.cfg)
+        except Exception as e:
+            # e.g. an upload that is not a video, ffprobe fails or finds no video stream
+            raise ValueError(f'can not read the driving video: {type(e).__name__}: {e}') from e
+        if n_frames <= 0:
+            raise ValueError('no frame in the driving video')
+        selector = live_portrait.get_frame_selector(driving_path, live_portrait.cfg)
+        n_frames = len(selector.selected_indices(n_frames))
+        with self.lock:
+            # decisions are serialized, every one sees the backlog of the jobs admitted before it
+            try:
+                decision = self.admission.decide(options, output_modes, n_frames, frame_size,
+                                                 list(self.jobs.values()), allow_downgrade=allow_downgrade)
+            except AdmissionRejected:
+                self.admission_counts['reject'] = self.admission_counts.get('reject', 0) + 1
+                raise
+            self.admission_counts[decision.action] = self.admission_counts.get(decision.action, 0) + 1
+            job = RenderJob(job_id, job_dir, source_path, driving_path, decision.output_modes, decision.options)
+            job.n_frames = n_frames
+            job.admission = decision
+            self.jobs[job_id] = job
+        self.executor.submit(self.run_job, job)
+        return job
+
+    def run_job(self, job: RenderJob):
+        t0 = time.perf_counter()
+        with job.lock:
+            job.status = 'running'
+            job.timings['queued'] = t0 - job.submitted
+        self.job_latency.add('queued', t0 - job.submitted)
+        live_portrait = self.live_portrait.with_options(**job.options)
+        try:
+            wfp_prefix = osp.join(job.dir, 'output')
+            live_portrait.render(video_path_or_id=job.driving_path, image_path=job.source_path,
+                                 output_modes=job.output_modes, wfp_prefix=wfp_prefix, progress_callback=job.advance)
+            with job.lock:
+                job.outputs = {mode: live_portrait.output_path(wfp_prefix, mode) for mode in job.output_modes}
+                job.status = 'done'
+        except Exception as e:
+            with job.lock:
+                job.error = f'{type(e).__name__}: {e}'
+                job.status = 'failed'
+        finally:
+            elapsed = time.perf_counter() - t0
+            with job.lock:
+                job.timings['render'] = elapsed
+            self.job_latency.add(f'render.{job.status}', elapsed)
+
+    def get_job(self, job_id) -> RenderJob:
+        if job_id not in self.jobs:
+            raise HTTPException(status_code=404, detail=f'unknown job {job_id}')
+        return self.jobs[job_id]
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _save_upload(upload: UploadFile, job_dir, name):
+    """ the uploaded file as job_dir/name with the extension of the upload
+    """
+    ext = osp.splitext(upload.filename or '')[1].lower()
+    fp = osp.join(job_dir, name + (ext if re.fullmatch(r'\.[a-z0-9]{1,5}', ext) else ''))
+    with open(fp, 'wb') as f:
+        shutil.copyfileobj(upload.file, f)
+    return fp
+
+
+def create_app(service: RenderService = None, **kwargs) -> FastAPI:
+    """ the HTTP API of a RenderService, a new one is created with kwargs (and its models loaded) at startup
+    POST /jobs               multipart: source, driving (file) or template (name), output_modes, start, end,
+                             stride, fps, allow_downgrade. 503 with Retry-After when admission control rejects it
+                             for the load, 413 when the job can never fit the node
+    GET  /jobs/{id}          status, progress and timings of a job
+    GET  /jobs/{id}/events   the same as server-sent events, one per change, until the job is done or failed
+    GET  /jobs/{id}/outputs/{mode}
+    GET  /templates, /metrics, /health
+    """
+    state = {'service': service}
+
+    @asynccontextmanager
+    async def lifespan(app):
+        if state['service'] is None:
+            state['service'] = RenderService(**kwargs)
+        yield
+        state['service'].close()
+
+    app = FastAPI(title='Efficient Live Portrait', lifespan=lifespan)
+
+    def get_service() -> RenderService:
+        return state['service']
+
+    @app.middleware('http')
+    async def record_latency(request: Request, call_next):
+        # streamed responses are timed until their headers are sent
+        t0 = time.perf_counter()
+        response = await call_next(request)
+        route = request.scope.get('route')
+        key = f'{request.method} {route.path if route is not None else "unmatched"}'
+        get_service().endpoint_latency.add(key, time.perf_counter() - t0)
+        return response
+
+    @app.get('/health')
+    def health():
+        statuses = [job.status for job in get_service().jobs.values()]
+        return {'status': 'ok', 'jobs': {status: statuses.count(status) for status in set(statuses)}}
+
+    @app.get('/templates')
+    def templates():
+        return get_service().templates()
+
+    @app.post('/jobs', status_code=201)
+    def submit_job(source: UploadFile = File(...), driving: Optional[UploadFile] = File(None),
+                   template: Optional[str] = Form(None), output_modes: Optional[str] = Form(None),
+                   start: float = Form(0.), end: Optional[float] = Form(None), stride: int = Form(1),
+                   fps: Optional[float] = Form(None), allow_downgrade: bool = Form(True)):
+        service = get_service()
+        if (driving is None) == (template is None):
+            raise HTTPException(status_code=400, detail='give either a driving video or a template')
+        if template is not None:
+            try:
+                driving_path = service.template_path(template)
+            except KeyError:
+                raise HTTPException(status_code=404, detail=f'unknown template {template}')
+        job_id, job_dir = service.new_job_dir()
+        source_path = _save_upload(source, job_dir, 'source')
+        if driving is not None:
+            driving_path = _save_upload(driving, job_dir, 'driving')
+        try:
+            job = service.submit(job_id, job_dir, source_path, driving_path,
+                                 output_modes=output_modes.replace(',', ' ').split() if output_modes else None,
+                                 allow_downgrade=allow_downgrade, driving_start=start, driving_end=end,
+                                 driving_stride=stride, driving_fps=fps)
+        except JobTooLarge as e:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise HTTPException(status_code=413, detail=e.reason)
+        except AdmissionRejected as e:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            headers = {'Retry-After': str(math.ceil(e.retry_after))} if e.retry_after is not None else None
+            raise HTTPException(status_code=503, detail=e.reason, headers=headers)
+        except ValueError as e:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise HTTPException(status_code=400, detail=str(e))
+        return job.to_dict()
+
+    @app.get('/jobs')
+    def list_jobs():
+        return [job.to_dict() for job in get_service().jobs.values()]
+
+    @app.get('/jobs/{job_id}')
+    def get_job(job_id: str):
+        return get_service().get_job(job_id).to_dict()
+
+    @app.get('/jobs/{job_id}/events')
+    async def job_events(job_id: str, interval: float = 0.5):
+        job = get_service().get_job(job_id)
+        # a zero, negative or nan interval would busy-loop the event loop, an infinite one never report again
+        min_interval, max_interval = EVENTS_INTERVAL_RANGE
+        interval = min(interval, max_interval) if interval >= min_interval else min_interval
+
+        async def events():
+            last = None
+            while True:
+                data = job.to_dict()
+                if data != last:
+                    yield f'data: {json.dumps(data)}\n\n'
+                    last = data
+                if data['status'] in ('done', 'failed'):
+                    return
+                await asyncio.sleep(interval)
+
+        return StreamingResponse(events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    @app.get('/jobs/{job_id}/outputs/{mode}')
+    def get_output(job_id: str, mode: str):
+        job = get_service().get_job(job_id)
+        if mode not in job.outputs:
+            raise HTTPException(status_code=404, detail=f'job {job_id} has no {mode} output (status {job.status})')
+        return FileResponse(job.outputs[mode], media_type='video/mp4', filename=f'{job_id}_{mode}.mp4')
+
+    @app.get('/metrics')
+    def metrics():
+        service = get_service()
+        return {'endpoints': service.endpoint_latency.summary(), 'jobs': service.job_latency.summary(),
+                'batching': service.live_portrait.batching_stats(),
+                'scheduling': service.live_portrait.scheduler_stats(),
+                'stages': service.live_portrait.stage_latency.summary(),
+                'admission': dict(service.admission_counts)}
+
+    return app
@@ -7,6 +7,7 @@ cropping function and the related preprocess functions for cropping
 import numpy as np
 import os.path as osp
 from math import sin, cos, acos, degrees
+from concurrent.futures import ThreadPoolExecutor
 import cv2; cv2.setNumThreads(0); cv2.ocl.setUseOpenCL(False) # NOTE: enforce single thread
 from .rprint import rprint as print
 
@@ -388,6 +389,190 @@ def crop_image(img, pts: np.ndarray, **kwargs):
 
     return ret_dct
 
+# (left eye, right eye, lip) landmark indices used by parse_pt2_from_ptX, keyed by the number of points
+PT2_INDICES = {
+    101: ([39, 42, 45, 48], [51, 54, 57, 60], [75, 81]),
+    106: ([33, 35, 40, 39], [87, 89, 94, 93], [52, 61]),
+    203: ([0, 6, 12, 18], [24, 30, 36, 42], [48, 66]),
+    68: ([36, 39], [42, 45], [48, 54]),
+    5: ([0], [1], [3, 4]),
+}
+
+
+def parse_pt2_from_pt_x_batch(pts, use_lip=True):
+    """ batched parse_pt2_from_pt_x
+    pts: TxNx2
+    return: Tx2x2
+    """
+    n = pts.shape[1]
+    if n not in PT2_INDICES:
+        if n > 101:
+            # take the first 101 points
+            pts, n = pts[:, :101], 101
+        else:
+            raise Exception(f'Unknow shape: {pts.shape}')
+    idx_left, idx_right, idx_lip = PT2_INDICES[n]
+    pt_left_eye = pts[:, idx_left].mean(axis=1)
+    pt_right_eye = pts[:, idx_right].mean(axis=1)
+    if use_lip:
+        pt_center_eye = (pt_left_eye + pt_right_eye) / 2
+        pt_center_lip = pts[:, idx_lip].mean(axis=1)
+        pt2 = np.stack([pt_center_eye, pt_center_lip], axis=1)
+    else:
+        pt2 = np.stack([pt_left_eye, pt_right_eye], axis=1)
+        # NOTE: rotate the pt2 90 degrees clockwise, same as parse_pt2_from_pt_x
+        v = pt2[:, 1] - pt2[:, 0]
+        pt2[:, 1, 0] = pt2[:, 0, 0] - v[:, 1]
+        pt2[:, 1, 1] = pt2[:, 0, 1] + v[:, 0]
+    return pt2
+
+
+def parse_rect_from_landmark_batch(
+    pts,
+    scale=1.5,
+    need_square=True,
+    vx_ratio=0,
+    vy_ratio=0,
+    use_deg_flag=False,
+    **kwargs
+):
+    """batched parse_rect_from_landmark
+    pts: TxNx2 landmarks
+    return: center Tx2, size Tx2, angle T
+    """
+    pts = np.asarray(pts, dtype=np.float64)
+    pt2 = parse_pt2_from_pt_x_batch(pts, use_lip=kwargs.get('use_lip', True))
+
+    uy = pt2[:, 1] - pt2[:, 0]
+    l = np.linalg.norm(uy, axis=1, keepdims=True)
+    uy = np.where(l <= 1e-3, np.array([[0., 1.]]), uy / np.maximum(l, 1e-3))
+    ux = np.stack([uy[:, 1], -uy[:, 0]], axis=1)
+
+    angle = np.arccos(np.clip(ux[:, 0], -1., 1.))
+    angle = np.where(ux[:, 1] < 0, -angle, angle)
+
+    # rotation matrices, Tx2x2
+    M = np.stack([ux, uy], axis=1)
+
+    center0 = pts.mean(axis=1)
+    rpts = (pts - center0[:, None]) @ M.transpose(0, 2, 1)
+    lt_pt = rpts.min(axis=1)
+    rb_pt = rpts.max(axis=1)
+    center1 = (lt_pt + rb_pt) / 2
+
+    size = rb_pt - lt_pt
+    if need_square:
+        size = np.repeat(size.max(axis=1, keepdims=True), 2, axis=1)
+
+    size *= scale
+    center = center0 + ux * center1[:, 0:1] + uy * center1[:, 1:2]
+    center = center + ux * (vx_ratio * size) + uy * (vy_ratio * size)
+
+    if use_deg_flag:
+        angle = np.degrees(angle)
+
+    return center, size, angle
+
+
+def invert_affine_batch(M):
+    """ closed-form inverse of Tx2x3 (or Tx3x3) affine matrices, instead of np.linalg.inv on each 3x3
+    return: Tx3x3
+    """
+    a, b, tx = M[:, 0, 0], M[:, 0, 1], M[:, 0, 2]
+    c, d, ty = M[:, 1, 0], M[:, 1, 1], M[:, 1, 2]
+    inv_det = 1. / (a * d - b * c)
+    M_inv = np.zeros((M.shape[0], 3, 3), dtype=M.dtype)
+    M_inv[:, 0, 0] = d * inv_det
+    M_inv[:, 0, 1] = -b * inv_det
+    M_inv[:, 1, 0] = -c * inv_det
+    M_inv[:, 1, 1] = a * inv_det
+    M_inv[:, 0, 2] = -(M_inv[:, 0, 0] * tx + M_inv[:, 0, 1] * ty)
+    M_inv[:, 1, 2] = -(M_inv[:, 1, 0] * tx + M_inv[:, 1, 1] * ty)
+    M_inv[:, 2, 2] = 1
+    return M_inv
+
+
+def _estimate_similar_transform_from_pts_batch(
+    pts,
+    dsize,
+    scale=1.5,
+    vx_ratio=0,
+    vy_ratio=-0.1,
+    flag_do_rot=True,
+    **kwargs
+):
+    """ batched _estimate_similar_transform_from_pts
+    pts: TxNx2
+    return: M_INV Tx2x3 (original to crop), M Tx2x3 (crop to original)
+    """
+    center, size, angle = parse_rect_from_landmark_batch(
+        pts, scale=scale, vx_ratio=vx_ratio, vy_ratio=vy_ratio,
+        use_lip=kwargs.get('use_lip', True)
+    )
+
+    s = dsize / size[:, 0]  # scale
+    tcx = tcy = dsize / 2  # center of dsize
+    cx, cy = center[:, 0], center[:, 1]
+
+    M_INV = np.zeros((pts.shape[0], 2, 3), dtype=np.float64)
+    if flag_do_rot:
+        costheta, sintheta = np.cos(angle), np.sin(angle)
+        M_INV[:, 0, 0] = s * costheta
+        M_INV[:, 0, 1] = s * sintheta
+        M_INV[:, 0, 2] = tcx - s * (costheta * cx + sintheta * cy)
+        M_INV[:, 1, 0] = -s * sintheta
+        M_INV[:, 1, 1] = s * costheta
+        M_INV[:, 1, 2] = tcy - s * (-sintheta * cx + costheta * cy)
+    else:
+        M_INV[:, 0, 0] = s
+        M_INV[:, 0, 2] = tcx - s * cx
+        M_INV[:, 1, 1] = s
+        M_INV[:, 1, 2] = tcy - s * cy
+
+    M = invert_affine_batch(M_INV)
+    return M_INV.astype(DTYPE), M[:, :2].astype(DTYPE)
+
+
+def crop_image_batch(imgs, pts: np.ndarray, max_workers=4, **kwargs):
+    """ crop_image on T landmark sets at once, the geometry is computed in one vectorised pass
+    and the warps run on a thread pool (cv2 releases the GIL)
+    imgs: list of T images (e.g. driving frames), one image shared by all the sets (e.g. multi-face source), or None
+    pts: TxNx2
+    """
+    dsize = kwargs.get('dsize', 224)
+    scale = kwargs.get('scale', 1.5)  # 1.5 | 1.6
+    vy_ratio = kwargs.get('vy_ratio', -0.1)  # -0.0625 | -0.1
+
+    pts = np.asarray(pts)
+    M_INV, M = _estimate_similar_transform_from_pts_batch(
+        pts,
+        dsize=dsize,
+        scale=scale,
+        vy_ratio=vy_ratio,
+        flag_do_rot=kwargs.get('flag_do_rot', True),
+    )
+    bottom = np.broadcast_to(np.array([0, 0, 1], dtype=DTYPE), (pts.shape[0], 1, 3))
+    M_o2c = np.concatenate([M_INV, bottom], axis=1)
+    M_c2o = np.concatenate([M, bottom], axis=1)
+
+    if imgs is None:
+        img_crop = None
+    else:
+        if isinstance(imgs, np.ndarray) and imgs.ndim == 3:
+            imgs = [imgs] * pts.shape[0]
+        assert len(imgs) == pts.shape[0], 'one image per landmark set'
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            img_crop = list(executor.map(lambda args: _transform_img(args[0], args[1], dsize), zip(imgs, M_INV)))
+    pt_crop = pts @ M_INV[:, :, :2].transpose(0, 2, 1) + M_INV[:, None, :, 2]
+
+    return {
+        'M_o2c': M_o2c,  # from the original image to the cropped image Tx3x3
+        'M_c2o': M_c2o,  # from the cropped image to the original image Tx3x3
+        'img_crop': img_crop,  # list of the cropped images
+        'pt_crop': pt_crop,  # the landmarks of the cropped images TxNx2
+    }
+
+
 def average_bbox_lst(bbox_lst):
     if len(bbox_lst) == 0:
         return None
@@ -55,15 +55,7 @@ class Cropper(object):
             if hasattr(self.crop_cfg, k):
                 setattr(self.crop_cfg, k, v)
 
-    def crop_single_image(self, obj, **kwargs):
-        direction = kwargs.get('direction', 'large-small')
-
-        # crop and align a single image
-        if isinstance(obj, str):
-            img_rgb = load_image_rgb(obj)
-        elif isinstance(obj, np.ndarray):
-            img_rgb = obj
-
+    def detect_landmark_106(self, img_rgb, direction='large-small'):
         src_face = self.face_analysis_wrapper.get(
             img_rgb,
             flag_do_landmark_2d_106=True,
@@ -77,8 +69,18 @@ class Cropper(object):
         elif len(src_face) > 1:
             log(f'More than one face detected in the image, only pick one face by rule {direction}.')
 
-        src_face = src_face[0]
-        pts = src_face.landmark_2d_106
+        return src_face[0].landmark_2d_106
+
+    def crop_single_image(self, obj, **kwargs):
+        direction = kwargs.get('direction', 'large-small')
+
+        # crop and align a single image
+        if isinstance(obj, str):
+            img_rgb = load_image_rgb(obj)
+        elif isinstance(obj, np.ndarray):
+            img_rgb = obj
+
+        pts = self.detect_landmark_106(img_rgb, direction=direction)
 
         # crop the face
         ret_dct = crop_image(
@@ -100,8 +102,9 @@ class Cropper(object):
 
     def get_retargeting_lmk_info(self, driving_rgb_lst):
         # TODO: implement a tracking-based version
-        driving_lmk_lst = []
-        for driving_image in driving_rgb_lst:
-            ret_dct = self.crop_single_image(driving_image)
-            driving_lmk_lst.append(ret_dct['lmk_crop'])
-        return driving_lmk_lst
+        # only the 203 landmarks are needed, so skip the 512 crops and do the landmark crops in one batched pass
+        pts_lst = [self.detect_landmark_106(driving_image) for driving_image in driving_rgb_lst]
+        if len(pts_lst) == 0:
+            return []
+        recon_ret_lst = self.landmark_runner.run_batch(driving_rgb_lst, pts_lst)
+        return [recon_ret['pts'] for recon_ret in recon_ret_lst]
@@ -10,6 +10,9 @@ from LivePortrait.utils.insightface.app import FaceAnalysis
 from LivePortrait.utils.insightface.app.common import Face
 from .timer import Timer
 
+# the only insightface tasks the cropper needs, recognition/genderage are never loaded
+REQUIRED_TASKS = ('detection', 'landmark_2d_106')
+
 
 def sort_by_direction(faces, direction: str = 'large-small', face_center=None):
     if len(faces) <= 0:
@@ -33,8 +36,8 @@ def sort_by_direction(faces, direction: str = 'large-small', face_center=None):
 
 
 class FaceAnalysisDIY(FaceAnalysis):
-    def __init__(self, name='buffalo_l', root='~/.insightface', allowed_modules=None, **kwargs):
-        super().__init__(name=name, root=root, allowed_modules=allowed_modules, **kwargs)
+    def __init__(self, name='buffalo_l', root='~/.insightface', allowed_modules=REQUIRED_TASKS, lazy=True, **kwargs):
+        super().__init__(name=name, root=root, allowed_modules=allowed_modules, lazy=lazy, **kwargs)
 
         self.timer = Timer()
 
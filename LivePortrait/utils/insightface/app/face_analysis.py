@@ -22,10 +22,33 @@ __all__ = ['FaceAnalysis']
 
 
 class FaceAnalysis:
-    def __init__(self, name=DEFAULT_MP_NAME, root='~/.insightface', allowed_modules=None, **kwargs):
+    def __init__(self, name=DEFAULT_MP_NAME, root='~/.insightface', allowed_modules=None, lazy=False, **kwargs):
         onnxruntime.set_default_logger_severity(3)
         self.models = {}
         self.model_dir = ensure_available('models', name, root=root)
+        if lazy:
+            self._init_lazy_models(allowed_modules, **kwargs)
+        else:
+            self._init_models(allowed_modules, **kwargs)
+        assert 'detection' in self.models
+        self.det_model = self.models['detection']
+
+    def _init_lazy_models(self, allowed_modules, **kwargs):
+        # routing comes from the cache in model_dir, sessions are only built on first use
+        session_kwargs = {
+            'providers': kwargs.get('providers', model_zoo.get_default_providers()),
+            'provider_options': kwargs.get('provider_options', model_zoo.get_default_provider_options()),
+        }
+        for onnx_file, routing in model_zoo.get_model_routing(self.model_dir).items():
+            taskname = routing['taskname']
+            if allowed_modules is not None and taskname not in allowed_modules:
+                continue
+            if taskname in self.models:
+                print('duplicated model task type, ignore:', onnx_file, taskname)
+                continue
+            self.models[taskname] = model_zoo.LazyModel(onnx_file, routing, **session_kwargs)
+
+    def _init_models(self, allowed_modules, **kwargs):
         onnx_files = glob.glob(osp.join(self.model_dir, '*.onnx'))
         onnx_files = sorted(onnx_files)
         for onnx_file in onnx_files:
@@ -41,8 +64,6 @@ class FaceAnalysis:
             else:
                 print('duplicated model task type, ignore:', onnx_file, model.taskname)
                 del model
-        assert 'detection' in self.models
-        self.det_model = self.models['detection']
 
     def prepare(self, ctx_id, det_thresh=0.5, det_size=(640, 640)):
         self.det_thresh = det_thresh
@@ -17,30 +17,32 @@ __all__ = [
 
 
 class Attribute:
-    def __init__(self, model_file=None, session=None):
+    def __init__(self, model_file=None, session=None, input_mean=None, input_std=None):
         assert model_file is not None
         self.model_file = model_file
         self.session = session
-        find_sub = False
-        find_mul = False
-        model = onnx.load(self.model_file)
-        graph = model.graph
-        for nid, node in enumerate(graph.node[:8]):
-            #print(nid, node.name)
-            if node.name.startswith('Sub') or node.name.startswith('_minus'):
-                find_sub = True
-            if node.name.startswith('Mul') or node.name.startswith('_mul'):
-                find_mul = True
-            if nid<3 and node.name=='bn_data':
-                find_sub = True
-                find_mul = True
-        if find_sub and find_mul:
-            #mxnet arcface model
-            input_mean = 0.0
-            input_std = 1.0
-        else:
-            input_mean = 127.5
-            input_std = 128.0
+        if input_mean is None or input_std is None:
+            # routing cache did not provide the normalisation, parse the graph
+            find_sub = False
+            find_mul = False
+            model = onnx.load(self.model_file)
+            graph = model.graph
+            for nid, node in enumerate(graph.node[:8]):
+                #print(nid, node.name)
+                if node.name.startswith('Sub') or node.name.startswith('_minus'):
+                    find_sub = True
+                if node.name.startswith('Mul') or node.name.startswith('_mul'):
+                    find_mul = True
+                if nid<3 and node.name=='bn_data':
+                    find_sub = True
+                    find_mul = True
+            if find_sub and find_mul:
+                #mxnet arcface model
+                input_mean = 0.0
+                input_std = 1.0
+            else:
+                input_mean = 127.5
+                input_std = 128.0
         self.input_mean = input_mean
         self.input_std = input_std
         #print('input mean and std:', model_file, self.input_mean, self.input_std)
@@ -7,6 +7,8 @@
 import os
 import os.path as osp
 import glob
+import json
+import threading
 import onnxruntime
 from .arcface_onnx import *
 from .retinaface import *
@@ -16,7 +18,16 @@ from .attribute import Attribute
 from .inswapper import INSwapper
 from ..utils import download_onnx
 
-__all__ = ['get_model']
+__all__ = ['get_model', 'get_model_routing', 'LazyModel']
+
+ROUTING_CACHE_NAME = 'routing.json'
+ROUTED_CLASSES = {
+    'RetinaFace': RetinaFace,
+    'Landmark': Landmark,
+    'Attribute': Attribute,
+    'INSwapper': INSwapper,
+    'ArcFaceONNX': ArcFaceONNX,
+}
 
 
 class PickableInferenceSession(onnxruntime.InferenceSession):
@@ -59,6 +70,94 @@ class ModelRouter:
             # raise RuntimeError('error on model routing')
             return None
 
+    def get_routing(self):
+        """route once on CPU and return the metadata needed to rebuild the model without parsing it again"""
+        model = self.get_model(providers=['CPUExecutionProvider'])
+        stat = os.stat(self.onnx_file)
+        return {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'cls': type(model).__name__ if model is not None else None,
+            'taskname': getattr(model, 'taskname', None),
+            'input_mean': getattr(model, 'input_mean', None),
+            'input_std': getattr(model, 'input_std', None),
+        }
+
+
+class LazyModel:
+    """model proxy which creates its session on first use
+    prepare() calls made before that are recorded and replayed on the real model
+    """
+    def __init__(self, onnx_file, routing, **kwargs):
+        self.onnx_file = onnx_file
+        self.routing = routing
+        self.taskname = routing['taskname']
+        self.session_kwargs = kwargs
+        self._model = None
+        self._prepare_args = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    session = PickableInferenceSession(self.onnx_file, **self.session_kwargs)
+                    model_cls = ROUTED_CLASSES[self.routing['cls']]
+                    if model_cls in (Landmark, Attribute, ArcFaceONNX):
+                        model = model_cls(model_file=self.onnx_file, session=session,
+                                          input_mean=self.routing['input_mean'],
+                                          input_std=self.routing['input_std'])
+                    else:
+                        model = model_cls(model_file=self.onnx_file, session=session)
+                    if self._prepare_args is not None:
+                        args, kwargs = self._prepare_args
+                        model.prepare(*args, **kwargs)
+                    self._model = model
+        return self._model
+
+    def prepare(self, *args, **kwargs):
+        if self._model is None:
+            self._prepare_args = (args, kwargs)
+        else:
+            self._model.prepare(*args, **kwargs)
+
+    def __getattr__(self, name):
+        # only reached for attributes that are not set on the proxy itself
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+def get_model_routing(model_dir):
+    """return {onnx_file: routing} for every model in model_dir
+    routing is cached in model_dir so that later start-ups do not have to build a session or load the protobuf
+    """
+    cache_file = osp.join(model_dir, ROUTING_CACHE_NAME)
+    cache = {}
+    if osp.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+
+    entries = {}
+    for onnx_file in sorted(glob.glob(osp.join(model_dir, '*.onnx'))):
+        entry = cache.get(osp.basename(onnx_file))
+        stat = os.stat(onnx_file)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = ModelRouter(onnx_file).get_routing()
+        entries[onnx_file] = entry
+
+    new_cache = {osp.basename(k): v for k, v in entries.items()}
+    if new_cache != cache:
+        try:
+            with open(cache_file, 'w') as f:
+                json.dump(new_cache, f, indent=2)
+        except OSError:
+            pass  # read-only model dir, route again next time
+    return {k: v for k, v in entries.items() if v['cls'] is not None}
+
 
 def find_onnx_file(dir_path):
     if not os.path.exists(dir_path):
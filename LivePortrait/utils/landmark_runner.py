@@ -7,7 +7,7 @@ import numpy as np
 import onnxruntime
 from .timer import Timer
 from .rprint import rlog
-from .crop import crop_image, _transform_pts
+from .crop import crop_image, crop_image_batch, _transform_pts
 
 
 def make_abs_path(fn):
@@ -65,17 +65,27 @@ class LandmarkRunner(object):
                 ], dtype=np.float32),
             }
 
+        return {
+            'pts': self._infer(img_crop_rgb, crop_dct['M_c2o']),  # 2d landmarks 203 points
+        }
+
+    def run_batch(self, img_rgb_lst, lmk_lst):
+        """run() on many frames, the crops of all the frames are computed in one batched pass
+        """
+        crop_dct = crop_image_batch(img_rgb_lst, np.stack(lmk_lst), dsize=self.dsize, scale=1.5, vy_ratio=-0.1)
+        return [
+            {'pts': self._infer(img_crop_rgb, M_c2o)}
+            for img_crop_rgb, M_c2o in zip(crop_dct['img_crop'], crop_dct['M_c2o'])
+        ]
+
+    def _infer(self, img_crop_rgb, M_c2o):
         inp = (img_crop_rgb.astype(np.float32) / 255.).transpose(2, 0, 1)[None, ...]  # HxWx3 (BGR) -> 1x3xHxW (RGB!)
 
         out_lst = self._run(inp)
         out_pts = out_lst[2]
 
         pts = to_ndarray(out_pts[0]).reshape(-1, 2) * self.dsize  # scale to 0-224
-        pts = _transform_pts(pts, M=crop_dct['M_c2o'])
-
-        return {
-            'pts': pts,  # 2d landmarks 203 points
-        }
+        return _transform_pts(pts, M=M_c2o)
 
     def warmup(self):
         # 构造dummy image进行warmup
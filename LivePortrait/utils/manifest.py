@@ -0,0 +1,161 @@
+import os
+import os.path as osp
+import json
+import hashlib
+import numpy as np
+import torch
+
+MANIFEST_VERSION = 1
+
+
+def job_key(*parts) -> str:
+    """ stable hash of everything that changes the frames of a render (inputs, their mtimes, options)
+    """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_signature(fp):
+    """ path, size and mtime, enough to notice a replaced input file
+    """
+    if fp is None or not osp.exists(fp):
+        return fp
+    st = os.stat(fp)
+    return [osp.abspath(fp), st.st_size, int(st.st_mtime)]
+
+
+def _atomic_write(fp, write):
+    tmp = f'{fp}.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, fp)
+
+
+class RenderManifest:
+    """ progress of a chunked render, stored as manifest.json in the job directory next to the segments
+    a chunk is recorded only once all of its segments are closed, the file is replaced atomically,
+    so after a crash the manifest lists exactly the chunks that do not have to be rendered again.
+    the state (source keypoints, first driving frame motion, ...) is kept in state.npz
+    """
+
+    def __init__(self, job_dir, key, chunk_size, modes):
+        self.job_dir = job_dir
+        self.key = key
+        self.chunk_size = chunk_size
+        self.modes = list(modes)
+        self.chunks = []  # [{'index', 'start', 'end', 'segments': {mode: file name}}]
+        self.complete = False  # every driving frame is covered by a chunk
+
+    @property
+    def path(self):
+        return osp.join(self.job_dir, 'manifest.json')
+
+    @property
+    def state_path(self):
+        return osp.join(self.job_dir, 'state.npz')
+
+    @classmethod
+    def open(cls, job_dir, key, chunk_size, modes):
+        """ resume the manifest of job_dir if it belongs to the same job, otherwise start over
+        """
+        os.makedirs(job_dir, exist_ok=True)
+        manifest = cls(job_dir, key, chunk_size, modes)
+        if osp.exists(manifest.path):
+            with open(manifest.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION and data.get('key') == key \
+                    and data.get('chunk_size') == chunk_size and data.get('modes') == manifest.modes:
+                manifest.chunks = data['chunks']
+                manifest.complete = data.get('complete', False)
+            else:
+                manifest.clear()
+        return manifest
+
+    def clear(self):
+        """ drop the progress and every file of the job directory
+        """
+        self.chunks = []
+        self.complete = False
+        for name in os.listdir(self.job_dir):
+            fp = osp.join(self.job_dir, name)
+            if osp.isfile(fp):
+                os.remove(fp)
+
+    def save(self):
+        data = {
+            'version': MANIFEST_VERSION,
+            'key': self.key,
+            'chunk_size': self.chunk_size,
+            'modes': self.modes,
+            'chunks': self.chunks,
+            'complete': self.complete,
+        }
+        _atomic_write(self.path, lambda f: f.write(json.dumps(data, indent=2).encode()))
+
+    @property
+    def next_frame(self):
+        """ first frame not covered by a completed chunk
+        """
+        return self.chunks[-1]['end'] if self.chunks else 0
+
+    def mark_complete(self):
+        self.complete = True
+        self.save()
+
+    def segment_path(self, mode, index):
+        return osp.join(self.job_dir, f'{mode}_{index:05d}.mp4')
+
+    def add_chunk(self, index, start, end):
+        self.chunks.append({
+            'index': index,
+            'start': start,
+            'end': end,
+            'segments': {mode: osp.basename(self.segment_path(mode, index)) for mode in self.modes},
+        })
+        self.save()
+
+    def completed(self):
+        return {chunk['index'] for chunk in self.chunks}
+
+    def segments(self, mode):
+        """ segment files in frame order, chunks rendered in parallel complete out of order
+        """
+        chunks = sorted(self.chunks, key=lambda chunk: chunk['start'])
+        return [osp.join(self.job_dir, chunk['segments'][mode]) for chunk in chunks]
+
+    def has_state(self):
+        return osp.exists(self.state_path)
+
+    def save_state(self, **state):
+        """ dicts are flattened to 'name.key', torch tensors are restored as tensors, None values are dropped
+        """
+        arrays, tensors = {}, []
+        for name, value in state.items():
+            items = value.items() if isinstance(value, dict) else [(None, value)]
+            for key, v in items:
+                if v is None:
+                    continue
+                full_name = name if key is None else f'{name}.{key}'
+                if isinstance(v, torch.Tensor):
+                    tensors.append(full_name)
+                    v = v.detach().cpu().numpy()
+                arrays[full_name] = np.asarray(v)
+        arrays['__tensors__'] = np.array(tensors, dtype=str)
+        _atomic_write(self.state_path, lambda f: np.savez(f, **arrays))
+
+    def load_state(self) -> dict:
+        with np.load(self.state_path) as data:
+            tensors = set(data['__tensors__'].tolist())
+            state = {}
+            for full_name in data.files:
+                if full_name == '__tensors__':
+                    continue
+                v = data[full_name]
+                v = torch.from_numpy(v) if full_name in tensors else v
+                if '.' in full_name:
+                    name, key = full_name.split('.', 1)
+                    state.setdefault(name, {})[key] = v
+                else:
+                    state[full_name] = v
+        return state
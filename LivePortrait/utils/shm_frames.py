@@ -0,0 +1,361 @@
+""" frames passed between processes of one host through a POSIX shared-memory ring, written as shm://name
+
+layout of the segment (little endian):
+  0   RING_HEADER  magic b'LPFR', version u8, pad, n_slots u16, height u32, width u32, channels u32, frame_stride u64,
+                   producer pid u32
+  32  u64 x 4      write_seq (last committed frame), read_seq (last frame the consumer is done with), closed,
+                   consumer_gone (the consumer stopped reading before the end of the stream)
+  64  u64 x n      seq of the frame in every slot, 0 while it is being written
+      f64 x n      timestamp of the frame in every slot, time.time() of its capture
+  ... uint8        n_slots frames of height x width x channels (RGB), 64-byte aligned
+sequence numbers start at 1, frame seq lives in slot (seq - 1) % n_slots. the producer writes in place and the
+consumer reads numpy views of the slots: a frame is never pickled nor copied from one process to the other.
+the seq of a slot is a seqlock: a copy of a slot is consistent when the slot still holds its frame afterwards.
+a lossless producer waits for the consumer (read_seq) before it overwrites a slot, offline rendering, unless the
+consumer is gone; a real-time producer never waits and the consumer takes the latest frame, the frames it was too
+slow for are skipped
+"""
+import os
+import sys
+import time
+import struct
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+
+SHM_PREFIX = 'shm://'
+RING_MAGIC = b'LPFR'
+RING_VERSION = 1
+RING_HEADER = struct.Struct('<4sBxHIIIQI')
+COUNTERS_OFFSET = 32
+SLOTS_OFFSET = 64
+POLL_INTERVAL = 0.0005  # seconds between two looks at the counters while waiting for the other process
+WRITE_SEQ, READ_SEQ, CLOSED, CONSUMER_GONE = 0, 1, 2, 3
+
+
+def is_shared_frames(path) -> bool:
+    return isinstance(path, str) and path.startswith(SHM_PREFIX)
+
+
+def shared_frames_name(path) -> str:
+    return path[len(SHM_PREFIX):]
+
+
+def _align(n, alignment=64):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def _attach_segment(name) -> shared_memory.SharedMemory:
+    """ open an existing segment without handing it to the resource tracker, the producer owns it
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    if os.name == 'nt':
+        # no resource tracker on windows, the segment lives as long as a handle on it
+        return shared_memory.SharedMemory(name)
+    # SharedMemory(name) registers the segment and unregistering it afterwards is not an option: a consumer
+    # spawned by the same parent as the producer shares its tracker, the unregister would drop the producer's
+    # registration (KeyError in the tracker, the segment leaks when the producer crashes). map it ourselves
+    import mmap
+    import _posixshmem
+    shm = shared_memory.SharedMemory.__new__(shared_memory.SharedMemory)
+    shm._name = '/' + name if shared_memory.SharedMemory._prepend_leading_slash else name
+    shm._fd = _posixshmem.shm_open(shm._name, os.O_RDWR, mode=0o600)
+    try:
+        shm._size = os.fstat(shm._fd).st_size
+        shm._mmap = mmap.mmap(shm._fd, shm._size)
+    except OSError:
+        os.close(shm._fd)
+        raise
+    shm._buf = memoryview(shm._mmap)
+    return shm
+
+
+def _is_stale(shm) -> bool:
+    """ the segment is not a ring (e.g. its producer died creating it), its stream is closed or its producer is gone
+    """
+    if shm.size < SLOTS_OFFSET or bytes(shm.buf[:4]) != RING_MAGIC:
+        return True
+    if struct.unpack_from('<Q', shm.buf, COUNTERS_OFFSET + 8 * CLOSED)[0]:
+        return True
+    pid = RING_HEADER.unpack_from(shm.buf)[-1]
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass  # alive, another user's
+    return False
+
+
+class SharedFrameRing:
+    """ a ring of n_slots frames of one shape in a shared-memory segment, created by the producer
+    use create() on the producer side and attach() on the consumer side, close() detaches, the producer unlinks
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner=False):
+        self.shm = shm
+        self.owner = owner
+        magic, version, n_slots, height, width, channels, frame_stride, _ = RING_HEADER.unpack_from(shm.buf)
+        if magic != RING_MAGIC:
+            raise ValueError(f'{shm.name} is not a frame ring')
+        if version != RING_VERSION:
+            raise ValueError(f'frame ring {shm.name} has version {version}, expect {RING_VERSION}')
+        self.n_slots = n_slots
+        self.shape = (height, width, channels)
+        self.counters = np.ndarray((4,), dtype='<u8', buffer=shm.buf, offset=COUNTERS_OFFSET)
+        self.slot_seq = np.ndarray((n_slots,), dtype='<u8', buffer=shm.buf, offset=SLOTS_OFFSET)
+        self.slot_time = np.ndarray((n_slots,), dtype='<f8', buffer=shm.buf, offset=SLOTS_OFFSET + 8 * n_slots)
+        frames_offset = _align(SLOTS_OFFSET + 16 * n_slots)
+        self.frames = np.ndarray((n_slots, height, width, channels), dtype=np.uint8, buffer=shm.buf,
+                                 offset=frames_offset, strides=(frame_stride, width * channels, channels, 1))
+        self.n_lost = 0  # frames a lossless consumer missed because the producer did not wait for it
+
+    @classmethod
+    def create(cls, name, shape, n_slots=8) -> 'SharedFrameRing':
+        """ producer side, a stale segment of the same name (left by a crashed producer) is replaced
+        shape: (height, width, channels) of the frames
+        raise: FileExistsError when a live producer streams to this name
+        """
+        height, width, channels = shape
+        frame_stride = _align(height * width * channels)
+        size = _align(SLOTS_OFFSET + 16 * n_slots) + n_slots * frame_stride
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name)
+            try:
+                if not _is_stale(stale):
+                    raise FileExistsError(f'frame ring {SHM_PREFIX}{name} is in use by another producer') from None
+                stale.unlink()
+            finally:
+                stale.close()
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        shm.buf[:SLOTS_OFFSET + 16 * n_slots] = bytes(SLOTS_OFFSET + 16 * n_slots)
+        # the magic goes last, a consumer attaching meanwhile waits for it
+        RING_HEADER.pack_into(shm.buf, 0, b'\0' * 4, RING_VERSION, n_slots, height, width, channels, frame_stride,
+                              os.getpid())
+        shm.buf[:4] = RING_MAGIC
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name, timeout=None) -> 'SharedFrameRing':
+        """ consumer side, waits up to timeout seconds (None: forever) for the producer to create the ring
+        raise: TimeoutError
+        """
+        t0 = time.perf_counter()
+        while True:
+            try:
+                shm = _attach_segment(name)
+                if shm.size >= SLOTS_OFFSET and bytes(shm.buf[:4]) == RING_MAGIC:
+                    return cls(shm)
+                shm.close()
+            except FileNotFoundError:
+                pass
+            if timeout is not None and time.perf_counter() - t0 > timeout:
+                raise TimeoutError(f'no frame ring {SHM_PREFIX}{name} after {timeout:.0f}s')
+            time.sleep(POLL_INTERVAL * 10)
+
+    @property
+    def closed(self) -> bool:
+        return bool(self.counters[CLOSED])
+
+    @property
+    def consumer_gone(self) -> bool:
+        return bool(self.counters[CONSUMER_GONE])
+
+    @property
+    def write_seq(self) -> int:
+        return int(self.counters[WRITE_SEQ])
+
+    def acquire(self, wait=False, timeout=None) -> np.ndarray:
+        """ producer: the slot of the next frame, to be filled in place before commit()
+        wait: wait for the consumer to be done with the frame the slot holds (lossless)
+        raise: TimeoutError
+        """
+        seq = self.write_seq + 1
+        if wait:
+            t0 = time.perf_counter()
+            while seq - int(self.counters[READ_SEQ]) > self.n_slots and not self.consumer_gone:
+                if timeout is not None and time.perf_counter() - t0 > timeout:
+                    raise TimeoutError(f'the consumer of {SHM_PREFIX}{self.shm.name} is not reading')
+                time.sleep(POLL_INTERVAL)
+        slot = (seq - 1) % self.n_slots
+        self.slot_seq[slot] = 0
+        return self.frames[slot]
+
+    def commit(self, timestamp=None):
+        """ producer: publish the frame written into the slot of acquire()
+        """
+        seq = self.write_seq + 1
+        slot = (seq - 1) % self.n_slots
+        self.slot_time[slot] = time.time() if timestamp is None else timestamp
+        self.slot_seq[slot] = seq
+        self.counters[WRITE_SEQ] = seq
+
+    def write(self, image, timestamp=None, wait=False, timeout=None):
+        """ producer: copy a frame into the ring, the one copy into shared memory the frame ever goes through
+        """
+        if image.shape != self.shape:
+            raise ValueError(f'frame shape {image.shape} != {self.shape} of {SHM_PREFIX}{self.shm.name}')
+        self.acquire(wait=wait, timeout=timeout)[...] = image
+        self.commit(timestamp)
+
+    def close_stream(self):
+        """ producer: no more frames, the consumer stops after the ones written
+        """
+        self.counters[CLOSED] = 1
+
+    def read(self, seq):
+        """ (timestamp, view) of frame seq, None when its slot holds another frame
+        the view is only valid until the producer reuses the slot, n_slots frames later (lossless: after ack),
+        valid(seq) tells whether what was taken from it is frame seq
+        """
+        slot = (seq - 1) % self.n_slots
+        if int(self.slot_seq[slot]) != seq:
+            return None
+        timestamp = float(self.slot_time[slot])
+        if int(self.slot_seq[slot]) != seq:
+            return None
+        return timestamp, self.frames[slot]
+
+    def valid(self, seq) -> bool:
+        """ the slot of frame seq still holds it: a copy of the view of read(seq) taken before is not torn
+        """
+        return int(self.slot_seq[(seq - 1) % self.n_slots]) == seq
+
+    def ack(self, seq):
+        """ consumer: done with the frames up to seq, a lossless producer may overwrite them
+        """
+        self.counters[READ_SEQ] = seq
+
+    def iter_frames(self, lossless=True, timeout=None):
+        """ consumer: yield (seq, timestamp, view) until the producer closes the stream
+        lossless: every frame in order, each one acknowledged when the next one is asked for.
+        otherwise the latest frame each time, the ones written meanwhile are skipped
+        timeout: seconds without a new frame before TimeoutError, None waits forever
+        a consumer leaving before the end of the stream releases a lossless producer
+        """
+        last = int(self.counters[READ_SEQ]) if lossless else self.write_seq
+        self.counters[CONSUMER_GONE] = 0
+        try:
+            yield from self._iter_frames(last, lossless, timeout)
+        finally:
+            self.counters[CONSUMER_GONE] = 1
+
+    def _iter_frames(self, last, lossless, timeout):
+        t0 = time.perf_counter()
+        while True:
+            write_seq = self.write_seq
+            if write_seq <= last:
+                if self.closed and self.write_seq <= last:
+                    return
+                if timeout is not None and time.perf_counter() - t0 > timeout:
+                    raise TimeoutError(f'no frame from {SHM_PREFIX}{self.shm.name} for {timeout:.0f}s')
+                time.sleep(POLL_INTERVAL)
+                continue
+            if lossless:
+                seq = last + 1
+                if write_seq - seq >= self.n_slots:
+                    # the producer did not wait, the oldest frames are gone
+                    self.n_lost += write_seq - self.n_slots + 1 - seq
+                    seq = write_seq - self.n_slots + 1
+            else:
+                seq = write_seq
+            frame = self.read(seq)
+            if frame is None:
+                continue  # overwritten while it was looked up, the next frame is there
+            last = seq
+            yield (seq,) + frame
+            t0 = time.perf_counter()
+            self.ack(seq)
+
+    def close(self):
+        """ detach the views and the segment, the producer also removes it
+        """
+        del self.counters, self.slot_seq, self.slot_time, self.frames
+        try:
+            self.shm.close()
+        except BufferError:
+            pass  # views of the frames are still referenced, the mapping goes away with them
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class SharedFrameReader:
+    """ the frames of a shm://name ring as a driving video, iterated like FFmpegVideoReader
+    one output per entry of sizes ((w, h), or None for the native frame), selector applies to the frame index.
+    the network input and display frames are resized straight from the shared memory, native frames are copied
+    out since they outlive their slot
+    """
+
+    def __init__(self, path, sizes=(None,), selector=None, lossless=True, timeout=None):
+        self.name = shared_frames_name(path)
+        self.sizes = list(sizes)
+        self.selector = selector
+        self.lossless = lossless
+        self.timeout = timeout
+
+    def __iter__(self):
+        ring = SharedFrameRing.attach(self.name, timeout=self.timeout)
+        try:
+            for i, (seq, _, frame) in enumerate(ring.iter_frames(lossless=self.lossless, timeout=self.timeout)):
+                if self.selector is not None:
+                    if self.selector.end_frame is not None and i >= self.selector.end_frame:
+                        break
+                    if i < self.selector.first_frame or not self.selector.select_index(i - self.selector.first_frame):
+                        continue
+                frames = tuple(frame.copy() if size is None else cv2.resize(frame, size) for size in self.sizes)
+                if not ring.valid(seq):
+                    continue  # overwritten while it was copied, real-time producer
+                yield frames[0] if len(frames) == 1 else frames
+        finally:
+            ring.close()
+
+
+class SharedFrameWriter:
+    """ a writer (like StreamingVideoWriter) into a shm://name ring, created with the shape of the first frame
+    lossless: wait for the consumer instead of overwriting the frames it has not read, offline rendering.
+    close() ends the stream and, lossless, waits up to timeout for the consumer to read the last frames
+    """
+
+    def __init__(self, path, n_slots=8, lossless=True, timeout=None):
+        self.path = path
+        self.n_slots = n_slots
+        self.lossless = lossless
+        self.timeout = timeout
+        self.ring = None
+        self.n_frames = 0
+
+    def write(self, image):
+        image = np.asarray(image, dtype=np.uint8)
+        if self.ring is None:
+            self.ring = SharedFrameRing.create(shared_frames_name(self.path), image.shape, self.n_slots)
+        self.ring.write(image, wait=self.lossless, timeout=self.timeout)
+        self.n_frames += 1
+
+    # a writer can stand in for the list the frames used to be collected in
+    append = write
+
+    def close(self):
+        if self.ring is None:
+            return None
+        ring, self.ring = self.ring, None
+        ring.close_stream()
+        t0 = time.perf_counter()
+        while self.lossless and int(ring.counters[READ_SEQ]) < ring.write_seq and not ring.consumer_gone:
+            if self.timeout is not None and time.perf_counter() - t0 > self.timeout:
+                break
+            time.sleep(POLL_INTERVAL)
+        ring.close()
+        print(f'Streamed {self.n_frames} frames to {self.path}\n')
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -5,6 +5,9 @@ tools to measure elapsed time
 """
 
 import time
+import threading
+from collections import deque
+import numpy as np
 
 class Timer(object):
     """A simple timer."""
@@ -27,3 +30,42 @@ class Timer(object):
     def clear(self):
         self.start_time = 0.
         self.diff = 0.
+
+
+class LatencyStats(object):
+    """Latencies per key (endpoint, job stage, ...), thread-safe.
+    The last `window` samples of every key are kept for the percentiles, the count covers all of them.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.samples = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, seconds):
+        with self.lock:
+            if key not in self.samples:
+                self.samples[key] = deque(maxlen=self.window)
+                self.counts[key] = 0
+            self.samples[key].append(seconds)
+            self.counts[key] += 1
+
+    def mean(self, key, default=None):
+        """mean of the kept samples of key in seconds, default without samples"""
+        with self.lock:
+            values = self.samples.get(key)
+            return sum(values) / len(values) if values else default
+
+    def summary(self):
+        """{key: {'count', 'mean_ms', 'p50_ms', 'p95_ms', 'max_ms'}} over the kept samples"""
+        with self.lock:
+            samples = {key: np.array(values) * 1000. for key, values in self.samples.items()}
+            counts = dict(self.counts)
+        return {key: {
+            'count': counts[key],
+            'mean_ms': float(values.mean()),
+            'p50_ms': float(np.percentile(values, 50)),
+            'p95_ms': float(np.percentile(values, 95)),
+            'max_ms': float(values.max()),
+        } for key, values in samples.items()}
@@ -4,9 +4,14 @@
 functions for processing video
 """
 
+import os
 import os.path as osp
+import json
+import functools
 import numpy as np
 import subprocess
+import threading
+import queue
 import imageio
 import cv2
 
@@ -19,6 +24,17 @@ def exec_cmd(cmd):
     subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
 
+@functools.lru_cache(maxsize=None)
+def ffmpeg_exe():
+    """ the ffmpeg binary shipped with imageio-ffmpeg (or $IMAGEIO_FFMPEG_EXE), ffmpeg of the PATH without it
+    """
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        return 'ffmpeg'
+
+
 def images2video(images, wfp, **kwargs):
     fps = kwargs.get('fps', 30)
     video_format = kwargs.get('format', 'mp4')  # default is mp4 format
@@ -127,6 +143,445 @@ class VideoWriter:
             self.writer.close()
 
 
+class StreamingVideoWriter:
+    """ pipe raw rgb24 frames to an ffmpeg subprocess from a background thread
+    write() only queues the frame (and blocks while the bounded queue is full), so encoding overlaps with inference.
+    the audio of audio_fp (e.g. the driving video) is muxed in the same ffmpeg pass
+    """
+
+    def __init__(self, wfp, **kwargs):
+        self.wfp = wfp
+        self.fps = kwargs.get('fps', 30)
+        self.audio_fp = kwargs.get('audio_fp')  # None: no audio
+        self.audio_start = kwargs.get('audio_start', 0.)  # seconds, trims the audio like the driving frames
+        self.audio_duration = kwargs.get('audio_duration')
+        self.codec = kwargs.get('codec', 'libx264')
+        self.crf = kwargs.get('crf', 18)
+        self.preset = kwargs.get('preset', 'medium')  # ultrafast ... veryslow, speed/size trade-off
+        self.tune = kwargs.get('tune')  # e.g. zerolatency, fastdecode
+        self.pixelformat = kwargs.get('pixelformat', 'yuv420p')
+        self.image_mode = kwargs.get('image_mode', 'rgb')
+        self.ffmpeg_bin = kwargs.get('ffmpeg_bin') or ffmpeg_exe()
+        self.queue = queue.Queue(maxsize=kwargs.get('queue_size', 32))
+        self.process = None
+        self.thread = None
+        self.error = None
+        self.size = None
+        self.n_frames = 0
+
+    def _command(self, w, h):
+        cmd = [self.ffmpeg_bin, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{w}x{h}', '-r', str(self.fps), '-i', '-']
+        if self.audio_fp is not None:
+            if self.audio_start:
+                cmd += ['-ss', f'{self.audio_start:.6f}']
+            if self.audio_duration is not None:
+                cmd += ['-t', f'{self.audio_duration:.6f}']
+            cmd += ['-i', self.audio_fp]
+        cmd += ['-map', '0:v:0']
+        if self.audio_fp is not None:
+            # '?' keeps drivings without an audio stream working
+            cmd += ['-map', '1:a:0?', '-c:a', 'aac', '-shortest']
+        # yuv420p needs even dimensions
+        cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', self.codec, '-crf', str(self.crf),
+                '-pix_fmt', self.pixelformat]
+        if self.preset is not None:
+            cmd += ['-preset', self.preset]
+        if self.tune is not None:
+            cmd += ['-tune', self.tune]
+        cmd += [self.wfp]
+        return cmd
+
+    def _start(self, image):
+        h, w = image.shape[:2]
+        self.size = (w, h)
+        self.process = subprocess.Popen(self._command(w, h), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE)
+        self.thread = threading.Thread(target=self._worker, name='video_writer', daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            image = self.queue.get()
+            if image is None:
+                break
+            if self.error is not None:
+                continue  # keep draining so that write() never blocks on a dead encoder
+            try:
+                self.process.stdin.write(image.data)
+            except (BrokenPipeError, OSError) as e:
+                self.error = e
+
+    def write(self, image):
+        if self.error is not None:
+            raise RuntimeError(f'ffmpeg encoder for {self.wfp} failed: {self.error}')
+        if self.image_mode.lower() == 'bgr':
+            image = image[..., ::-1]
+        if self.process is None:
+            self._start(image)
+        elif image.shape[1::-1] != self.size:
+            raise ValueError(f'frame size {image.shape[1::-1]} != {self.size}')
+        self.queue.put(np.ascontiguousarray(image, dtype=np.uint8))
+        self.n_frames += 1
+
+    # a writer can stand in for the list the frames used to be collected in
+    append = write
+
+    def close(self):
+        if self.process is None:
+            return None
+        self.queue.put(None)
+        self.thread.join()
+        _, stderr = self.process.communicate()
+        returncode = self.process.returncode
+        self.process = None
+        if self.error is not None or returncode != 0:
+            raise RuntimeError(f'ffmpeg encoder for {self.wfp} failed: {stderr.decode(errors="ignore")}')
+        print(f'Dump to {self.wfp}\n')
+        return self.wfp
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def concat_segments(segment_fps, wfp, **kwargs):
+    """ join video segments with the ffmpeg concat demuxer, the video stream is copied, not re-encoded
+    the segments must share codec, size and fps (e.g. written by StreamingVideoWriter with the same options).
+    audio_fp/audio_start/audio_duration: optional audio muxed in, as in StreamingVideoWriter
+    """
+    ffmpeg_bin = kwargs.get('ffmpeg_bin') or ffmpeg_exe()
+    audio_fp = kwargs.get('audio_fp')
+    list_fp = f'{wfp}.concat.txt'
+    with open(list_fp, 'w') as f:
+        for fp in segment_fps:
+            # the demuxer resolves relative paths against the list file, absolute paths avoid the ambiguity
+            f.write("file '%s'\n" % osp.abspath(fp).replace("'", "'\\''"))
+    cmd = [ffmpeg_bin, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_fp]
+    if audio_fp is not None:
+        if kwargs.get('audio_start'):
+            cmd += ['-ss', f'{kwargs["audio_start"]:.6f}']
+        if kwargs.get('audio_duration') is not None:
+            cmd += ['-t', f'{kwargs["audio_duration"]:.6f}']
+        cmd += ['-i', audio_fp, '-map', '0:v:0', '-map', '1:a:0?', '-c:a', 'aac', '-shortest']
+    cmd += ['-c:v', 'copy', wfp]
+    try:
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f'ffmpeg concat for {wfp} failed: {e.stderr.decode(errors="ignore")}') from e
+    finally:
+        os.remove(list_fp)
+    print(f'Dump to {wfp}\n')
+    return wfp
+
+
+def probe_video(filepath, ffprobe_bin='ffprobe'):
+    """ width/height (after rotation), fps and frame count of the first video stream
+    """
+    cmd = [ffprobe_bin, '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+           '-show_entries', 'stream=width,height,avg_frame_rate,nb_read_packets:stream_side_data=rotation:stream_tags=rotate',
+           '-of', 'json', filepath]
+    try:
+        out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+    except FileNotFoundError:
+        # no ffprobe, opencv reports the size after rotation as well
+        cap = cv2.VideoCapture(filepath)
+        info = {
+            'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            'fps': float(cap.get(cv2.CAP_PROP_FPS)),
+            'n_frames': int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+        }
+        cap.release()
+        return info
+    stream = json.loads(out)['streams'][0]
+    w, h = int(stream['width']), int(stream['height'])
+    rotation = stream.get('tags', {}).get('rotate')
+    for side_data in stream.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+    if rotation is not None and int(float(rotation)) % 180 != 0:
+        w, h = h, w  # ffmpeg auto-rotates when decoding
+    num, den = stream.get('avg_frame_rate', '0/1').split('/')
+    return {
+        'width': w,
+        'height': h,
+        'fps': float(num) / float(den) if float(den) != 0 else 0.,
+        'n_frames': int(stream.get('nb_read_packets', 0)),
+    }
+
+
+def probe_keyframes(filepath, fps=None, ffprobe_bin='ffprobe'):
+    """ source frame indices of the keyframes of the first video stream, read from the packet flags without decoding
+    return: sorted list, empty when ffprobe is not available
+    """
+    cmd = [ffprobe_bin, '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+           'stream=start_time,avg_frame_rate:packet=pts_time,flags', '-of', 'json', filepath]
+    try:
+        out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+    except FileNotFoundError:
+        return []
+    data = json.loads(out)
+    stream = data['streams'][0]
+    if fps is None:
+        num, den = stream.get('avg_frame_rate', '0/1').split('/')
+        fps = float(num) / float(den) if float(den) != 0 else 30.
+    start_time = float(stream.get('start_time', 0.) or 0.)
+    keyframes = {int(round((float(packet['pts_time']) - start_time) * fps))
+                 for packet in data.get('packets', []) if 'K' in packet.get('flags', '') and 'pts_time' in packet}
+    return sorted(keyframes)
+
+
+class FrameSelector:
+    """ which driving frames are rendered: the [start, end) time range in seconds, retimed to fps,
+    then every stride-th frame. the selection of a frame only depends on its index in the source video,
+    so it is the same whether the video is decoded from the start (ffmpeg_input_args/ffmpeg_filters,
+    select_index) or from any frame on (offset), which segment-parallel rendering relies on.
+    select() applies it to frames that arrive one at a time with their timestamps (webcam)
+    """
+
+    def __init__(self, src_fps, start=0., end=None, stride=1, fps=None):
+        self.src_fps = float(src_fps) if src_fps else 30.
+        self.start = max(float(start or 0.), 0.)
+        self.end = None if end is None else float(end)
+        self.stride = max(int(stride), 1)
+        self.fps = float(fps) if fps else None
+        self.kwargs = {'src_fps': self.src_fps, 'start': self.start, 'end': self.end, 'stride': self.stride,
+                       'fps': self.fps}  # rebuilds the selector, e.g. in another process
+        if self.end is not None and self.end <= self.start:
+            raise ValueError(f'driving end time {self.end} should be larger than the start time {self.start}')
+        # retiming only drops frames, a target fps above the source fps keeps them all
+        self.ratio = min(self.fps / self.src_fps, 1.) if self.fps is not None else 1.
+        self.first_frame = int(np.ceil(self.start * self.src_fps - 1e-6))  # first source frame in the range
+        self.end_frame = None if self.end is None else int(np.ceil(self.end * self.src_fps - 1e-6))  # exclusive
+        self.reset()
+
+    def reset(self):
+        self._next_t = 0.
+        self._n_retimed = 0
+
+    @property
+    def is_identity(self):
+        return self.start == 0 and self.end is None and self.stride == 1 and self.ratio == 1.
+
+    @property
+    def output_fps(self):
+        """ frame rate of the selected frames, the rate the output has to be written at to keep the timing
+        """
+        return self.src_fps * self.ratio / self.stride
+
+    @property
+    def duration(self):
+        return None if self.end is None else self.end - self.start
+
+    def select_index(self, i):
+        """ i: index of the frame counted from first_frame
+        a retimed frame is the first one of its 1/fps slot, (i + 0.5) / src_fps being its time within half a frame
+        """
+        slot = np.floor((i + 0.5) * self.ratio)
+        return bool(slot > np.floor((i - 0.5) * self.ratio) and slot % self.stride == 0)
+
+    def selected_indices(self, n_src_frames):
+        """ source frame indices of the selected frames of a video with n_src_frames frames
+        """
+        end = n_src_frames if self.end_frame is None else min(self.end_frame, n_src_frames)
+        return [i for i in range(self.first_frame, end) if self.select_index(i - self.first_frame)]
+
+    def offset_of(self, n):
+        """ offset from first_frame of the source frame of selected frame n, where decoding starts to resume at it
+        """
+        i, n_selected = 0, 0
+        while True:
+            if self.select_index(i):
+                if n_selected == n:
+                    return i
+                n_selected += 1
+            i += 1
+
+    def ffmpeg_input_args(self, offset=0):
+        """ offset: decode from source frame first_frame + offset on, seeking half a frame early so that
+        timestamp rounding never drops it
+        """
+        first = self.first_frame + offset
+        args = ['-ss', f'{(first - 0.5) / self.src_fps:.6f}'] if first > 0 else []
+        if self.end_frame is not None:
+            args += ['-t', f'{(self.end_frame - first) / self.src_fps:.6f}']
+        return args
+
+    def ffmpeg_filters(self, offset=0):
+        """ select_index as an ffmpeg select expression, n being the index of the decoded frame
+        """
+        if self.ratio == 1. and self.stride == 1:
+            return []
+        i = f'(n+{offset})'
+        slot = f'floor(({i}+0.5)*{self.ratio!r})'
+        expr = f'gt({slot}\\,floor(({i}-0.5)*{self.ratio!r}))*not(mod({slot}\\,{self.stride}))'
+        return [f'select={expr}']
+
+    def finished(self, t):
+        return self.end is not None and t >= self.end
+
+    def select(self, t):
+        """ t: timestamp of the frame in seconds, called in increasing order
+        """
+        if t < self.start or self.finished(t):
+            return False
+        if self.fps is not None:
+            # keep the first frame of every 1/fps slot, within half a source frame
+            if t - self.start < self._next_t - 0.5 / self.src_fps:
+                return False
+            self._next_t += 1. / self.fps
+        keep = self._n_retimed % self.stride == 0
+        self._n_retimed += 1
+        return keep
+
+
+class FFmpegVideoReader:
+    """ decode a video with an ffmpeg subprocess into raw rgb24 frames
+    ffmpeg scales the frames itself, one output per entry of sizes ((w, h), or None for the native resolution),
+    e.g. [(256, 256), (512, 512)] for the network input and a display-size frame.
+    every output is a pipe read by its own thread into a bounded queue, so decoding runs ahead of the consumer.
+    iterating yields one frame per output (a tuple when there are several outputs)
+    """
+
+    def __init__(self, filepath, sizes=(None,), **kwargs):
+        self.filepath = filepath
+        self.sizes = list(sizes)
+        self.threads = kwargs.get('threads', 0)  # ffmpeg decoding threads, 0 is auto
+        self.queue_size = kwargs.get('queue_size', 16)
+        self.ffmpeg_bin = kwargs.get('ffmpeg_bin') or ffmpeg_exe()
+        self.interp = kwargs.get('interp', 'bilinear')  # ffmpeg scale flags
+        self.info = probe_video(filepath, ffprobe_bin=kwargs.get('ffprobe_bin', 'ffprobe'))
+        self.selector = kwargs.get('selector')  # FrameSelector, None decodes every frame
+        self.offset = kwargs.get('offset', 0)  # with a selector: start decoding at source frame first_frame + offset
+        self.max_frames = kwargs.get('max_frames')  # ffmpeg stops after this many (selected) frames, None decodes all
+        self.frame_sizes = [(self.info['width'], self.info['height']) if size is None else tuple(size)
+                            for size in self.sizes]
+        self.process = None
+        self.readers = []
+        self.queues = []
+        self.stopped = threading.Event()
+
+    @property
+    def fps(self):
+        """ frame rate of the decoded frames
+        """
+        return self.info['fps'] if self.selector is None else self.selector.output_fps
+
+    def _command(self, fds):
+        n = len(self.sizes)
+        # frames are selected before the split, so the dropped ones are never scaled
+        selection = self.selector.ffmpeg_filters(self.offset) if self.selector is not None else []
+        filters = ['[0:v]%s[sel]' % ','.join(selection)] if selection else []
+        src0 = '[sel]' if selection else '[0:v]'
+        if n > 1:
+            filters.append('%ssplit=%d%s' % (src0, n, ''.join(f'[s{i}]' for i in range(n))))
+        for i, size in enumerate(self.sizes):
+            src = f'[s{i}]' if n > 1 else src0
+            if size is None:
+                filters.append(f'{src}null[o{i}]')
+            else:
+                filters.append(f'{src}scale={size[0]}:{size[1]}:flags={self.interp}[o{i}]')
+        cmd = [self.ffmpeg_bin, '-nostdin', '-loglevel', 'error', '-threads', str(self.threads)]
+        if self.selector is not None:
+            cmd += self.selector.ffmpeg_input_args(self.offset)
+        cmd += ['-i', self.filepath, '-filter_complex', ';'.join(filters)]
+        for i, fd in enumerate(fds):
+            cmd += ['-map', f'[o{i}]']
+            if self.max_frames is not None:
+                cmd += ['-frames:v', str(self.max_frames)]
+            cmd += ['-f', 'rawvideo', '-pix_fmt', 'rgb24', '-vsync', 'passthrough', f'pipe:{fd}']
+        return cmd
+
+    def _read(self, stream, frame_size, q):
+        w, h = frame_size
+        n_bytes = w * h * 3
+        try:
+            while not self.stopped.is_set():
+                data = stream.read(n_bytes)
+                if len(data) < n_bytes:
+                    break
+                frame = np.frombuffer(data, dtype=np.uint8).reshape(h, w, 3)
+                while not self.stopped.is_set():
+                    try:
+                        q.put(frame, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        finally:
+            stream.close()
+            while True:
+                try:
+                    q.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    if self.stopped.is_set():
+                        # the consumer is gone, make room for the end marker instead of waiting for it
+                        try:
+                            q.get_nowait()
+                        except queue.Empty:
+                            pass
+
+    def start(self):
+        # the first output goes to stdout, the others to extra pipes inherited by ffmpeg
+        extra = [os.pipe() for _ in self.sizes[1:]]
+        fds = [1] + [w for _, w in extra]
+        self.process = subprocess.Popen(self._command(fds), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                        pass_fds=[w for _, w in extra])
+        streams = [self.process.stdout]
+        for r, w in extra:
+            os.close(w)  # only ffmpeg keeps the write end, so EOF arrives when it exits
+            streams.append(os.fdopen(r, 'rb'))
+        for stream, frame_size in zip(streams, self.frame_sizes):
+            q = queue.Queue(maxsize=self.queue_size)
+            reader = threading.Thread(target=self._read, args=(stream, frame_size, q), name='video_reader', daemon=True)
+            reader.start()
+            self.queues.append(q)
+            self.readers.append(reader)
+        return self
+
+    def __iter__(self):
+        if self.process is None:
+            self.start()
+        try:
+            while True:
+                frames = [q.get() for q in self.queues]
+                if any(frame is None for frame in frames):
+                    break
+                yield frames[0] if len(frames) == 1 else tuple(frames)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.process is None:
+            return
+        self.stopped.set()
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        for reader in self.readers:
+            reader.join()
+        self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_video_frames(filepath, sizes=(None,), **kwargs):
+    """ decode a whole video with FFmpegVideoReader, return one frame list per entry of sizes
+    """
+    frame_lsts = [[] for _ in sizes]
+    for frames in FFmpegVideoReader(filepath, sizes=sizes, **kwargs):
+        frames = frames if isinstance(frames, tuple) else (frames,)
+        for frame_lst, frame in zip(frame_lsts, frames):
+            frame_lst.append(frame)
+    return frame_lsts
+
+
 def change_video_fps(input_file, output_file, fps=20, codec='libx264', crf=5):
     cmd = f"ffmpeg -i {input_file} -c:v {codec} -crf {crf} -r {fps} {output_file} -y"
     exec_cmd(cmd)
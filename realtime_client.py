@@ -0,0 +1,149 @@
+import time
+import json
+import dataclasses
+import asyncio
+import argparse
+import cv2
+import numpy as np
+import websockets
+from LivePortrait.commons import Config
+from LivePortrait.commons.config import config_snapshot
+from LivePortrait.realtime_server import HEADER, RESULT_HEADER, SOURCE, FRAME, RESULT, MOTION, MAX_MESSAGE_SIZE
+
+
+def load_frames(video_path, max_frames, width, quality):
+    """ JPEG driving frames of a video, encoded once so that the clients measure the server, not the encoding
+    """
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if width and frame.shape[1] > width:
+            frame = cv2.resize(frame, (width, frame.shape[0] * width // frame.shape[1]))
+        frames.append(cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes())
+    cap.release()
+    if not frames:
+        raise ValueError(f'no frame read from {video_path}')
+    return frames
+
+
+def load_motion(video_path, max_frames, retargeting):
+    """ MotionPackets of the frames of a video, extracted once like an edge would do frame by frame
+    """
+    from LivePortrait.commons.motion_extractor import MotionExtractor
+    cfg = config_snapshot(Config, flag_eye_retargeting=retargeting, flag_lip_retargeting=retargeting)
+    extractor = MotionExtractor(cfg)
+    cap = cv2.VideoCapture(video_path)
+    packets = []
+    while len(packets) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        packets += extractor.extract([cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)])
+    cap.release()
+    if not packets:
+        raise ValueError(f'no frame read from {video_path}')
+    return packets
+
+
+def driving_message(frames, seq, motion):
+    """ message sending frame seq of the replayed frames (JPEG or MotionPacket), stamped now
+    """
+    now = time.perf_counter()
+    frame = frames[seq % len(frames)]
+    if motion:
+        # the edge timestamps the motion at capture, the replay captures now
+        packet = dataclasses.replace(frame, seq=seq, timestamp=now, anchor=seq == 0)
+        return HEADER.pack(MOTION, seq, now) + packet.encode()
+    return HEADER.pack(FRAME, seq, now) + frame
+
+
+async def run_client(index, url, source, frames, fps, duration, paste_back, motion=False):
+    """ one simulated webcam: sends frames (or their motion) at fps for duration seconds, return its measurements
+    """
+    stats = {'sent': 0, 'bytes': 0, 'rendered': 0, 'dropped': 0, 'rtt': [], 'render': []}
+    async with websockets.connect(url, max_size=MAX_MESSAGE_SIZE) as websocket:
+        await websocket.send(json.dumps({'type': 'config', 'paste_back': paste_back}))
+        await websocket.send(HEADER.pack(SOURCE, 0, time.perf_counter()) + source)
+        reply = json.loads(await websocket.recv())
+        if reply.get('type') != 'source':
+            raise RuntimeError(f'client {index}: {reply}')
+
+        async def send():
+            t0 = time.perf_counter()
+            seq = 0
+            while time.perf_counter() - t0 < duration:
+                message = driving_message(frames, seq, motion)
+                await websocket.send(message)
+                stats['bytes'] += len(message)
+                seq += 1
+                stats['sent'] = seq
+                await asyncio.sleep(max(t0 + seq / fps - time.perf_counter(), 0.))
+
+        sender = asyncio.create_task(send())
+        while not sender.done() or stats['rendered'] + stats['dropped'] < stats['sent']:
+            try:
+                message = await asyncio.wait_for(websocket.recv(), timeout=5.)
+            except asyncio.TimeoutError:
+                break
+            if isinstance(message, str):
+                continue
+            kind, seq, client_time, wait, decode, render, encode = RESULT_HEADER.unpack_from(message)
+            if kind == RESULT:
+                stats['rendered'] += 1
+                stats['rtt'].append((time.perf_counter() - client_time) * 1000.)
+                stats['render'].append(render)
+            else:
+                stats['dropped'] += 1
+        await sender
+    return stats
+
+
+def percentiles(values):
+    if not values:
+        return 'n/a'
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return f'p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms'
+
+
+async def main(args):
+    with open(args.source_img, 'rb') as f:
+        source = f.read()
+    max_frames = int(args.fps * args.duration)
+    if args.motion:
+        frames = load_motion(args.video_path, max_frames, args.retargeting)
+    else:
+        frames = load_frames(args.video_path, max_frames, args.width, args.quality)
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*[run_client(i, args.url, source, frames, args.fps, args.duration, args.paste_back,
+                                                args.motion) for i in range(args.clients)])
+    elapsed = time.perf_counter() - t0
+    for i, stats in enumerate(results):
+        print(f'client {i}: sent {stats["sent"]}, rendered {stats["rendered"]}, dropped {stats["dropped"]}, '
+              f'{stats["bytes"] / max(stats["sent"], 1):.0f} bytes/frame, round trip {percentiles(stats["rtt"])}')
+    rendered = sum(stats['rendered'] for stats in results)
+    print(f'{args.clients} clients: {rendered / elapsed:.1f} frames/s rendered, '
+          f'{sum(stats["dropped"] for stats in results)} dropped')
+    print(f'round trip: {percentiles([v for stats in results for v in stats["rtt"]])}')
+    print(f'server render: {percentiles([v for stats in results for v in stats["render"]])}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test client of the real-time WebSocket server')
+    parser.add_argument('--url', type=str, default='ws://127.0.0.1:8765', help='Server address')
+    parser.add_argument('-i', '--source_img', type=str, required=True, help='Path to the source image')
+    parser.add_argument('-v', '--video_path', type=str, required=True, help='Driving video the webcams replay')
+    parser.add_argument('--clients', type=int, default=1, help='Simulated webcams connected at once')
+    parser.add_argument('--fps', type=float, default=25., help='Frames per second sent by every webcam')
+    parser.add_argument('--duration', type=float, default=10., help='Seconds every webcam sends frames')
+    parser.add_argument('--width', type=int, default=640, help='Width the driving frames are scaled down to')
+    parser.add_argument('--quality', type=int, default=85, help='JPEG quality of the driving frames')
+    parser.add_argument('--paste_back', action='store_true', help='Ask for frames pasted back into the source')
+    parser.add_argument('--motion', action='store_true',
+                        help='Send the motion of the frames, extracted on this side, instead of the frames')
+    parser.add_argument('--retargeting', action='store_true', help='Add the eye and lip ratios to the motion')
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
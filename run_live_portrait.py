@@ -1,20 +1,40 @@
 import argparse
 import warnings
 from LivePortrait import LivePortraitONNX
+from LivePortrait.commons.config import OUTPUT_MODES
 
 warnings.filterwarnings("ignore")
 
 
-def main(video_path, source_img, real_time):
-    live_portrait = LivePortraitONNX()
-    live_portrait.render(live_portrait, video_path_or_id=video_path, image_path=source_img, real_time=real_time)
+def main(video_path, source_img, real_time, output_modes, start, end, stride, fps, chunk_size, workers, output):
+    live_portrait = LivePortraitONNX().with_options(driving_start=start, driving_end=end, driving_stride=stride,
+                                                    driving_fps=fps, render_chunk_size=chunk_size,
+                                                    render_workers=workers,
+                                                    realtime_output=output if real_time else None)
+    live_portrait.render(video_path_or_id=video_path, image_path=source_img, real_time=real_time,
+                         output_modes=output_modes, wfp_prefix=None if real_time else output)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Live Portrait Rendering Script')
-    parser.add_argument('-v', '--video_path_or_webcam_id', type=str, required=True, help='Path to the driving video or your webcam id')
+    parser.add_argument('-v', '--video_path_or_webcam_id', type=str, required=True,
+                        help='Path to the driving video, your webcam id or shm://name of a shared-memory frame ring')
     parser.add_argument('-i', '--source_img', type=str, required=True, help='Path to the source image')
     parser.add_argument('-r', '--real_time', action='store_true', help='Enable real-time webcam demo')
+    parser.add_argument('-o', '--output_modes', nargs='+', choices=OUTPUT_MODES, default=None,
+                        help='Outputs to produce: crop, pasted and/or concat (default: pasted concat)')
+    parser.add_argument('--start', type=float, default=0., help='Start time of the driving video in seconds')
+    parser.add_argument('--end', type=float, default=None, help='End time of the driving video in seconds')
+    parser.add_argument('--stride', type=int, default=1, help='Render every n-th driving frame')
+    parser.add_argument('--fps', type=float, default=None, help='Retime the driving video to this fps before inference')
+    parser.add_argument('--chunk_size', type=int, default=0,
+                        help='Render in resumable chunks of this many frames, a rerun continues an interrupted job')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Split the render of a driving video over this many processes')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Output path without extension, or shm://name to stream the frames to a shared-memory '
+                             'ring (in real time, instead of the window)')
     args = parser.parse_args()
 
-    main(args.video_path_or_webcam_id, args.source_img, args.real_time)
+    main(args.video_path_or_webcam_id, args.source_img, args.real_time, args.output_modes, args.start, args.end,
+         args.stride, args.fps, args.chunk_size, args.workers, args.output)
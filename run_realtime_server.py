@@ -0,0 +1,26 @@
+import argparse
+import asyncio
+import warnings
+from LivePortrait.commons import Config
+from LivePortrait.commons.config import config_snapshot
+from LivePortrait.async_pipeline import AsyncLivePortrait
+from LivePortrait.realtime_server import RealtimeServer
+
+warnings.filterwarnings("ignore")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Live Portrait Real-Time WebSocket Server')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Threads decoding, animating and encoding the frames (default: cfg.async_threads)')
+    parser.add_argument('--scheduling', action='store_true',
+                        help='Drop the frames not rendered within cfg.realtime_deadline_ms of their arrival')
+    args = parser.parse_args()
+
+    cfg = config_snapshot(Config, flag_scheduling=args.scheduling,
+                          async_threads=args.threads if args.threads is not None else Config.async_threads)
+    server = RealtimeServer(AsyncLivePortrait(cfg=cfg))
+    print(f'Listening on ws://{args.host}:{args.port}')
+    asyncio.run(server.serve(args.host, args.port))
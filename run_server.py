@@ -0,0 +1,27 @@
+import argparse
+import warnings
+import uvicorn
+from LivePortrait.commons import Config
+from LivePortrait.commons.config import config_snapshot
+from LivePortrait.service import create_app
+
+warnings.filterwarnings("ignore")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Live Portrait Rendering Service')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Jobs rendered at once, they share the models (default: cfg.service_workers)')
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help='Where the inputs and outputs of the jobs are kept (default: cfg.service_dir)')
+    parser.add_argument('--micro_batching', action='store_true',
+                        help='Batch the per-frame model calls of the jobs running at once (use with --workers > 1)')
+    parser.add_argument('--scheduling', action='store_true',
+                        help='Schedule the model calls by priority: real-time frames first, stale ones are dropped')
+    args = parser.parse_args()
+
+    # one process: the models are loaded once at startup and shared by every job
+    cfg = config_snapshot(Config, flag_micro_batching=args.micro_batching, flag_scheduling=args.scheduling)
+    uvicorn.run(create_app(cfg=cfg, n_workers=args.workers, work_dir=args.work_dir), host=args.host, port=args.port)
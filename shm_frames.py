@@ -0,0 +1,56 @@
+import time
+import argparse
+import cv2
+from LivePortrait.utils.shm_frames import SharedFrameRing, SharedFrameWriter, shared_frames_name
+
+
+def publish(video_path_or_id, path, fps, lossless, n_slots, timeout):
+    """ write the frames of a video or a webcam to a shm:// ring, a stand-in for a capture service
+    """
+    cap = cv2.VideoCapture(int(video_path_or_id) if video_path_or_id.isdigit() else video_path_or_id)
+    fps = fps or cap.get(cv2.CAP_PROP_FPS) or 25.
+    t0 = time.perf_counter()
+    with SharedFrameWriter(path, n_slots=n_slots, lossless=lossless, timeout=timeout) as writer:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            writer.write(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            if not video_path_or_id.isdigit() and not lossless:
+                # a video file is paced like a camera
+                time.sleep(max(t0 + writer.n_frames / fps - time.perf_counter(), 0.))
+    cap.release()
+
+
+def show(path, timeout):
+    """ display the frames of a shm:// ring, a stand-in for a compositor
+    """
+    ring = SharedFrameRing.attach(shared_frames_name(path), timeout=timeout)
+    n_frames, t0 = 0, time.perf_counter()
+    try:
+        for _, _, frame in ring.iter_frames(lossless=True, timeout=timeout):
+            cv2.imshow(path, frame[:, :, ::-1])
+            n_frames += 1
+            if cv2.waitKey(1) & 0xff == ord('q'):
+                break
+    finally:
+        ring.close()
+        cv2.destroyAllWindows()
+    print(f'{n_frames} frames, {n_frames / (time.perf_counter() - t0):.1f} fps')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Publish frames to or show frames of a shared-memory frame ring')
+    parser.add_argument('ring', type=str, help='shm://name of the ring')
+    parser.add_argument('--publish', type=str, default=None, help='Video or webcam id to publish to the ring')
+    parser.add_argument('--fps', type=float, default=None, help='Frame rate a published video is paced at')
+    parser.add_argument('--lossless', action='store_true',
+                        help='Wait for the consumer instead of overwriting its unread frames (offline rendering)')
+    parser.add_argument('--slots', type=int, default=8, help='Frames the ring holds')
+    parser.add_argument('--timeout', type=float, default=10., help='Seconds to wait for the other process')
+    args = parser.parse_args()
+
+    if args.publish is not None:
+        publish(args.publish, args.ring, args.fps, args.lossless, args.slots, args.timeout)
+    else:
+        show(args.ring, args.timeout)